@@ -11,7 +11,7 @@ from edc_subject_dashboard import ModelAdminSubjectDashboardMixin
 
 from ..admin_site import esr21_export_admin
 from ..forms import ExportFileForm
-from ..models import ExportFile
+from ..models import ExportFile, ExportStage
 
 
 class ModelAdminMixin(ModelAdminNextUrlRedirectMixin,
@@ -27,11 +27,26 @@ class ModelAdminMixin(ModelAdminNextUrlRedirectMixin,
     empty_value_display = '-'
 
 
+class ExportStageInline(admin.TabularInline):
+
+    model = ExportStage
+    fields = ('name', 'stage', 'wall_time', 'queries', 'rows')
+    readonly_fields = fields
+    ordering = ('name', '-wall_time')
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(ExportFile, site=esr21_export_admin)
 class ExportFileAdmin(ModelAdminMixin, admin.ModelAdmin):
 
     form = ExportFileForm
 
+    inlines = [ExportStageInline]
+
     fieldsets = (
         (None, {
             'fields': (
@@ -39,13 +54,20 @@ class ExportFileAdmin(ModelAdminMixin, admin.ModelAdmin):
                 'document',
                 'study',
                 'download_time',
-                'download_complete')}),
+                'download_complete',
+                'incremental',
+                'export_site',
+                'status',
+                'attempts',
+                'error',
+                'fingerprint')}),
         audit_fieldset_tuple
     )
 
     search_fields = ['export_identifier']
 
     list_display = ('export_identifier', 'description', 'download_time',
-                    'download_complete',)
+                    'download_complete', 'incremental', 'status', 'attempts',)
 
-    list_filter = ('download_complete', 'description',)
+    list_filter = ('download_complete', 'description', 'incremental',
+                   'export_site', 'status',)
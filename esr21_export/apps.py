@@ -16,6 +16,30 @@ class AppConfig(DjangoAppConfig):
     subject_path = settings.MEDIA_ROOT + export_date + '/subject/'
     non_crf_path = settings.MEDIA_ROOT + export_date + '/non_crf/'
     metadata_path = settings.MEDIA_ROOT + export_date + '/metadata/'
+    metadata_cache_path = getattr(
+        settings, 'ESR21_EXPORT_METADATA_CACHE',
+        settings.MEDIA_ROOT + '/documents/metadata_cache/')
+    chunk_size = getattr(settings, 'ESR21_EXPORT_CHUNK_SIZE', 2000)
+    export_processes = getattr(settings, 'ESR21_EXPORT_PROCESSES', 1)
+    export_database = getattr(settings, 'ESR21_EXPORT_DATABASE', 'default')
+    export_database_check_interval = getattr(
+        settings, 'ESR21_EXPORT_DATABASE_CHECK_INTERVAL', 60)
+    max_rows_per_second = getattr(settings, 'ESR21_EXPORT_MAX_ROWS_PER_SECOND', None)
+    max_queries_per_second = getattr(settings, 'ESR21_EXPORT_MAX_QUERIES_PER_SECOND', None)
+    latency_threshold = getattr(settings, 'ESR21_EXPORT_LATENCY_THRESHOLD', None)
+    max_backoff = getattr(settings, 'ESR21_EXPORT_MAX_BACKOFF', 10)
+    rows_per_task = getattr(settings, 'ESR21_EXPORT_ROWS_PER_TASK', 250000)
+    partition_field = getattr(settings, 'ESR21_EXPORT_PARTITION_FIELD', 'id')
+    site_shards = getattr(settings, 'ESR21_EXPORT_SITE_SHARDS', False)
+    site_ids = getattr(settings, 'ESR21_EXPORT_SITE_IDS', [40, 41, 42, 43, 44])
+    output_format = getattr(settings, 'ESR21_EXPORT_FORMAT', 'csv')
+    keep_export_files = getattr(settings, 'ESR21_EXPORT_KEEP_FILES', True)
+    reuse_export_files = getattr(settings, 'ESR21_EXPORT_REUSE_FILES', True)
+    profile_exports = getattr(settings, 'ESR21_EXPORT_PROFILE', True)
+    max_export_jobs = getattr(settings, 'ESR21_EXPORT_MAX_JOBS', 1)
+    export_job_retries = getattr(settings, 'ESR21_EXPORT_JOB_RETRIES', 3)
+    export_job_timeout = getattr(settings, 'ESR21_EXPORT_JOB_TIMEOUT', 6 * 60 * 60)
+    export_job_retry_delay = getattr(settings, 'ESR21_EXPORT_JOB_RETRY_DELAY', 60)
 
 
 class EdcBaseAppConfig(BaseEdcBaseAppConfig):
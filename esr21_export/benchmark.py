@@ -0,0 +1,411 @@
+import datetime
+import time
+import tracemalloc
+import uuid
+from contextlib import ExitStack, contextmanager
+from decimal import Decimal
+
+from django.apps import apps as django_apps
+from django.db import connections, transaction
+from edc_base.utils import get_utcnow
+
+from .export_data_mixin import ExportDataMixin
+from .export_methods import ExportMethods
+from .export_model_lists import (
+    subject_crfs_list, subject_inlines_dict, subject_many_to_many_crf,
+    subject_model_list, offstudy_prn_model_list, death_report_prn_model_list)
+from .export_non_crfs import ExportNonCrfData
+from .metadata import ExportMetadata
+from .metadata_app_names_list import metadata_app_names
+from .routers import available_databases, export_reads
+
+integer_types = [
+    'IntegerField', 'BigIntegerField', 'SmallIntegerField',
+    'PositiveIntegerField', 'PositiveSmallIntegerField']
+
+
+class SyntheticData:
+    """Fill the database with synthetic ESR21 subjects, visits, crfs,
+    inlines and many to many values shaped like the export model lists.
+
+    Objects are bulk created with a placeholder value for every field
+    that needs one, bypassing model save methods and signals. Models
+    that cannot be filled this way are skipped and listed in skipped.
+    """
+
+    study = 'esr21_subject'
+    identifier_prefix = 'SYN'
+
+    def __init__(self, subjects=100, visits=3, inlines=2, m2m_values=2,
+                 batch_size=1000, database=None):
+        self.database = database
+        self.subjects = subjects
+        self.visits = visits
+        self.inlines = inlines
+        self.m2m_values = m2m_values
+        self.batch_size = batch_size
+        self.parents = {}
+        self.created = {}
+        self.skipped = {}
+
+    @property
+    def subject_identifiers(self):
+        return [
+            f'{self.identifier_prefix}-{i:06d}' for i in range(self.subjects)]
+
+    def field_value(self, field=None, index=0):
+        """Return a placeholder value for a field.
+        """
+        internal_type = field.get_internal_type()
+        if field.is_relation:
+            return None if field.null else self.parent(field.related_model).pk
+        if field.primary_key:
+            return uuid.uuid4() if internal_type == 'UUIDField' else None
+        if field.has_default():
+            return field.get_default()
+        if field.null:
+            return None
+        if field.flatchoices:
+            return field.flatchoices[0][0]
+        if internal_type == 'DateTimeField':
+            return get_utcnow()
+        if internal_type == 'DateField':
+            return get_utcnow().date()
+        if internal_type == 'TimeField':
+            return datetime.time(8, 0)
+        if internal_type in ['BooleanField', 'NullBooleanField']:
+            return False
+        if internal_type in integer_types:
+            return index if field.unique else 1
+        if internal_type == 'DecimalField':
+            return Decimal(1)
+        if internal_type == 'FloatField':
+            return 1.0
+        if internal_type == 'DurationField':
+            return datetime.timedelta()
+        if internal_type == 'UUIDField':
+            return uuid.uuid4()
+        value = f'{field.name}{index}'
+        return value[-field.max_length:] if field.max_length else value
+
+    def build(self, model_cls=None, index=0, **values):
+        """Return an unsaved obj with a value for every field.
+        """
+        data = {}
+        for field in model_cls._meta.concrete_fields:
+            if field.name in values or field.attname in values:
+                continue
+            value = self.field_value(field=field, index=index)
+            if value is not None or field.null:
+                data[field.attname] = value
+        data.update(values)
+        return model_cls(**data)
+
+    def parent(self, model_cls=None):
+        """Return a single obj shared by every required foreign key to
+        the model.
+        """
+        if model_cls not in self.parents:
+            obj = self.build(model_cls=model_cls)
+            model_cls.objects.using(self.database).bulk_create([obj])
+            self.parents[model_cls] = obj
+        return self.parents[model_cls]
+
+    def bulk_create(self, model_cls=None, rows=None):
+        """Bulk create an obj per dict of values and return the objs, or
+        an empty list if the model could not be filled.
+        """
+        try:
+            objs = [
+                self.build(model_cls=model_cls, index=index, **values)
+                for index, values in enumerate(rows)]
+            with transaction.atomic(using=self.database):
+                model_cls.objects.using(self.database).bulk_create(
+                    objs, batch_size=self.batch_size)
+        except Exception as e:
+            self.skipped[model_cls._meta.label_lower] = repr(e)
+            return []
+        label = model_cls._meta.label_lower
+        self.created[label] = self.created.get(label, 0) + len(objs)
+        return objs
+
+    def get_model(self, model_name=None, app_label=None):
+        return django_apps.get_model(app_label or self.study, model_name)
+
+    def generate(self):
+        """Create subjects with their visits, crfs, inlines, many to many
+        values and non crfs.
+        """
+        subject_identifiers = self.subject_identifiers
+        subject_rows = [
+            {'subject_identifier': s} for s in subject_identifiers]
+        self.bulk_create(
+            model_cls=django_apps.get_model('edc_registration.registeredsubject'),
+            rows=subject_rows)
+        self.bulk_create(
+            model_cls=self.get_model('onschedule'),
+            rows=[{'subject_identifier': s,
+                   'schedule_name': 'esr21_sub_cohort_schedule' if i % 10 == 0
+                   else 'esr21_enrol_schedule'}
+                  for i, s in enumerate(subject_identifiers)])
+
+        appointments = self.bulk_create(
+            model_cls=django_apps.get_model('edc_appointment.appointment'),
+            rows=[{'subject_identifier': s, 'visit_code': str(1000 + v * 10)}
+                  for s in subject_identifiers for v in range(self.visits)])
+        visits = self.bulk_create(
+            model_cls=self.get_model('subjectvisit'),
+            rows=[{'appointment_id': a.pk,
+                   'subject_identifier': a.subject_identifier,
+                   'visit_code': a.visit_code} for a in appointments])
+        del appointments
+
+        crfs = {}
+        for crf_name in subject_crfs_list:
+            crfs[crf_name] = [obj.pk for obj in self.bulk_create(
+                model_cls=self.get_model(crf_name),
+                rows=[{'subject_visit_id': v.pk} for v in visits])]
+
+        for crf_name, (inline_names, filed_n) in subject_inlines_dict.items():
+            for inline_name in inline_names:
+                crfs[inline_name] = [obj.pk for obj in self.bulk_create(
+                    model_cls=self.get_model(inline_name),
+                    rows=[{filed_n: pk} for pk in crfs.get(crf_name, [])
+                          for _ in range(self.inlines)])]
+
+        for crf_name, mm_field, _ in subject_many_to_many_crf:
+            self.generate_m2m(
+                model_cls=self.get_model(crf_name), mm_field=mm_field,
+                obj_ids=crfs.get(crf_name, []))
+
+        for model_name in subject_model_list:
+            model_cls = self.get_model(model_name)
+            if model_name == 'subjectvisit':
+                continue
+            field_names = [f.name for f in model_cls._meta.concrete_fields]
+            if 'subject_visit' in field_names:
+                rows = [{'subject_visit_id': v.pk} for v in visits]
+            else:
+                rows = subject_rows
+            self.bulk_create(model_cls=model_cls, rows=rows)
+
+        for model_name in offstudy_prn_model_list + death_report_prn_model_list:
+            self.bulk_create(
+                model_cls=self.get_model(model_name, app_label='esr21_prn'),
+                rows=subject_rows[::10])
+        return self.created
+
+    def generate_m2m(self, model_cls=None, mm_field=None, obj_ids=None):
+        """Add m2m_values choices of the list model to every obj.
+        """
+        field = model_cls._meta.get_field(mm_field)
+        list_cls = field.related_model
+        choices = list(
+            list_cls.objects.using(self.database).all()[:self.m2m_values])
+        choices += self.bulk_create(
+            model_cls=list_cls,
+            rows=[{'name': f'{mm_field}_{i}', 'short_name': f'{mm_field}_{i}'}
+                  for i in range(len(choices), self.m2m_values)])
+        source = field.m2m_field_name()
+        target = field.m2m_reverse_field_name()
+        self.bulk_create(
+            model_cls=field.remote_field.through,
+            rows=[{f'{source}_id': obj_id, f'{target}_id': choice.pk}
+                  for obj_id in obj_ids for choice in choices])
+
+
+class BenchmarkRowsMixin:
+
+    rows_written = 0
+
+    def write_file(self, *args, **kwargs):
+        count = super().write_file(*args, **kwargs)
+        self.rows_written += count or 0
+        return count
+
+
+class BenchmarkExportData(ExportDataMixin):
+
+    rows_written = 0
+
+    def finish_file(self, writer=None, **kwargs):
+        self.rows_written += writer.count
+        super().finish_file(writer=writer, **kwargs)
+
+    def export_subject_crfs(self, crf_data_dict=None, study=None,
+                            output_format=None):
+        """Export every subject crf with its inline and many to many
+        merges, a single pass per crf.
+        """
+        crf_names = list(subject_crfs_list)
+        for crf_name in list(subject_inlines_dict) + [
+                c[0] for c in subject_many_to_many_crf]:
+            if crf_name not in crf_names:
+                crf_names.append(crf_name)
+        for crf_name in crf_names:
+            self.export_crf_outputs(
+                crf_name=crf_name, flat=crf_name in subject_crfs_list,
+                inline_n_field=subject_inlines_dict.get(crf_name),
+                m2m_class=[c for c in subject_many_to_many_crf
+                           if c[0] == crf_name],
+                crf_data_dict=crf_data_dict, study=study,
+                output_format=output_format)
+
+
+class BenchmarkNonCrfData(BenchmarkRowsMixin, ExportNonCrfData):
+    pass
+
+
+class ExportBenchmark:
+    """Time the export methods over the data in a database, reporting
+    rows per second, query counts and the peak memory allocated by each
+    method, traced from its start so earlier methods do not count.
+
+    The exports read from the benchmark database as they would from the
+    export database.
+    """
+
+    study = 'esr21_subject'
+
+    def __init__(self, export_path=None, output_format=None, database=None):
+        self.export_path = export_path
+        self.output_format = output_format
+        self.database = database
+        self.results = []
+
+    @contextmanager
+    def benchmark_reads(self):
+        """Send the reads of the exports to the benchmark database.
+        """
+        app_config = django_apps.get_app_config('esr21_export')
+        export_database = app_config.export_database
+        app_config.export_database = self.database
+        available_databases.pop(self.database, None)
+        try:
+            with export_reads():
+                yield
+        finally:
+            app_config.export_database = export_database
+            available_databases.pop(self.database, None)
+
+    def count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def measure(self, label=None, method=None, exporter=None, **options):
+        """Run an export method and record its result.
+        """
+        self.queries = 0
+        rows_written = getattr(exporter, 'rows_written', 0)
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(
+                        connection.execute_wrapper(self.count_query))
+                start = time.perf_counter()
+                traced, _ = tracemalloc.get_traced_memory()
+                method(**options)
+                seconds = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+        rows = getattr(exporter, 'rows_written', 0) - rows_written
+        result = {
+            'label': label,
+            'seconds': round(seconds, 3),
+            'rows': rows,
+            'rows_per_second': round(rows / seconds, 1) if rows and seconds else None,
+            'queries': self.queries,
+            'peak_memory_mb': round((peak - traced) / 1024 ** 2, 1),
+        }
+        self.results.append(result)
+        return result
+
+    def run(self):
+        """Time each export method in turn and return the results.
+        """
+        if self.database:
+            with self.benchmark_reads():
+                return self.run_exports()
+        return self.run_exports()
+
+    def run_exports(self):
+        export_methods = ExportMethods()
+        self.measure(label='load_lookups', method=export_methods.load_lookups)
+        crf_data = BenchmarkExportData(
+            export_path=self.export_path + 'subject/',
+            export_methods_cls=export_methods)
+        non_crf_data = BenchmarkNonCrfData(
+            export_path=self.export_path + 'non_crf/',
+            export_methods_cls=export_methods)
+        crf_options = {
+            'crf_data_dict': export_methods.subject_crf_data_dict,
+            'study': self.study, 'output_format': self.output_format}
+        self.measure(
+            label='export_crfs', method=crf_data.export_crfs,
+            exporter=crf_data, crf_list=subject_crfs_list, **crf_options)
+        self.measure(
+            label='export_inline_crfs', method=crf_data.export_inline_crfs,
+            exporter=crf_data, inlines_dict=subject_inlines_dict, **crf_options)
+        self.measure(
+            label='generate_m2m_crf', method=crf_data.generate_m2m_crf,
+            exporter=crf_data, m2m_class=subject_many_to_many_crf, **crf_options)
+        self.measure(
+            label='export_crf_outputs', method=crf_data.export_subject_crfs,
+            exporter=crf_data, **crf_options)
+        self.measure(
+            label='subject_non_crfs', method=non_crf_data.subject_non_crfs,
+            exporter=non_crf_data, subject_model_list=subject_model_list,
+            output_format=self.output_format)
+        self.measure(
+            label='subject_visit', method=non_crf_data.subject_visit,
+            exporter=non_crf_data, output_format=self.output_format)
+        self.measure(
+            label='offstudy', method=non_crf_data.offstudy,
+            exporter=non_crf_data,
+            offstudy_prn_model_list=offstudy_prn_model_list,
+            output_format=self.output_format)
+        self.measure(
+            label='death_report', method=non_crf_data.death_report,
+            exporter=non_crf_data,
+            death_report_prn_model_list=death_report_prn_model_list,
+            output_format=self.output_format)
+        metadata = ExportMetadata(export_path=self.export_path + 'metadata/')
+        self.measure(
+            label='generate_metadata', method=metadata.generate_metadata,
+            app_names=metadata_app_names)
+        export_methods.clear_lookups()
+        return self.results
+
+    def regressions(self, baseline=None, tolerance=0.2):
+        """Return a message per result slower, with more queries or a
+        higher peak memory than the baseline results by more than the
+        tolerance.
+        """
+        baseline = {result['label']: result for result in baseline or []}
+        messages = []
+        for result in self.results:
+            previous = baseline.get(result['label'])
+            if not previous:
+                continue
+            if (previous.get('rows_per_second') and result['rows_per_second']
+                    and result['rows_per_second'] < previous['rows_per_second'] * (1 - tolerance)):
+                messages.append(
+                    f'{result["label"]}: {result["rows_per_second"]} rows/s, '
+                    f'baseline {previous["rows_per_second"]} rows/s')
+            if result['queries'] > previous['queries'] * (1 + tolerance):
+                messages.append(
+                    f'{result["label"]}: {result["queries"]} queries, '
+                    f'baseline {previous["queries"]} queries')
+            if (previous.get('peak_memory_mb')
+                    and result['peak_memory_mb'] > previous['peak_memory_mb'] * (1 + tolerance)):
+                messages.append(
+                    f'{result["label"]}: {result["peak_memory_mb"]} MB peak, '
+                    f'baseline {previous["peak_memory_mb"]} MB peak')
+        return messages
@@ -0,0 +1,22 @@
+from .constants import COMPLETE, FAILED, QUEUED, RUNNING
+from .constants import (
+    DATES_STAGE, ENCRYPT_STAGE, FILE_STAGE, QUERY_STAGE, ROWS_STAGE,
+    THROTTLE_STAGE, WRITE_STAGE, ZIP_STAGE)
+
+EXPORT_STATUS = (
+    (QUEUED, 'Queued'),
+    (RUNNING, 'Running'),
+    (COMPLETE, 'Complete'),
+    (FAILED, 'Failed'),
+)
+
+EXPORT_STAGES = (
+    (FILE_STAGE, 'Other file work'),
+    (QUERY_STAGE, 'Query'),
+    (ROWS_STAGE, 'Row building'),
+    (ENCRYPT_STAGE, 'Encrypt values'),
+    (DATES_STAGE, 'Date formatting'),
+    (WRITE_STAGE, 'File write'),
+    (ZIP_STAGE, 'Zip'),
+    (THROTTLE_STAGE, 'Throttle wait'),
+)
@@ -0,0 +1,13 @@
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETE = 'complete'
+FAILED = 'failed'
+
+FILE_STAGE = 'file'
+QUERY_STAGE = 'query'
+ROWS_STAGE = 'rows'
+ENCRYPT_STAGE = 'encrypt'
+DATES_STAGE = 'dates'
+WRITE_STAGE = 'write'
+ZIP_STAGE = 'zip'
+THROTTLE_STAGE = 'throttle'
@@ -0,0 +1,93 @@
+import os
+import queue
+import shutil
+import threading
+import time
+import zipfile
+
+from django.apps import apps as django_apps
+
+from .constants import ZIP_STAGE
+
+
+class ExportArchive:
+    """Compress export files into a zip archive as they are written.
+
+    Files are compressed on a background thread, so compression of one
+    model's file overlaps with the database reads of the next, and are
+    removed once archived unless the raw files are kept. With a profiler
+    the compression time of each file is recorded as its zip stage.
+    """
+
+    def __init__(self, dir_to_zip=None, keep_files=None, profiler=None):
+        self.dir_to_zip = dir_to_zip
+        self.profiler = profiler
+        self.zip_path = dir_to_zip + '.zip'
+        if keep_files is None:
+            keep_files = django_apps.get_app_config('esr21_export').keep_export_files
+        self.keep_files = keep_files
+        self.archived = set()
+        self.error = None
+        self.queue = queue.Queue()
+        os.makedirs(os.path.dirname(self.zip_path), exist_ok=True)
+        self.zip_file = zipfile.ZipFile(
+            self.zip_path, 'w', compression=zipfile.ZIP_DEFLATED)
+        self.thread = threading.Thread(target=self.compress, daemon=True)
+        self.thread.start()
+
+    def add(self, path=None):
+        """Queue a written export file for compression.
+        """
+        self.queue.put(path)
+
+    def compress(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            arcname = os.path.relpath(path, self.dir_to_zip)
+            if arcname in self.archived:
+                continue
+            try:
+                start = time.perf_counter()
+                self.zip_file.write(path, arcname)
+                self.archived.add(arcname)
+                if self.profiler:
+                    name = os.path.splitext(os.path.basename(path))[0]
+                    self.profiler.record(
+                        name=name.rsplit('_', 1)[0], stage=ZIP_STAGE,
+                        seconds=time.perf_counter() - start, rows=0)
+                if not self.keep_files:
+                    os.remove(path)
+            except Exception as e:
+                self.error = self.error or e
+
+    def close(self):
+        """Archive any files not yet added, e.g. metadata workbooks, and
+        finish the zip file.
+        """
+        for root, _, files in os.walk(self.dir_to_zip):
+            for name in sorted(files):
+                self.add(os.path.join(root, name))
+        self.queue.put(None)
+        self.thread.join()
+        self.zip_file.close()
+        if self.profiler:
+            self.profiler.save()
+        if not self.keep_files:
+            shutil.rmtree(self.dir_to_zip, ignore_errors=True)
+        if self.error:
+            raise self.error
+
+    def abort(self):
+        """Stop compressing and remove the unfinished zip file, e.g. when
+        the export failed, along with the export files unless they are
+        kept.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.zip_file.close()
+        if os.path.exists(self.zip_path):
+            os.remove(self.zip_path)
+        if not self.keep_files:
+            shutil.rmtree(self.dir_to_zip, ignore_errors=True)
@@ -1,50 +1,254 @@
 import datetime
+import itertools
 import os
+from functools import partial
 from django.apps import apps as django_apps
 
-import pandas as pd
-
 from .export_methods import ExportMethods
 from .export_model_lists import exclude_fields
+from .export_partitions import partition_queryset, site_queryset
+from .export_writer import export_writers
+
+
+def crf_output_name(study=None, crf_name=None, merged=None):
+    """Return the name of a crf export file without its timestamp, the
+    crf merged with an inline or a many to many field if given.
+    """
+    if merged:
+        return study + '_' + crf_name + '_merged_' + merged
+    return study + '_' + crf_name
+
+
+def crf_output_names(study=None, crf_name=None, flat=True, inline_n_field=None,
+                     m2m_class=None, layout='long'):
+    """Return the names of the files export_crf_outputs writes.
+    """
+    names = [crf_output_name(study, crf_name)] if flat else []
+    for inl in (inline_n_field or [[]])[0]:
+        names.append(crf_output_name(study, crf_name, merged=inl))
+    for crf_infor in m2m_class or []:
+        suffix = crf_infor[1] + ('_wide' if layout == 'wide' else '')
+        names.append(crf_output_name(study, crf_name, merged=suffix))
+    return names
 
 
 class ExportDataMixin:
 
-    def __init__(self, export_path=None):
-        self.export_path = export_path or django_apps.get_app_config('esr21_export').subject_path
+    def __init__(self, export_path=None, export_methods_cls=None, columns=None,
+                 partition=None, site_id=None):
+        app_config = django_apps.get_app_config('esr21_export')
+        self.export_path = export_path or app_config.subject_path
         if not os.path.exists(self.export_path):
             os.makedirs(self.export_path)
-        self.export_methods_cls = ExportMethods()
+        self.export_methods_cls = export_methods_cls or ExportMethods()
+        self.chunk_size = app_config.chunk_size
+        self.output_format = app_config.output_format
+        self.written_files = []
+        self.columns = columns or {}
+        self.partition = partition
+        self.site_id = site_id
+
+    def partitioned(self, queryset=None):
+        """Limit a queryset to the site and the range of the partition
+        exported.
+        """
+        queryset = site_queryset(queryset=queryset, site_id=self.site_id)
+        return partition_queryset(queryset=queryset, partition=self.partition)
+
+    def column_subset(self, model_cls=None):
+        """Return the columns of a model the export is limited to, or
+        None to export all of them.
+        """
+        return self.columns.get(model_cls._meta.model_name)
+
+    def crf_queryset(self, crf_cls=None, inline_cls=None, filed_n=None):
+        """Return the crf queryset for export, bulk loading the
+        registered subject and cohort data for its subjects.
+        """
+        queryset = self.partitioned(self.export_methods_cls.export_window(
+            queryset=self.export_methods_cls.crf_queryset(crf_cls=crf_cls),
+            inline_cls=inline_cls, filed_n=filed_n))
+        visit_lookup = self.export_methods_cls.visit_lookup(crf_cls=crf_cls)
+        self.export_methods_cls.prefetch_subject_data(
+            queryset=queryset,
+            subject_lookup=f'{visit_lookup}__subject_identifier')
+        return queryset
+
+    def open_writer(self, fname=None, model_classes=None, extra_fieldnames=None,
+                    output_format=None, rows_total=None):
+        """Return a writer for a csv or parquet file in the export path,
+        preparing rows a chunk at a time and reporting progress, or None
+        if the file of a previous export was reused.
+        """
+        writer_cls = export_writers[output_format or self.output_format]
+        fieldnames = []
+        for model_cls in model_classes:
+            if not self.column_subset(model_cls=model_cls):
+                fieldnames += self.export_methods_cls.export_fieldnames(
+                    model_cls=model_cls, format_dates=writer_cls.format_dates)
+        name = fname.rsplit('_', 1)[0]
+        fingerprint = self.export_methods_cls.file_fingerprint(
+            model_classes=model_classes, name=name,
+            output_format=output_format or self.output_format,
+            extra_fieldnames=extra_fieldnames, exclude=exclude_fields,
+            site_id=self.site_id,
+            columns=[self.column_subset(model_cls=model_cls)
+                     for model_cls in model_classes])
+        if self.partition:
+            # A part file is concatenated into the model's file, which is
+            # never reused from a previous export.
+            fingerprint = None
+        reused_path = self.export_methods_cls.reuse_file(
+            name=name, fingerprint=fingerprint, export_path=self.export_path)
+        if reused_path:
+            self.written_files.append(reused_path)
+            return None
+        final_path = self.export_path + fname + writer_cls.extension
+        return writer_cls(
+            final_path=final_path,
+            fieldnames=fieldnames + (extra_fieldnames or []),
+            exclude=self.export_methods_cls.export_exclude(exclude=exclude_fields),
+            chunk_size=self.chunk_size,
+            model_classes=model_classes,
+            derived_columns=self.export_methods_cls.derived_columns(
+                model_classes=model_classes,
+                format_dates=writer_cls.format_dates),
+            derived_fields=self.export_methods_cls.derived_fields(),
+            progress=self.export_methods_cls.export_progress(
+                name=name, rows_total=rows_total, path=final_path,
+                fingerprint=fingerprint),
+            profiler=self.export_methods_cls.profiler,
+            transform=partial(
+                self.export_methods_cls.export_chunk,
+                model_cls=model_classes[0],
+                format_dates=writer_cls.format_dates))
+
+    def finish_file(self, writer=None, fname=None, model_classes=None,
+                    filed_n=None, replaced=None):
+        """Record a written file and write its tombstone file.
+        """
+        self.written_files.append(writer.final_path)
+        self.write_deleted(
+            fname=fname, model_classes=model_classes, writer_cls=type(writer),
+            filed_n=filed_n, replaced=replaced)
+
+    def write_file(self, fname=None, rows=None, model_classes=None,
+                   extra_fieldnames=None, output_format=None, rows_total=None,
+                   filed_n=None, replaced=None):
+        """Stream rows into a csv or parquet file in the export path,
+        preparing them a chunk at a time and reporting progress.
+        """
+        writer = self.open_writer(
+            fname=fname, model_classes=model_classes,
+            extra_fieldnames=extra_fieldnames, output_format=output_format,
+            rows_total=rows_total)
+        if not writer:
+            return None
+        with self.export_methods_cls.profiler.file(name=fname.rsplit('_', 1)[0]):
+            count = writer.write(rows)
+        self.finish_file(
+            writer=writer, fname=fname, model_classes=model_classes,
+            filed_n=filed_n, replaced=replaced)
+        return count
+
+    def write_deleted(self, fname=None, model_classes=None, writer_cls=None,
+                      filed_n=None, replaced=None):
+        """Write the tombstone file of an incremental export, a row per
+        obj deleted of the crf and of the inline merged into it, keyed by
+        model and id, and per obj whose replaced many to many values are
+        written again.
+        """
+        crf_cls, inline_cls = (list(model_classes) + [None])[:2]
+        tombstones = [replaced]
+        if not self.partition or not self.partition['index']:
+            tombstones.append(self.export_methods_cls.deleted_rows(
+                model_cls=crf_cls, site_id=self.site_id))
+            if inline_cls:
+                tombstones.append(self.export_methods_cls.deleted_rows(
+                    model_cls=inline_cls, site_id=self.site_id,
+                    parent_cls=crf_cls, parent_field=filed_n))
+        tombstones = [
+            rows for rows in tombstones if rows is not None and rows.exists()]
+        if tombstones:
+            writer = writer_cls(
+                final_path=self.export_path + fname + '_deleted' + writer_cls.extension,
+                fieldnames=['model', 'id', 'history_date'],
+                chunk_size=self.chunk_size)
+            writer.write(itertools.chain(*tombstones))
+            self.written_files.append(writer.final_path)
 
-    def export_crfs(self, crf_list=None, crf_data_dict=None, study=None):
+    def export_crfs(self, crf_list=None, crf_data_dict=None, study=None,
+                    output_format=None):
 
         """Export crf data.
         """
         for crf_name in crf_list:
             crf_cls = django_apps.get_model(study, crf_name)
-            objs = crf_cls.objects.all()
-            count = 0
-            crf_data = []
-            for crf_obj in objs:
-                temp_data = crf_data_dict(crf_obj=crf_obj)
-                data = self.export_methods_cls.fix_date_format(
-                    obj_dict=temp_data)
-                for e_fields in exclude_fields:
-                    try:
-                        del data[e_fields]
-                    except KeyError:
-                        pass
-                # subject_identifier = data.get('subject_visit').subject_identifier
-                data.update(self.export_methods_cls.get_participant_cohort(data.get('subject_identifier')))
-                crf_data.append(data)
-                count += 1
+            objs = self.crf_queryset(crf_cls=crf_cls)
+            rows = self.export_methods_cls.iterate_values(
+                queryset=objs, chunk_size=self.chunk_size, encrypt=True,
+                row_dict=partial(crf_data_dict, crf_cls=crf_cls),
+                columns=self.export_methods_cls.crf_columns(
+                    crf_cls=crf_cls, exclude=exclude_fields,
+                    only=self.column_subset(model_cls=crf_cls)))
             timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-            fname = study + '_' + crf_name + '_' + timestamp + '.csv'
-            final_path = self.export_path + fname
-            df_crf = pd.DataFrame(crf_data)
-            df_crf.to_csv(final_path, encoding='utf-8', index=False)
+            fname = crf_output_name(study, crf_name) + '_' + timestamp
+            self.write_file(
+                fname=fname, rows=rows, model_classes=[crf_cls],
+                output_format=output_format, rows_total=objs.count())
 
-    def export_inline_crfs(self, inlines_dict=None, crf_data_dict=None, study=None):
+    def inline_lookup(self, crf_objs=None, inline_cls=None, filed_n=None):
+        """Return the inline rows of all crfs in one query, grouped by
+        the crf id. The id of an inline, read in an incremental export,
+        is renamed so it does not replace the id of its crf.
+        """
+        inline_objs = inline_cls.objects.filter(
+            **{f'{filed_n}__in': crf_objs.values('id')})
+        columns = self.export_methods_cls.export_columns(
+            model_cls=inline_cls, exclude=exclude_fields, include=[filed_n],
+            only=self.column_subset(model_cls=inline_cls))
+        id_column = self.export_methods_cls.inline_id_column(inline_cls=inline_cls)
+        inlines = {}
+        for in_data in self.export_methods_cls.iterate_values(
+                queryset=inline_objs, columns=columns,
+                chunk_size=self.chunk_size):
+            if 'id' in in_data:
+                in_data[id_column] = in_data.pop('id')
+            inlines.setdefault(in_data[filed_n], []).append(in_data)
+        return inlines
+
+    def inline_rows(self, crf_objs=None, inline_cls=None, filed_n=None,
+                    crf_data_dict=None):
+        """Yield crf rows merged with each of their inline rows.
+        """
+        inlines = self.inline_lookup(
+            crf_objs=crf_objs, inline_cls=inline_cls, filed_n=filed_n)
+        crf_cls = crf_objs.model
+        columns = self.export_methods_cls.crf_columns(
+            crf_cls=crf_cls, exclude=exclude_fields, include=['id'],
+            only=self.column_subset(model_cls=crf_cls))
+        for crfdata in self.export_methods_cls.iterate_values(
+                queryset=crf_objs, columns=columns, chunk_size=self.chunk_size,
+                encrypt=True, row_dict=partial(crf_data_dict, crf_cls=crf_cls)):
+            in_rows = inlines.pop(crfdata['id'], None)
+            if in_rows:
+                for in_data in in_rows:
+                    # Merged inline and CRF data
+                    yield {**crfdata, **in_data}
+            else:
+                yield crfdata
+
+    def inline_rows_total(self, crf_objs=None, inline_cls=None, filed_n=None):
+        """Return the number of merged rows, a row per inline plus a row
+        per crf without inlines.
+        """
+        inline_objs = inline_cls.objects.filter(
+            **{f'{filed_n}__in': crf_objs.values('id')})
+        return inline_objs.count() + crf_objs.exclude(
+            id__in=inline_objs.values(filed_n)).count()
+
+    def export_inline_crfs(self, inlines_dict=None, crf_data_dict=None, study=None,
+                           output_format=None):
         """Export Inline data.
         """
 
@@ -52,89 +256,167 @@ class ExportDataMixin:
             inline, filed_n = inline_n_field
             for inl in inline:
                 inline_cls = django_apps.get_model(study, inl)
-                inline_objs = inline_cls.objects.all()
                 crf_cls = django_apps.get_model(study, crf_name)
-                count = 0
-                mergered_data = []
-                crf_objs = crf_cls.objects.all()
-                for crf_obj in crf_objs:
-                    inline_objs = inline_cls.objects.filter(**{filed_n: crf_obj.id})
-                    if inline_objs:
-                        for inline_obj in inline_objs:
-                            in_data = inline_obj.__dict__
-                            del in_data['_state']
-
-                            crfdata = crf_data_dict(crf_obj)
-
-                            # Merged inline and CRF data
-                            data = self.export_methods_cls.fix_date_format({**crfdata, **in_data})
-                            for e_fields in exclude_fields:
-                                try:
-                                    del data[e_fields]
-                                except KeyError:
-                                    pass
-                            mergered_data.append(data)
-                            count += 1
-                    else:
-                        crfdata = self.export_methods_cls.fix_date_format(
-                            crf_data_dict(crf_obj))
-                        for e_fields in exclude_fields:
-                            try:
-                                del crfdata[e_fields]
-                            except KeyError:
-                                pass
-                       # subject_identifier = crfdata.get('subject_visit').subject_identifier
-                        crfdata.update(self.export_methods_cls.get_participant_cohort(
-                            crfdata.get('subject_identifier')))
-                        mergered_data.append(crfdata)
-                        count += 1
+                crf_objs = self.crf_queryset(
+                    crf_cls=crf_cls, inline_cls=inline_cls, filed_n=filed_n)
+                rows = self.inline_rows(
+                    crf_objs=crf_objs, inline_cls=inline_cls, filed_n=filed_n,
+                    crf_data_dict=crf_data_dict)
                 timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-                fname = study + '_' + crf_name + '_' + 'merged' '_' + inl + '_' + timestamp + '.csv'
-                final_path = self.export_path + fname
-                df_crf_inline = pd.DataFrame(mergered_data)
-                df_crf_inline.to_csv(final_path, encoding='utf-8', index=False)
-
-    def generate_m2m_crf(self, m2m_class=None, crf_data_dict=None, study=None,):
+                fname = crf_output_name(study, crf_name, merged=inl) + '_' + timestamp
+                extra_fieldnames = []
+                if self.export_methods_cls.incremental:
+                    extra_fieldnames = [self.export_methods_cls.inline_id_column(
+                        inline_cls=inline_cls)]
+                self.write_file(
+                    fname=fname, rows=rows, model_classes=[crf_cls, inline_cls],
+                    extra_fieldnames=extra_fieldnames, filed_n=filed_n,
+                    output_format=output_format,
+                    rows_total=self.inline_rows_total(
+                        crf_objs=crf_objs, inline_cls=inline_cls,
+                        filed_n=filed_n))
 
+    def generate_m2m_crf(self, m2m_class=None, crf_data_dict=None, study=None,
+                         layout='long', output_format=None):
+        """Export crfs merged with their many to many values, a row per
+        value or, with layout 'wide', a boolean column per choice.
+        """
         for crf_infor in m2m_class:
-                crf_name, mm_field, _ = crf_infor
-                crf_cls = django_apps.get_model(study, crf_name)
-                count = 0
-                mergered_data = []
-                crf_objs = crf_cls.objects.all()
-                for crf_obj in crf_objs:
-                    mm_objs = getattr(crf_obj, mm_field).all()
-                    if mm_objs:
-                        for mm_obj in mm_objs:
-                            mm_data = {mm_field: mm_obj.short_name}
-
-                            crfdata = crf_data_dict(crf_obj=crf_obj)
-
-                            # Merged many to many and CRF data
-                            data = self.export_methods_cls.fix_date_format({**crfdata, **mm_data})
-                            for e_fields in exclude_fields:
-                                try:
-                                    del data[e_fields]
-                                except KeyError:
-                                    pass
-                            mergered_data.append(data)
-                            count += 1
-                    else:
-                        crfdata = self.export_methods_cls.fix_date_format(
-                            crf_data_dict(crf_obj=crf_obj))
-                        for e_fields in exclude_fields:
-                            try:
-                                del crfdata[e_fields]
-                            except KeyError:
-                                pass
-                        # subject_identifier = crfdata.get('subject_visit').subject_identifier
-                        crfdata.update(self.export_methods_cls.get_participant_cohort(
-                            crfdata.get('subject_identifier')))
-                        mergered_data.append(crfdata)
-                        count += 1
+            crf_name, mm_field, _ = crf_infor
+            crf_cls = django_apps.get_model(study, crf_name)
+            crf_objs = self.crf_queryset(crf_cls=crf_cls)
+            rows = self.export_methods_cls.flatten_m2m(
+                queryset=crf_objs, mm_field=mm_field,
+                obj_data=partial(crf_data_dict, crf_cls=crf_cls),
+                layout=layout, chunk_size=self.chunk_size,
+                columns=self.export_methods_cls.crf_columns(
+                    crf_cls=crf_cls, exclude=exclude_fields, include=['id'],
+                    only=self.column_subset(model_cls=crf_cls)))
+            extra_fieldnames = [mm_field]
+            if layout == 'wide':
+                mm_field += '_wide'
+                extra_fieldnames = list(self.export_methods_cls.m2m_columns(
+                    model_cls=crf_cls, mm_field=crf_infor[1]).values())
+            timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+            fname = crf_output_name(study, crf_name, merged=mm_field) + '_' + timestamp
+            self.write_file(
+                fname=fname, rows=rows, model_classes=[crf_cls],
+                extra_fieldnames=extra_fieldnames, output_format=output_format,
+                rows_total=crf_objs.count() if layout == 'wide' else None,
+                replaced=self.export_methods_cls.replaced_m2m_rows(
+                    queryset=crf_objs, mm_field=crf_infor[1]))
 
-                timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-                fname = study + '_' + crf_name + '_' + 'merged' '_' + mm_field + '_' + timestamp + '.csv'
-                final_path = self.export_path + fname
-                df_crf_many2many = pd.DataFrame(mergered_data)
-                df_crf_many2many.to_csv(final_path, encoding='utf-8', index=False)
+    def export_crf_outputs(self, crf_name=None, flat=True, inline_n_field=None,
+                           m2m_class=None, crf_data_dict=None, study=None,
+                           layout='long', output_format=None):
+        """Export a crf, its inlines merged with it and its many to many
+        values in a single pass, reading and preparing each crf row once
+        for all of the files.
+
+        An incremental export reads the inline merges from the crfs whose
+        inlines changed, so the files are exported one at a time instead.
+        """
+        inline, filed_n = inline_n_field or [[], None]
+        if self.export_methods_cls.incremental:
+            if flat:
+                self.export_crfs(
+                    crf_list=[crf_name], crf_data_dict=crf_data_dict,
+                    study=study, output_format=output_format)
+            if inline:
+                self.export_inline_crfs(
+                    inlines_dict={crf_name: inline_n_field},
+                    crf_data_dict=crf_data_dict, study=study,
+                    output_format=output_format)
+            if m2m_class:
+                self.generate_m2m_crf(
+                    m2m_class=m2m_class, crf_data_dict=crf_data_dict,
+                    study=study, layout=layout, output_format=output_format)
+            return
+        crf_cls = django_apps.get_model(study, crf_name)
+        crf_objs = self.crf_queryset(crf_cls=crf_cls)
+        timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        with self.export_methods_cls.profiler.file(name=study + '_' + crf_name):
+            flat_writer = None
+            if flat:
+                fname = crf_output_name(study, crf_name) + '_' + timestamp
+                flat_writer = self.open_writer(
+                    fname=fname, model_classes=[crf_cls],
+                    output_format=output_format, rows_total=crf_objs.count())
+            files = [(flat_writer, fname)] if flat_writer else []
+
+            inline_sinks = []
+            for inl in inline:
+                inline_cls = django_apps.get_model(study, inl)
+                fname = crf_output_name(study, crf_name, merged=inl) + '_' + timestamp
+                writer = self.open_writer(
+                    fname=fname, model_classes=[crf_cls, inline_cls],
+                    output_format=output_format,
+                    rows_total=self.inline_rows_total(
+                        crf_objs=crf_objs, inline_cls=inline_cls,
+                        filed_n=filed_n))
+                if writer:
+                    files.append((writer, fname))
+                    inline_sinks.append((writer, self.inline_lookup(
+                        crf_objs=crf_objs, inline_cls=inline_cls,
+                        filed_n=filed_n)))
+
+            m2m_sinks = []
+            for crf_infor in m2m_class or []:
+                mm_field = crf_infor[1]
+                choices = None
+                extra_fieldnames = [mm_field]
+                suffix = mm_field
+                if layout == 'wide':
+                    choices = self.export_methods_cls.m2m_columns(
+                        model_cls=crf_cls, mm_field=mm_field)
+                    extra_fieldnames = list(choices.values())
+                    suffix += '_wide'
+                fname = crf_output_name(study, crf_name, merged=suffix) + '_' + timestamp
+                writer = self.open_writer(
+                    fname=fname, model_classes=[crf_cls],
+                    extra_fieldnames=extra_fieldnames,
+                    output_format=output_format,
+                    rows_total=crf_objs.count() if layout == 'wide' else None)
+                if writer:
+                    files.append((writer, fname))
+                    m2m_sinks.append((
+                        writer, mm_field, choices,
+                        self.export_methods_cls.m2m_lookup(
+                            queryset=crf_objs, mm_field=mm_field,
+                            chunk_size=self.chunk_size)))
+
+            if not files:
+                return
+            columns = self.export_methods_cls.crf_columns(
+                crf_cls=crf_cls, exclude=exclude_fields, include=['id'],
+                only=self.column_subset(model_cls=crf_cls))
+            try:
+                for crfdata in self.export_methods_cls.iterate_values(
+                        queryset=crf_objs, columns=columns,
+                        chunk_size=self.chunk_size, encrypt=True,
+                        row_dict=partial(crf_data_dict, crf_cls=crf_cls)):
+                    crf_id = crfdata['id']
+                    # Every file gets its own row dicts, as rows are
+                    # changed in place when a chunk is prepared.
+                    for writer, inlines in inline_sinks:
+                        in_rows = inlines.pop(crf_id, None)
+                        if in_rows:
+                            for in_data in in_rows:
+                                writer.add({**crfdata, **in_data})
+                        else:
+                            writer.add(dict(crfdata))
+                    for writer, mm_field, choices, m2m in m2m_sinks:
+                        for row in self.export_methods_cls.m2m_rows(
+                                data=dict(crfdata), values=m2m.pop(crf_id, []),
+                                mm_field=mm_field, choices=choices):
+                            writer.add(row)
+                    if flat_writer:
+                        flat_writer.add(crfdata)
+                for writer, fname in files:
+                    writer.close()
+                    self.finish_file(
+                        writer=writer, fname=fname, model_classes=[crf_cls])
+            except Exception:
+                for writer, _ in files:
+                    writer.close_file()
+                raise
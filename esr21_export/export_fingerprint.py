@@ -0,0 +1,77 @@
+import hashlib
+import json
+
+from django.apps import apps as django_apps
+from django.db.models import Count, Max
+
+
+class ExportFingerprint:
+    """Cheap signatures of the data behind an export file or a whole
+    export, a row count, the latest modified and a schema hash per
+    model. Equal fingerprints mean the export would come out the same.
+    """
+
+    lookup_models = [
+        'edc_registration.registeredsubject',
+        'edc_appointment.appointment',
+        'esr21_subject.informedconsent',
+        'esr21_subject.onschedule',
+        'esr21_subject.subjectvisit',
+    ]
+
+    def __init__(self):
+        self.signatures = {}
+
+    def schema_hash(self, model_cls=None):
+        schema = [(f.attname, f.get_internal_type())
+                  for f in model_cls._meta.concrete_fields]
+        return hashlib.sha256(json.dumps(schema).encode()).hexdigest()[:16]
+
+    def model_signature(self, model_cls=None):
+        """Return the row count, latest modified and schema hash of a
+        model, computed once per fingerprint instance.
+        """
+        label = model_cls._meta.label_lower
+        if label not in self.signatures:
+            field_names = [f.name for f in model_cls._meta.concrete_fields]
+            if 'modified' in field_names:
+                signature = model_cls.objects.aggregate(
+                    count=Count('pk'), modified=Max('modified'))
+            else:
+                signature = {'count': model_cls.objects.count()}
+            self.signatures[label] = [
+                label, signature['count'], str(signature.get('modified')),
+                self.schema_hash(model_cls=model_cls)]
+        return self.signatures[label]
+
+    def related_models(self, model_cls=None):
+        """Return the model with its many to many through and list
+        models.
+        """
+        models = [model_cls]
+        for field in model_cls._meta.many_to_many:
+            models += [field.remote_field.through, field.related_model]
+        return models
+
+    def fingerprint(self, model_classes=None, **options):
+        """Return the fingerprint of models, the subject lookup models
+        and any options that change the output.
+        """
+        model_classes = [
+            model for model_cls in model_classes or []
+            for model in self.related_models(model_cls=model_cls)]
+        model_classes += [
+            django_apps.get_model(label) for label in self.lookup_models]
+        signatures = sorted(
+            self.model_signature(model_cls=model_cls)
+            for model_cls in set(model_classes))
+        content = json.dumps([signatures, options], sort_keys=True, default=str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def app_fingerprint(self, app_labels=None, **options):
+        """Return the fingerprint of every model of the apps.
+        """
+        model_classes = [
+            model_cls for app_label in app_labels
+            for model_cls in django_apps.get_app_config(app_label).get_models()]
+        return self.fingerprint(model_classes=model_classes, **options)
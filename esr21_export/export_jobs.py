@@ -0,0 +1,108 @@
+import datetime
+
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from edc_base.utils import get_utcnow
+
+from .constants import FAILED, QUEUED, RUNNING
+from .export_profiles import export_profiles
+from .identifiers import ExportIdentifier
+from .models import ExportFile, ExportJobLock
+from .views.listboard_view_mixin import ListBoardViewMixin
+
+
+class ExportJobRunner(ListBoardViewMixin):
+    """Claim queued exports from the database and run them.
+
+    Claims are serialised on a lock row and a job is claimed with an
+    update conditional on it still being queued, so several workers, in
+    one or more processes, never run the same export twice nor more
+    than max_jobs exports at once. A running job is kept alive by its
+    progress updates and queued again once they stop for the timeout.
+    A job queued again waits retry_delay seconds, doubled with each
+    attempt, before it is claimed.
+    """
+
+    identifier_cls = ExportIdentifier
+    lock_name = 'export_jobs'
+
+    def __init__(self, to_email=None):
+        super().__init__(to_email=to_email)
+        app_config = django_apps.get_app_config('esr21_export')
+        self.max_jobs = app_config.max_export_jobs
+        self.retries = app_config.export_job_retries
+        self.timeout = app_config.export_job_timeout
+        self.retry_delay = app_config.export_job_retry_delay
+
+    def lock_jobs(self):
+        """Hold the lock of the job queue until the transaction ends.
+
+        An update takes a write lock on every backend, SQLite included,
+        where select_for_update is ignored.
+        """
+        locked = ExportJobLock.objects.filter(name=self.lock_name).update(
+            modified=get_utcnow())
+        if not locked:
+            ExportJobLock.objects.create(name=self.lock_name)
+
+    def requeue_stale_jobs(self):
+        """Queue again jobs left running by a worker that died, or fail
+        them once they are out of attempts.
+        """
+        stale_time = get_utcnow() - datetime.timedelta(seconds=self.timeout)
+        stale = ExportFile.objects.filter(status=RUNNING, modified__lt=stale_time)
+        stale.filter(attempts__gte=self.retries).update(
+            status=FAILED, error='Export stopped responding', modified=get_utcnow())
+        stale.update(status=QUEUED, modified=get_utcnow())
+
+    def retry_due(self, job=None, now=None):
+        """Return True if a job may be claimed, a job queued again once
+        its back-off since the last attempt has passed.
+        """
+        if not job.attempts:
+            return True
+        delay = self.retry_delay * 2 ** (job.attempts - 1)
+        return job.modified + datetime.timedelta(seconds=delay) <= now
+
+    def claim_job(self):
+        """Return the oldest queued job marked as running, or None if
+        there is none or the running jobs are at the limit.
+        """
+        with transaction.atomic():
+            self.lock_jobs()
+            self.requeue_stale_jobs()
+            if ExportFile.objects.filter(status=RUNNING).count() >= self.max_jobs:
+                return None
+            now = get_utcnow()
+            queued = ExportFile.objects.filter(
+                status=QUEUED,
+                description__in=export_profiles.names).order_by('created')
+            job = next(
+                (job for job in queued if self.retry_due(job=job, now=now)), None)
+            if not job:
+                return None
+            claimed = ExportFile.objects.filter(pk=job.pk, status=QUEUED).update(
+                status=RUNNING, attempts=F('attempts') + 1, modified=get_utcnow())
+            if not claimed:
+                return None
+            job.refresh_from_db()
+            return job
+
+    def run_job(self, job=None):
+        """Run the export of a claimed job, queueing it again on failure
+        until it runs out of attempts.
+        """
+        self.email = job.email or settings.EMAIL_HOST_USER
+        profile = export_profiles.get(name=job.description)
+        job.progress.all().delete()
+        try:
+            self.download_profile(profile=profile, doc=job)
+        except Exception as e:
+            job.refresh_from_db()
+            job.error = repr(e)
+            job.status = QUEUED if job.attempts < self.retries else FAILED
+            job.save()
+            return False
+        return True
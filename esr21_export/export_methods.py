@@ -1,15 +1,31 @@
 import datetime
+import os
 import re
+import shutil
+import zipfile
+from contextlib import contextmanager
+from types import SimpleNamespace
 
 from django.apps import apps as django_apps
-from django.core.exceptions import ValidationError
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import (
+    CharField, DateField, DateTimeField, F, Max, Q, Value)
+from django.db.models.constants import LOOKUP_SEP
 from django_crypto_fields.fields import (
     EncryptedCharField, EncryptedDecimalField, EncryptedIntegerField,
     EncryptedTextField, FirstnameField, IdentityField, LastnameField)
+from edc_base.utils import get_utcnow
 from pytz import timezone
+import pandas as pd
 
 from esr21_subject.models import SeriousAdverseEventRecord
 
+from .constants import COMPLETE, DATES_STAGE, ENCRYPT_STAGE, ROWS_STAGE
+from .export_fingerprint import ExportFingerprint
+from .export_partitions import has_site, site_queryset
+from .export_profiler import ExportProfiler
+from .export_throttle import ExportThrottle
+
 encrypted_fields = [
     EncryptedCharField, EncryptedDecimalField, EncryptedIntegerField,
     EncryptedTextField, FirstnameField, IdentityField, LastnameField]
@@ -19,132 +35,769 @@ class ExportMethods:
     """Export ESR21 data.
     """
 
-    def __init__(self):
+    field_plans = {}
+    date_plans = {}
+    column_plans = {}
+
+    visit_fields = {
+        'subject_identifier': 'subject_identifier',
+        'visit_datetime': 'report_datetime',
+        'last_alive_date': 'last_alive_date',
+        'reason': 'reason',
+        'survival_status': 'survival_status',
+        'visit_code': 'visit_code',
+        'visit_code_sequence': 'visit_code_sequence',
+        'study_status': 'study_status',
+        'appt_status': 'appointment__appt_status',
+        'appt_datetime': 'appointment__appt_datetime',
+    }
+
+    registered_subject_fields = [
+        'subject_identifier', 'screening_identifier', 'relative_identifier',
+        'screening_age_in_years', 'registration_status', 'dob', 'gender',
+        'subject_type', 'registration_datetime', 'screening_datetime']
+
+    consent_fields = [
+        'subject_identifier', 'dob', 'gender', 'screening_identifier']
+
+    def __init__(self, export_file=None, incremental=False):
+        self.export_file = export_file
+        self.incremental = incremental
+        self.profiler = ExportProfiler(export_file=export_file)
+        self.throttle = ExportThrottle(profiler=self.profiler)
+        self.fingerprints = ExportFingerprint()
+        self.reuse_files = django_apps.get_app_config(
+            'esr21_export').reuse_export_files
+        self.watermark_cls = django_apps.get_model('esr21_export.exportwatermark')
+        self.progress_cls = django_apps.get_model('esr21_export.exportprogress')
         self.rs_cls = django_apps.get_model('edc_registration.registeredsubject')
         self.subject_consent_csl = django_apps.get_model('esr21_subject.informedconsent')
-        self.onschedule_cls = django_apps.get_model('esr21_subject.onschedule')  
+        self.onschedule_cls = django_apps.get_model('esr21_subject.onschedule')
+        self.registered_subjects = {}
+        self.consents = {}
+        self.cohorts = {}
+        self.lookups_loaded = False
+        self.derived_field_plan = None
+
+    def encrypted_field_plan(self, obj_cls=None):
+        """Return a dict of column name to field cryptor for the
+        encrypted fields of a model, built once per model class.
+        """
+        try:
+            return self.field_plans[obj_cls]
+        except KeyError:
+            plan = {
+                f.name: f.field_cryptor for f in obj_cls._meta.get_fields()
+                if type(f) in encrypted_fields}
+            self.field_plans[obj_cls] = plan
+            return plan
+
+    def encrypt_column(self, obj_cls=None, column=None, values=None):
+        """Return a list of values for a column, encrypted if the column
+        is an encrypted field. Each distinct value is encrypted once.
+        """
+        cryptor = self.encrypted_field_plan(obj_cls=obj_cls).get(column)
+        if not cryptor:
+            return list(values)
+        encrypted = {}
+        result = []
+        for value in values:
+            try:
+                result.append(encrypted[value])
+            except KeyError:
+                encrypted[value] = cryptor.encrypt(value)
+                result.append(encrypted[value])
+        return result
+
+    def encrypt_chunk(self, rows=None, obj_cls=None):
+        """Encrypt the values of the encrypted fields in a chunk of rows
+        read from a model, a column at a time.
+        """
+        if not rows:
+            return rows
+        with self.profiler.stage(ENCRYPT_STAGE, rows=len(rows)):
+            for column in self.encrypted_field_plan(obj_cls=obj_cls):
+                if column not in rows[0]:
+                    continue
+                values = self.encrypt_column(
+                    obj_cls=obj_cls, column=column,
+                    values=[row[column] for row in rows])
+                for row, value in zip(rows, values):
+                    row[column] = value
+        return rows
+
+    def prepare_chunk(self, rows=None, obj_cls=None, encrypt=False,
+                      row_dict=None):
+        """Return a chunk of rows read from a model, encrypted if
+        encrypt and built into export rows by row_dict if given, each
+        step recorded as a stage once for the chunk.
+        """
+        if encrypt:
+            rows = self.encrypt_chunk(rows=rows, obj_cls=obj_cls)
+        if row_dict and rows:
+            with self.profiler.stage(ROWS_STAGE, rows=len(rows)):
+                rows = [row_dict(row) for row in rows]
+        return rows
+
+    def prepared_rows(self, rows=None, obj_cls=None, encrypt=False,
+                      row_dict=None, chunk_size=None):
+        """Yield rows read from a model, prepared a chunk at a time.
+        """
+        chunk_size = chunk_size or django_apps.get_app_config(
+            'esr21_export').chunk_size
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield from self.prepare_chunk(
+                    rows=chunk, obj_cls=obj_cls, encrypt=encrypt,
+                    row_dict=row_dict)
+                chunk = []
+        yield from self.prepare_chunk(
+            rows=chunk, obj_cls=obj_cls, encrypt=encrypt, row_dict=row_dict)
+
+    def last_watermark(self, model_cls=None):
+        """Return the high-water mark of the model from the last completed
+        export with the same description and site, or None.
+        """
+        watermarks = self.watermark_cls.objects.filter(
+            model=model_cls._meta.label_lower,
+            export_file__description=self.export_file.description,
+            export_file__export_site=self.export_file.export_site,
+            export_file__status=COMPLETE)
+        return watermarks.aggregate(
+            Max('high_water_mark')).get('high_water_mark__max')
+
+    def record_watermark(self, model_cls=None, high_water_mark=None):
+        """Record the high-water mark of a model for the export file,
+        keeping the newest one where the model is read more than once.
+        """
+        watermarks = self.watermark_cls.objects.filter(
+            export_file=self.export_file, model=model_cls._meta.label_lower)
+        if watermarks.filter(high_water_mark__gte=high_water_mark).exists():
+            return
+        self.watermark_cls.objects.update_or_create(
+            export_file=self.export_file, model=model_cls._meta.label_lower,
+            defaults={'high_water_mark': high_water_mark})
+
+    def export_window(self, queryset=None, inline_cls=None, filed_n=None):
+        """Record the model's high-water mark for the export file and, for
+        an incremental export, limit the queryset to rows created or
+        modified since the last export, or with inlines that were.
+
+        The high-water mark is the newest modified value of the rows in
+        the window, read from the database the export reads from, so a
+        row changed after the export was queued, or not yet on a lagging
+        replica, is still in the next window.
+        """
+        if not self.export_file:
+            return queryset
+        model_cls = queryset.model
+        since = self.last_watermark(model_cls=model_cls)
+        if self.incremental and since:
+            changed = Q(modified__gt=since)
+            if inline_cls:
+                changed |= Q(id__in=inline_cls.objects.filter(
+                    modified__gt=since).values(filed_n))
+            queryset = queryset.filter(changed)
+        high_water_mark = site_queryset(
+            queryset=queryset, site_id=self.export_file.export_site).aggregate(
+                Max('modified')).get('modified__max')
+        if high_water_mark:
+            self.record_watermark(
+                model_cls=model_cls, high_water_mark=high_water_mark)
+        return queryset
+
+    def export_progress(self, name=None, rows_total=None, path=None,
+                        fingerprint=None):
+        """Return a progress record for a file of the export file, or
+        None outside an export.
+        """
+        if not self.export_file:
+            return None
+        return self.progress_cls.objects.create(
+            export_file=self.export_file, name=name, rows_total=rows_total,
+            path=self.archive_name(path=path), fingerprint=fingerprint or '')
+
+    def archive_name(self, path=None):
+        """Return the name of an export file in the zip archive.
+        """
+        if not path:
+            return ''
+        return os.path.join(
+            os.path.basename(os.path.dirname(path)), os.path.basename(path))
+
+    def file_fingerprint(self, model_classes=None, **options):
+        """Return the fingerprint of an export file, or None where
+        files are not reused, e.g. in an incremental export.
+        """
+        if not self.export_file or self.incremental or not self.reuse_files:
+            return None
+        return self.fingerprints.fingerprint(
+            model_classes=model_classes, **options)
+
+    def reuse_file(self, name=None, fingerprint=None, export_path=None):
+        """Extract the file with the same fingerprint from the archive of
+        the last completed export into the export path, returning its
+        path, or None if there is no such file.
+        """
+        if not fingerprint:
+            return None
+        previous = self.progress_cls.objects.filter(
+            export_file__description=self.export_file.description,
+            export_file__status=COMPLETE, name=name, fingerprint=fingerprint,
+            finished__isnull=False).exclude(path='').order_by('-created').first()
+        if not previous:
+            return None
+        final_path = export_path + os.path.basename(previous.path)
+        try:
+            with zipfile.ZipFile(previous.export_file.document.path) as zip_file:
+                with zip_file.open(previous.path) as src, open(final_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+        except (KeyError, OSError, ValueError, zipfile.BadZipFile):
+            return None
+        self.progress_cls.objects.create(
+            export_file=self.export_file, name=name,
+            rows_done=previous.rows_done, rows_total=previous.rows_total,
+            finished=get_utcnow(), path=previous.path,
+            fingerprint=fingerprint, reused=True)
+        return final_path
+
+    def deleted_rows(self, model_cls=None, site_id=None, parent_cls=None,
+                     parent_field=None):
+        """Return the model, id and deletion date of objs deleted since
+        the last export of an incremental export, from the historical
+        model, or None.
+
+        The objs are limited to those of a site if given, an inline
+        without a site of its own through the parent_field of its
+        parent_cls.
+        """
+        history = getattr(model_cls, 'history', None)
+        if not self.export_file or not self.incremental or not history:
+            return None
+        since = self.last_watermark(model_cls=parent_cls or model_cls)
+        if not since:
+            return None
+        deleted = history.filter(history_type='-', history_date__gt=since)
+        if parent_cls and site_id is not None and not has_site(model_cls=model_cls):
+            parents = getattr(parent_cls, 'history', parent_cls.objects)
+            deleted = deleted.filter(**{f'{parent_field}__in': site_queryset(
+                queryset=parents.all(), site_id=site_id).values('id')})
+        else:
+            deleted = site_queryset(queryset=deleted, site_id=site_id)
+        return deleted.values(
+            'id', 'history_date', model=Value(
+                model_cls._meta.label_lower, output_field=CharField()))
+
+    def replaced_m2m_rows(self, queryset=None, mm_field=None):
+        """Return a tombstone per obj of an incremental export whose many
+        to many values are exported again, removing all of its earlier
+        values, or None.
+
+        Through tables have no history, so a removed value can only be
+        dropped by replacing all the values of its obj.
+        """
+        if not self.export_file or not self.incremental:
+            return None
+        if not self.last_watermark(model_cls=queryset.model):
+            return None
+        through = queryset.model._meta.get_field(mm_field).remote_field.through
+        return queryset.values(
+            'id', history_date=F('modified'), model=Value(
+                through._meta.label_lower, output_field=CharField()))
+
+    def iterate(self, queryset=None, chunk_size=None):
+        """Iterate over a queryset a chunk at a time, through a server
+        side cursor where the database supports one, profiling the
+        fetches as the query stage and pacing them with the throttle.
+        """
+        return self.throttle.iterate(
+            self.profiler.iterate(
+                queryset.iterator(chunk_size=chunk_size), chunk_size=chunk_size),
+            chunk_size=chunk_size)
+
+    def has_field(self, model_cls=None, name=None):
+        try:
+            model_cls._meta.get_field(name)
+        except FieldDoesNotExist:
+            return False
+        return True
+
+    def export_exclude(self, exclude=None):
+        """Return the fields left out of the export, less the id in an
+        incremental export, which keys its updated and deleted rows.
+        """
+        exclude = exclude or []
+        if self.incremental:
+            return [name for name in exclude if name != 'id']
+        return exclude
+
+    def inline_id_column(self, inline_cls=None):
+        """Return the column the id of an inline is exported as in the
+        rows it is merged into, beside the id of its crf.
+        """
+        return f'{inline_cls._meta.model_name}_id'
+
+    def export_columns(self, model_cls=None, exclude=None, include=None,
+                       only=None):
+        """Return the columns of a model read for export, its concrete
+        fields less the excluded ones, or only those listed in only,
+        followed by any include lookups. Built once per model, so
+        excluded fields never leave the database.
+        """
+        exclude = self.export_exclude(exclude=exclude)
+        key = (model_cls, tuple(exclude), tuple(include or []),
+               tuple(only or []))
+        try:
+            return self.column_plans[key]
+        except KeyError:
+            columns = [
+                field.attname for field in model_cls._meta.concrete_fields
+                if field.attname not in exclude and field.name not in exclude
+                and (not only or field.attname in only or field.name in only)]
+            columns += [c for c in include or [] if c not in columns]
+            self.column_plans[key] = columns
+            return columns
+
+    def iterate_values(self, queryset=None, columns=None, chunk_size=None,
+                       encrypt=False, row_dict=None):
+        """Yield a dict of the columns per row of the queryset, without
+        building model instances, with the values of encrypted fields
+        encrypted if encrypt and built into export rows by row_dict if
+        given, a chunk at a time.
+        """
+        rows = self.iterate(queryset.values(*columns), chunk_size=chunk_size)
+        if not encrypt and not row_dict:
+            return rows
+        return self.prepared_rows(
+            rows=rows, obj_cls=queryset.model, encrypt=encrypt,
+            row_dict=row_dict, chunk_size=chunk_size)
+
+    def visit_lookup(self, crf_cls=None):
+        """Return the lookup from a crf to its subject visit.
+        """
+        if crf_cls == SeriousAdverseEventRecord:
+            return 'serious_adverse_event__subject_visit'
+        return 'subject_visit'
+
+    def visit_columns(self, crf_cls=None):
+        """Return a dict of export column to the lookup reading it from
+        the subject visit and appointment of a crf.
+        """
+        visit_lookup = self.visit_lookup(crf_cls=crf_cls)
+        return {
+            column: f'{visit_lookup}__{lookup}'
+            for column, lookup in self.visit_fields.items()}
+
+    def crf_columns(self, crf_cls=None, exclude=None, include=None,
+                    only=None):
+        """Return the columns of a crf read for export, with the subject
+        visit and appointment columns joined in.
+        """
+        return self.export_columns(
+            model_cls=crf_cls, exclude=exclude, only=only,
+            include=(include or []) + list(
+                self.visit_columns(crf_cls=crf_cls).values()))
+
+    def crf_queryset(self, crf_cls=None):
+        """Return the crf objects to export.
+        """
+        return crf_cls.objects.all()
+
+    @contextmanager
+    def lookups(self):
+        """Serve registered subject, consent and cohort lookups from
+        memory for the duration of one export run.
+        """
+        self.load_lookups()
+        try:
+            yield self
+        finally:
+            self.clear_lookups()
 
-    def encrypt_values(self, obj_dict=None, obj_cls=None):
-        """Ecrypt values for fields that are encypted.
+    def load_lookups(self):
+        """Bulk load registered subjects, the latest consent and the
+        cohort of every subject, keyed by subject identifier. Only the
+        exported columns are read, so no encrypted field is decrypted.
         """
-        result_dict_obj = {**obj_dict}
-        for key, value in obj_dict.items():
-            for f in obj_cls._meta.get_fields():
-                if key == f.name and type(f) in encrypted_fields:
-                    new_value = f.field_cryptor.encrypt(value)
-                    result_dict_obj[key] = new_value
-        return result_dict_obj
+        self.clear_lookups()
+        registered_subjects = self.rs_cls.objects.values(
+            *self.registered_subject_fields)
+        for rs in registered_subjects:
+            self.registered_subjects[rs['subject_identifier']] = SimpleNamespace(**rs)
+
+        ordering = self.subject_consent_csl._meta.ordering or ['pk']
+        consents = self.subject_consent_csl.objects.order_by(
+            *ordering).values(*self.consent_fields)
+        for consent in consents:
+            self.consents[consent['subject_identifier']] = SimpleNamespace(**consent)
+
+        onschedules = self.onschedule_cls.objects.values_list(
+            'subject_identifier', 'schedule_name')
+        for subject_identifier, schedule_name in onschedules:
+            self.cohorts.setdefault(
+                subject_identifier, self.cohort_dict(schedule_name))
+        self.lookups_loaded = True
+
+    def clear_lookups(self):
+        """Drop all cached lookups, e.g. at the end of an export run.
+        """
+        self.registered_subjects = {}
+        self.consents = {}
+        self.cohorts = {}
+        self.lookups_loaded = False
+
+    def prefetch_subject_data(self, queryset=None, subject_lookup='subject_identifier'):
+        """Bulk load registered subjects and cohorts for all subjects
+        in the queryset.
+        """
+        if self.lookups_loaded:
+            return
+        subject_identifiers = queryset.order_by().values(subject_lookup)
+        for subject_identifier in subject_identifiers.values_list(
+                subject_lookup, flat=True).distinct():
+            self.cohorts.setdefault(subject_identifier, {})
+
+        registered_subjects = self.rs_cls.objects.filter(
+            subject_identifier__in=subject_identifiers).values(
+                *self.registered_subject_fields)
+        for rs in registered_subjects:
+            self.registered_subjects[rs['subject_identifier']] = SimpleNamespace(**rs)
+
+        onschedules = self.onschedule_cls.objects.filter(
+            subject_identifier__in=subject_identifiers).values_list(
+                'subject_identifier', 'schedule_name')
+        cohorts = {}
+        for subject_identifier, schedule_name in onschedules:
+            cohorts.setdefault(
+                subject_identifier, self.cohort_dict(schedule_name))
+        self.cohorts.update(cohorts)
+
+    def get_registered_subject(self, subject_identifier=None):
+        """Return the exported fields of the registered subject, from
+        the prefetched data where available, otherwise read once and
+        cached, a subject registered during the export included.
+        """
+        try:
+            rs = self.registered_subjects[subject_identifier]
+        except KeyError:
+            rs = self.rs_cls.objects.filter(
+                subject_identifier=subject_identifier).values(
+                    *self.registered_subject_fields).first()
+            if rs:
+                rs = SimpleNamespace(**rs)
+            self.registered_subjects[subject_identifier] = rs
+        if not rs:
+            raise self.rs_cls.DoesNotExist(
+                f'RegisteredSubject {subject_identifier} does not exist.')
+        return rs
+
+    def get_consent(self, subject_identifier=None):
+        """Return the exported fields of the latest consent for the
+        subject or None, read once if not prefetched.
+        """
+        try:
+            return self.consents[subject_identifier]
+        except KeyError:
+            consent = self.subject_consent_csl.objects.filter(
+                subject_identifier=subject_identifier).values(
+                    *self.consent_fields).last()
+            if consent:
+                consent = SimpleNamespace(**consent)
+            self.consents[subject_identifier] = consent
+            return consent
+
+    def cohort_dict(self, schedule_name=None):
+        if 'sub' in schedule_name:
+            return {'cohort': 'sub cohort'}
+        return {'cohort': 'main cohort'}
 
     def get_participant_cohort(self, subject_identifier):
 
-        onschedule_objs = self.onschedule_cls.objects.filter(
-            subject_identifier=subject_identifier)
+        try:
+            return self.cohorts[subject_identifier]
+        except KeyError:
+            pass
 
-        if onschedule_objs:
-            onschedule_obj = onschedule_objs[0]
-            if 'sub' in onschedule_obj.schedule_name:
-                return {'cohort': 'sub cohort'}
-            else:
-                return {'cohort': 'main cohort'}
-        return {}
+        schedule_name = self.onschedule_cls.objects.filter(
+            subject_identifier=subject_identifier).values_list(
+                'schedule_name', flat=True).first()
+
+        cohort = {}
+        if schedule_name:
+            cohort = self.cohort_dict(schedule_name)
+        self.cohorts[subject_identifier] = cohort
+        return cohort
 
-    def fix_date_format(self, obj_dict=None):
-        """Change all dates into a format for the export
-        and split the time into a separate value.
+    def date_keys(self, key=None):
+        """Return the date and time keys a datetime value is split into.
+        """
+        if 'datetime' in key:
+            time_variable = re.sub('datetime', 'time', key)
+        elif 'vaccination_date' == key:
+            time_variable = re.sub('date', 'time', key)
+        else:
+            time_variable = key + '_time'
+        return re.sub('time', '', key), time_variable
 
-        Format: m/d/y
+    def derived_fields(self):
+        """Return the fields of the columns rows are given from the
+        subject visit, appointment, registered subject and consent, by
+        column name.
         """
+        if self.derived_field_plan is None:
+            visit_cls = django_apps.get_model('esr21_subject.subjectvisit')
+            fields = {}
+            for column, lookup in self.visit_fields.items():
+                model_cls = visit_cls
+                *path, name = lookup.split(LOOKUP_SEP)
+                for step in path:
+                    model_cls = model_cls._meta.get_field(step).related_model
+                fields[column] = model_cls._meta.get_field(name)
+            for name in self.registered_subject_fields:
+                fields.setdefault(name, self.rs_cls._meta.get_field(name))
+            for name in self.consent_fields:
+                fields.setdefault(
+                    name, self.subject_consent_csl._meta.get_field(name))
+            self.derived_field_plan = fields
+        return self.derived_field_plan
 
-        result_dict_obj = {**obj_dict}
-        for key, value in obj_dict.items():
-            if isinstance(value, datetime.datetime):
-                value = value.astimezone(timezone('Africa/Gaborone'))
-                time_value = value.time().strftime('%H:%M:%S.%f')
-                time_variable = None
-                if 'datetime' in key:
-                    time_variable = re.sub('datetime', 'time', key)
-                elif 'vaccination_date' == key:
-                    time_variable = re.sub('date', 'time', key)
+    def derived_columns(self, model_classes=None, format_dates=True):
+        """Return a dict of column to the columns export_chunk may add
+        to a row that has it: the cohort of a subject and, with dates
+        formatted, the date and time of a datetime.
+        """
+        columns = {'subject_identifier': ['cohort']}
+        if format_dates:
+            fields = list(self.derived_fields().items())
+            for model_cls in model_classes or []:
+                fields += [(f.attname, f) for f in model_cls._meta.concrete_fields]
+            for name, field in fields:
+                if isinstance(field, DateTimeField):
+                    columns[name] = list(self.date_keys(name))
+        return columns
+
+    def export_fieldnames(self, model_cls=None, format_dates=True):
+        """Return the columns a model's fields are exported as.
+        """
+        fieldnames = []
+        for field in model_cls._meta.concrete_fields:
+            fieldnames.append(field.attname)
+            if format_dates and isinstance(field, DateTimeField):
+                fieldnames.extend(self.date_keys(field.attname))
+        return list(dict.fromkeys(fieldnames))
+
+    def date_column_plan(self, model_cls=None, rows=None):
+        """Return a dict of column name to (kind, date key, time key)
+        for the date and datetime columns in rows, kept per model.
+
+        Kinds come from the types of the model and derived fields,
+        other columns are detected from their first value in rows.
+        """
+        plan = self.date_plans.setdefault(model_cls, {})
+        if not plan:
+            fields = list(self.derived_fields().items())
+            if model_cls:
+                fields += [(f.attname, f) for f in model_cls._meta.concrete_fields]
+            for name, field in fields:
+                if isinstance(field, DateTimeField):
+                    plan[name] = ('datetime', *self.date_keys(name))
+                elif isinstance(field, DateField):
+                    plan[name] = ('date', None, None)
                 else:
-                    time_variable = key + '_time'
-                value = value.strftime('%m/%d/%Y')
-                new_key = re.sub('time', '', key)
-                result_dict_obj[new_key] = value
-                if not 'vaccination_date':
-                    del result_dict_obj[key]
-                result_dict_obj[time_variable] = time_value
+                    plan[name] = None
+        columns = {}
+        for row in rows:
+            columns.update(dict.fromkeys(row))
+        for column in columns:
+            if column in plan:
+                continue
+            value = next(
+                (row[column] for row in rows if row.get(column) is not None), None)
+            if isinstance(value, datetime.datetime):
+                plan[column] = ('datetime', *self.date_keys(column))
             elif isinstance(value, datetime.date):
-                value = value.strftime('%m/%d/%Y')
-                result_dict_obj[key] = value
-        return result_dict_obj
+                plan[column] = ('date', None, None)
+            elif value is not None:
+                plan[column] = None
+        return {column: plan[column] for column in columns if plan.get(column)}
 
-    def subject_crf_data_dict(self, crf_obj=None):
-        """Return a crf obj dict adding extra required fields.
+    def format_dates(self, values=None, date_format=None, tz=None):
+        """Return a list of formatted values for a column of dates or
+        datetimes, None where there is no value.
+
+        A column with values outside the nanosecond range of pandas, e.g.
+        dates before 1677, is formatted one value at a time, as newer
+        pandas versions convert them with other timezone offsets rather
+        than raising.
         """
+        def format_each():
+            return [
+                None if v is None else (v.astimezone(tz) if tz else v).strftime(date_format)
+                for v in values]
 
-        data = crf_obj.__dict__
-        data = self.encrypt_values(obj_dict=data, obj_cls=crf_obj.__class__)
-        if crf_obj.__class__ == SeriousAdverseEventRecord:
-            data.update(
-                subject_identifier=crf_obj.serious_adverse_event.subject_visit.subject_identifier,
-                visit_datetime=crf_obj.serious_adverse_event.subject_visit.report_datetime,
-                last_alive_date=crf_obj.serious_adverse_event.subject_visit.last_alive_date,
-                reason=crf_obj.serious_adverse_event.subject_visit.reason,
-                survival_status=crf_obj.serious_adverse_event.subject_visit.survival_status,
-                visit_code=crf_obj.serious_adverse_event.subject_visit.visit_code,
-                visit_code_sequence=crf_obj.serious_adverse_event.subject_visit.visit_code_sequence,
-                study_status=crf_obj.serious_adverse_event.subject_visit.study_status,
-                appt_status=crf_obj.serious_adverse_event.subject_visit.appointment.appt_status,
-                appt_datetime=crf_obj.serious_adverse_event.subject_visit.appointment.appt_datetime,
-            )
-            try:
-                rs = self.rs_cls.objects.get(subject_identifier=crf_obj.serious_adverse_event.subject_visit.subject_identifier)
-            except self.rs_cls.DoesNotExist:
-                raise ValidationError('RegisteredSubject can not be missing')
+        if any(v is not None and not (
+                pd.Timestamp.min.year < v.year < pd.Timestamp.max.year)
+                for v in values):
+            return format_each()
+        series = pd.Series(values, dtype=object)
+        try:
+            converted = pd.to_datetime(series, utc=bool(tz))
+        except (pd.errors.OutOfBoundsDatetime, TypeError, ValueError):
+            return format_each()
+        if tz:
+            converted = converted.dt.tz_convert(tz)
+        # Missing values are set after formatting, as where() on a string
+        # column gives NaN rather than None.
+        return [
+            value if present else None for value, present in zip(
+                converted.dt.strftime(date_format).tolist(),
+                converted.notna().tolist())]
+
+    def fix_date_format_chunk(self, rows=None, model_cls=None):
+        """Change all dates in a chunk of rows into the export format,
+        splitting the time into a separate value, a column at a time.
+
+        Gives the same values the earlier per row formatting did, see
+        tests/test_date_format.py.
+        """
+        tz = timezone('Africa/Gaborone')
+        plan = self.date_column_plan(model_cls=model_cls, rows=rows)
+        formatted = {}
+        for column, (kind, date_key, time_key) in plan.items():
+            values = [row.get(column) for row in rows]
+            if kind == 'datetime':
+                formatted[column] = (
+                    self.format_dates(values, '%m/%d/%Y', tz),
+                    self.format_dates(values, '%H:%M:%S.%f', tz))
             else:
-                data.update(
-                    screening_age_in_years=rs.screening_age_in_years,
-                    registration_status=rs.registration_status,
-                    dob=rs.dob,
-                    gender=rs.gender,
-                    subject_type=rs.subject_type,
-                    registration_datetime=rs.registration_datetime,
-                )
+                formatted[column] = (
+                    self.format_dates(values, '%m/%d/%Y'), None)
+        for index, row in enumerate(rows):
+            for column, (kind, date_key, time_key) in plan.items():
+                dates, times = formatted[column]
+                if dates[index] is None:
+                    continue
+                if kind == 'datetime':
+                    row[date_key] = dates[index]
+                    row[time_key] = times[index]
+                else:
+                    row[column] = dates[index]
+        return rows
+
+    def export_chunk(self, rows=None, model_cls=None, format_dates=True):
+        """Prepare a chunk of rows for writing, formatting dates and
+        adding the participant cohort.
+
+        Excluded fields are never read, see export_columns, and the
+        writers leave out any excluded column added while building rows.
+        """
+        if format_dates:
+            with self.profiler.stage(DATES_STAGE, rows=len(rows)):
+                rows = self.fix_date_format_chunk(rows=rows, model_cls=model_cls)
+        for data in rows:
+            if 'subject_identifier' in data:
+                data.update(self.get_participant_cohort(data.get('subject_identifier')))
+        return rows
+
+    def m2m_lookup(self, queryset=None, mm_field=None, chunk_size=None):
+        """Return the many to many short names of every obj in the
+        queryset, read with one query on the through table and keyed
+        by obj id.
+        """
+        field = queryset.model._meta.get_field(mm_field)
+        source = field.m2m_field_name()
+        target = field.m2m_reverse_field_name()
+        ordering = [
+            f'-{target}__{o[1:]}' if o.startswith('-') else f'{target}__{o}'
+            for o in field.related_model._meta.ordering]
+        values = field.remote_field.through.objects.filter(
+            **{f'{source}__in': queryset.values('id')}).order_by(
+                *ordering).values_list(source, f'{target}__short_name')
+        m2m = {}
+        for obj_id, short_name in self.iterate(values, chunk_size=chunk_size):
+            m2m.setdefault(obj_id, []).append(short_name)
+        return m2m
+
+    def m2m_columns(self, model_cls=None, mm_field=None):
+        """Return a dict of choice short name to wide layout column name.
+        """
+        list_cls = model_cls._meta.get_field(mm_field).related_model
+        return {
+            short_name: f'{mm_field}_{short_name}'
+            for short_name in list_cls.objects.values_list('short_name', flat=True)}
+
+    def flatten_m2m(self, queryset=None, mm_field=None, obj_data=None,
+                    layout='long', chunk_size=None, columns=None):
+        """Yield export rows for objs with their many to many values.
+
+        Objs are read as dicts of columns, which must include the id.
+        The long layout gives a row per value, or a single row if there
+        are none. The wide layout gives a row per obj with a boolean
+        column per choice.
+        """
+        m2m = self.m2m_lookup(
+            queryset=queryset, mm_field=mm_field, chunk_size=chunk_size)
+        choices = None
+        if layout == 'wide':
+            choices = self.m2m_columns(
+                model_cls=queryset.model, mm_field=mm_field)
+        for data in self.iterate_values(
+                queryset=queryset, columns=columns, chunk_size=chunk_size,
+                encrypt=True, row_dict=obj_data):
+            yield from self.m2m_rows(
+                data=data, values=m2m.pop(data['id'], []),
+                mm_field=mm_field, choices=choices)
+
+    def m2m_rows(self, data=None, values=None, mm_field=None, choices=None):
+        """Yield the rows of an obj with its many to many values, a row
+        per value or, given the wide layout choices, a single row with a
+        boolean column per choice.
+        """
+        if choices is not None:
+            values = set(values)
+            yield {**data, **{
+                column: short_name in values
+                for short_name, column in choices.items()}}
+        elif values:
+            for value in values:
+                yield {**data, mm_field: value}
+        else:
+            yield data
+
+    def subject_crf_data_dict(self, crf_obj=None, crf_cls=None):
+        """Return a crf row dict adding extra required fields, from a
+        row read and encrypted with the crf columns of the crf.
+        """
+
+        data = {**crf_obj}
+        for column, lookup in self.visit_columns(crf_cls=crf_cls).items():
+            data[column] = data.pop(lookup)
+        try:
+            rs = self.get_registered_subject(
+                subject_identifier=data['subject_identifier'])
+        except self.rs_cls.DoesNotExist:
+            raise ValidationError('RegisteredSubject can not be missing')
         else:
             data.update(
-                subject_identifier=crf_obj.subject_visit.subject_identifier,
-                visit_datetime=crf_obj.subject_visit.report_datetime,
-                last_alive_date=crf_obj.subject_visit.last_alive_date,
-                reason=crf_obj.subject_visit.reason,
-                survival_status=crf_obj.subject_visit.survival_status,
-                visit_code=crf_obj.subject_visit.visit_code,
-                visit_code_sequence=crf_obj.subject_visit.visit_code_sequence,
-                study_status=crf_obj.subject_visit.study_status,
-                appt_status=crf_obj.subject_visit.appointment.appt_status,
-                appt_datetime=crf_obj.subject_visit.appointment.appt_datetime,
+                screening_age_in_years=rs.screening_age_in_years,
+                registration_status=rs.registration_status,
+                dob=rs.dob,
+                gender=rs.gender,
+                subject_type=rs.subject_type,
+                registration_datetime=rs.registration_datetime,
             )
-            try:
-                rs = self.rs_cls.objects.get(subject_identifier=crf_obj.subject_visit.subject_identifier)
-            except self.rs_cls.DoesNotExist:
-                raise ValidationError('RegisteredSubject can not be missing')
-            else:
-                data.update(
-                    screening_age_in_years=rs.screening_age_in_years,
-                    registration_status=rs.registration_status,
-                    dob=rs.dob,
-                    gender=rs.gender,
-                    subject_type=rs.subject_type,
-                    registration_datetime=rs.registration_datetime,
-                )
         return data
 
-    def non_crf_obj_dict(self, obj=None):
-        """Return a dictionary of non crf object.
+    def non_crf_obj_dict(self, obj=None, obj_cls=None):
+        """Return a dictionary of non crf object, from a row read and
+        encrypted with the export columns of the model.
         """
 
-        data = obj.__dict__
-        data = self.encrypt_values(obj_dict=data, obj_cls=obj.__class__)
-        subject_consent = self.subject_consent_csl.objects.filter(subject_identifier=obj.subject_identifier).last()
+        data = {**obj}
+        subject_identifier = obj.get('subject_identifier')
+        subject_consent = self.get_consent(subject_identifier=subject_identifier)
         if subject_consent:
             if 'dob' not in data:
                 data.update(dob=subject_consent.dob)
@@ -160,9 +813,10 @@ class ExportMethods:
                 dob=None,
                 gender=None,
             )
-        if 'registration_datetime' not in data:
+        if 'registration_datetime' not in data and not self.has_field(
+                model_cls=obj_cls, name='registration_datetime'):
             try:
-                rs = self.rs_cls.objects.get(subject_identifier=obj.subject_identifier)
+                rs = self.get_registered_subject(subject_identifier=subject_identifier)
             except self.rs_cls.DoesNotExist:
                 data.update(
                     registration_datetime=None,
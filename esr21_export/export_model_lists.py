@@ -68,3 +68,43 @@ offstudy_prn_model_list = ['subjectoffstudy', ]
 
 
 death_report_prn_model_list = ['deathreport', ]
+
+export_app_labels = [
+    'esr21_subject', 'esr21_prn', 'edc_registration', 'edc_appointment']
+
+vida_subject_crfs_list = [
+    'covid19symptomaticinfections',
+    'concomitantmedication',
+    'demographicsdata',
+    'medicalhistory',
+    'pregnancystatus',
+    'pregnancytest',
+    'rapidhivtesting',
+    'vaccinationdetails',
+    'covid19results',
+    'pregoutcome'
+]
+
+vida_subject_inlines_dict = {
+    'adverseevent': [['adverseeventrecord'], 'adverse_event_id'],
+    'seriousadverseevent': [
+        ['seriousadverseeventrecord'], 'serious_adverse_event_id'],
+    'specialinterestadverseevent': [
+        ['specialinterestadverseeventrecord'], 'special_interest_adverse_event_id'],
+    'concomitantmedication': [['medication'], 'concomitant_medication_id'],
+    'pregoutcome': [['outcomeinline'], 'preg_outcome_id']
+}
+
+vida_subject_many_to_many_crf = [
+    ['medicalhistory', 'covid_symptoms', 'symptoms'],
+    ['medicalhistory', 'comorbidities', 'diseases'],
+    ['pregnancystatus', 'contraceptive', 'contraception'],
+    ['seriousadverseeventrecord', 'sae_criteria', 'saecriteria'],
+    ['covid19symptomaticinfections', 'symptomatic_infections',
+     'symptomaticinfections'],
+]
+
+vida_subject_model_list = [
+    'eligibilityconfirmation', 'screeningeligibility',
+    'informedconsent', 'vaccinationhistory',
+]
@@ -1,10 +1,13 @@
 from django.apps import apps as django_apps
 from django.core.exceptions import ValidationError
 from django.db.models import Q
-import pandas as pd, datetime, os
+import datetime, itertools, os
+from functools import partial
 
 from .export_methods import ExportMethods
 from .export_model_lists import exclude_fields, exclude_m2m_fields
+from .export_partitions import partition_queryset, site_queryset
+from .export_writer import export_writers
 
 
 class ExportNonCrfData:
@@ -26,14 +29,26 @@ class ExportNonCrfData:
     def consent_model_cls(self):
         return django_apps.get_model(self.informed_consent_model)
 
-    def __init__(self, export_path=None):
-        self.export_path = export_path or django_apps.get_app_config('esr21_export').non_crf_path
+    @property
+    def profiler(self):
+        return self.export_methods_cls.profiler
+
+    def __init__(self, export_path=None, export_methods_cls=None, columns=None,
+                 partition=None, site_id=None):
+        app_config = django_apps.get_app_config('esr21_export')
+        self.export_path = export_path or app_config.non_crf_path
         if not os.path.exists(self.export_path):
             os.makedirs(self.export_path)
-        self.export_methods_cls = ExportMethods()
+        self.export_methods_cls = export_methods_cls or ExportMethods()
+        self.chunk_size = app_config.chunk_size
+        self.output_format = app_config.output_format
+        self.written_files = []
+        self.columns = columns or {}
+        self.partition = partition
+        self.site_id = site_id
         self.rs_cls = django_apps.get_model('edc_registration.registeredsubject')
         self.appointment_cls = django_apps.get_model('edc_appointment.appointment')
-        self.site_ids = [40, 41, 42, 43, 44]
+        self.site_ids = app_config.site_ids
 
     @property
     def eligible_no_icf_statistics(self):
@@ -53,9 +68,109 @@ class ExportNonCrfData:
             no_consent_screenigs += missing_site_consents
         return no_consent_screenigs
 
-    def subject_non_crfs(self, subject_model_list=None, exclude=None):
+    def partitioned(self, queryset=None):
+        """Limit a queryset to the site and the range of the partition
+        exported.
+        """
+        queryset = site_queryset(queryset=queryset, site_id=self.site_id)
+        return partition_queryset(queryset=queryset, partition=self.partition)
+
+    def column_subset(self, model_cls=None):
+        """Return the columns of a model the export is limited to, or
+        None to export all of them.
+        """
+        return self.columns.get(model_cls._meta.model_name)
+
+    def write_file(self, fname=None, rows=None, model_cls=None, exclude=None,
+                   extra_fieldnames=None, output_format=None, rows_total=None,
+                   replaced=None):
+        """Stream rows into a csv or parquet file in the export path,
+        preparing them a chunk at a time and reporting progress.
+        """
+        writer_cls = export_writers[output_format or self.output_format]
+        exclude = self.export_methods_cls.export_exclude(
+            exclude=exclude or exclude_fields)
+        name = fname.rsplit('_', 1)[0]
+        fingerprint = self.export_methods_cls.file_fingerprint(
+            model_classes=[model_cls], name=name,
+            output_format=output_format or self.output_format,
+            extra_fieldnames=extra_fieldnames, exclude=exclude,
+            columns=self.column_subset(model_cls=model_cls),
+            site_id=self.site_id)
+        if self.partition:
+            # A part file is concatenated into the model's file, which is
+            # never reused from a previous export.
+            fingerprint = None
+        reused_path = self.export_methods_cls.reuse_file(
+            name=name, fingerprint=fingerprint, export_path=self.export_path)
+        if reused_path:
+            self.written_files.append(reused_path)
+            return None
+        fieldnames = []
+        if not self.column_subset(model_cls=model_cls):
+            fieldnames = self.export_methods_cls.export_fieldnames(
+                model_cls=model_cls, format_dates=writer_cls.format_dates)
+        final_path = self.export_path + fname + writer_cls.extension
+        writer = writer_cls(
+            final_path=final_path,
+            fieldnames=fieldnames + (extra_fieldnames or []),
+            exclude=exclude,
+            chunk_size=self.chunk_size,
+            model_classes=[model_cls],
+            derived_columns=self.export_methods_cls.derived_columns(
+                model_classes=[model_cls],
+                format_dates=writer_cls.format_dates),
+            derived_fields=self.export_methods_cls.derived_fields(),
+            progress=self.export_methods_cls.export_progress(
+                name=name, rows_total=rows_total, path=final_path,
+                fingerprint=fingerprint),
+            profiler=self.export_methods_cls.profiler,
+            transform=partial(
+                self.export_methods_cls.export_chunk,
+                model_cls=model_cls,
+                format_dates=writer_cls.format_dates))
+        with self.export_methods_cls.profiler.file(name=name):
+            count = writer.write(rows)
+        self.written_files.append(writer.final_path)
+        self.write_deleted(
+            fname=fname, model_cls=model_cls, writer_cls=writer_cls,
+            replaced=replaced)
+        return count
+
+    def write_deleted(self, fname=None, model_cls=None, writer_cls=None,
+                      replaced=None):
+        """Write the tombstone file of an incremental export, a row per
+        obj deleted, keyed by model and id, and per obj whose replaced
+        many to many values are written again.
+        """
+        tombstones = [replaced]
+        if not self.partition or not self.partition['index']:
+            tombstones.append(self.export_methods_cls.deleted_rows(
+                model_cls=model_cls, site_id=self.site_id))
+        tombstones = [
+            rows for rows in tombstones if rows is not None and rows.exists()]
+        if tombstones:
+            writer = writer_cls(
+                final_path=self.export_path + fname + '_deleted' + writer_cls.extension,
+                fieldnames=['model', 'id', 'history_date'],
+                chunk_size=self.chunk_size)
+            writer.write(itertools.chain(*tombstones))
+            self.written_files.append(writer.final_path)
+
+    def non_crf_rows(self, objs=None, exclude=None):
+        columns = self.export_methods_cls.export_columns(
+            model_cls=objs.model, exclude=exclude,
+            only=self.column_subset(model_cls=objs.model))
+        return self.export_methods_cls.iterate_values(
+            queryset=objs, columns=columns, chunk_size=self.chunk_size,
+            encrypt=True, row_dict=partial(
+                self.export_methods_cls.non_crf_obj_dict, obj_cls=objs.model))
+
+    def subject_non_crfs(self, subject_model_list=None, exclude=None,
+                         output_format=None):
         """E.
         """
+        model_exclude = exclude_fields + [exclude] if exclude else exclude_fields
         for model_name in subject_model_list:
             if 'registeredsubject' == model_name:
                 model_cls = self.rs_cls
@@ -64,178 +179,123 @@ class ExportNonCrfData:
             else:
                 model_cls = django_apps.get_model('esr21_subject', model_name)
 
-            objs = model_cls.objects.all()
-            count = 0
-            models_data = []
-
-            for obj in objs:
-                data = self.export_methods_cls.fix_date_format(
-                    self.export_methods_cls.non_crf_obj_dict(obj=obj))
-                if exclude:
-                    exclude_fields.append(exclude)
-
-                for e_fields in exclude_fields:
-                    try:
-                        del data[e_fields]
-                    except KeyError:
-                        pass
-                if 'subject_identifier' in data:
-                    data.update(self.export_methods_cls.get_participant_cohort(data.get('subject_identifier')))
-                models_data.append(data)
-                count += 1
+            objs = self.partitioned(self.export_methods_cls.export_window(
+                queryset=model_cls.objects.all()))
+            rows = self.non_crf_rows(objs=objs, exclude=model_exclude)
             timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-            fname = 'esr21_subject_' + model_name + '_' + timestamp + '.csv'
-            final_path = self.export_path + fname
-            df_crf = pd.DataFrame(models_data)
-            df_crf.rename(columns={'subject_identifier':
-                                   'subject_identifier'}, inplace=True)
-            df_crf.to_csv(final_path, encoding='utf-8', index=False)
-
-    def subject_m2m_non_crf(self, subject_many_to_many_non_crf=None):
-        """.
+            fname = 'esr21_subject_' + model_name + '_' + timestamp
+            self.write_file(
+                fname=fname, rows=rows, model_cls=model_cls,
+                exclude=model_exclude, output_format=output_format,
+                rows_total=objs.count())
+
+    def subject_m2m_non_crf(self, subject_many_to_many_non_crf=None, layout='long',
+                            output_format=None):
+        """Export non crfs merged with their many to many values, a row
+        per value or, with layout 'wide', a boolean column per choice.
         """
         for crf_infor in subject_many_to_many_non_crf:
             crf_name, mm_field, _ = crf_infor
             crf_cls = django_apps.get_model('esr21_subject', crf_name)
-            count = 0
-            mergered_data = []
-            crf_objs = crf_cls.objects.all()
-            for crf_obj in crf_objs:
-                mm_objs = getattr(crf_obj, mm_field).all()
-                if mm_objs:
-                    for mm_obj in mm_objs:
-                        mm_data = {mm_field: mm_obj.short_name}
-
-                        crfdata = self.export_methods_cls.non_crf_obj_dict(obj=crf_obj)
-
-                        # Merged many to many and CRF data
-                        data = self.export_methods_cls.fix_date_format({**crfdata, **mm_data})
-                        for e_fields in exclude_m2m_fields:
-                            try:
-                                del data[e_fields]
-                            except KeyError:
-                                pass
-                        mergered_data.append(data)
-                        count += 1
-                else:
-                    crfdata = self.export_methods_cls.fix_date_format(
-                        self.export_methods_cls.non_crf_obj_dict(obj=crf_obj))
-                    for e_fields in exclude_fields:
-                        try:
-                            del crfdata[e_fields]
-                        except KeyError:
-                            pass
-                    mergered_data.append(crfdata)
-                    count += 1
+            crf_objs = self.partitioned(self.export_methods_cls.export_window(
+                queryset=crf_cls.objects.all()))
+            rows = self.export_methods_cls.flatten_m2m(
+                queryset=crf_objs, mm_field=mm_field,
+                obj_data=partial(
+                    self.export_methods_cls.non_crf_obj_dict, obj_cls=crf_cls),
+                layout=layout, chunk_size=self.chunk_size,
+                columns=self.export_methods_cls.export_columns(
+                    model_cls=crf_cls, exclude=exclude_m2m_fields,
+                    include=['id'], only=self.column_subset(model_cls=crf_cls)))
+            extra_fieldnames = [mm_field]
+            if layout == 'wide':
+                mm_field += '_wide'
+                extra_fieldnames = list(self.export_methods_cls.m2m_columns(
+                    model_cls=crf_cls, mm_field=crf_infor[1]).values())
             timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-            fname = 'esr21_subject_' + crf_name + '_' + 'merged' '_' + mm_field + '_' + timestamp + '.csv'
-            final_path = self.export_path + fname
-            df_crf_many2many = pd.DataFrame(mergered_data)
-            df_crf_many2many.to_csv(final_path, encoding='utf-8', index=False)
+            fname = 'esr21_subject_' + crf_name + '_' + 'merged' '_' + mm_field + '_' + timestamp
+            self.write_file(
+                fname=fname, rows=rows, model_cls=crf_cls,
+                exclude=exclude_m2m_fields, extra_fieldnames=extra_fieldnames,
+                output_format=output_format,
+                rows_total=crf_objs.count() if layout == 'wide' else None,
+                replaced=self.export_methods_cls.replaced_m2m_rows(
+                    queryset=crf_objs, mm_field=crf_infor[1]))
+
+    def prn_data(self, obj=None):
+        """Return a prn row dict adding the registered subject fields.
+        """
+        data = obj
+        try:
+            rs = self.export_methods_cls.get_registered_subject(
+                subject_identifier=obj.get('subject_identifier'))
+        except self.rs_cls.DoesNotExist:
+            raise ValidationError('Registered subject can not be missing')
+        else:
+            if 'dob' not in data:
+                data.update(dob=rs.dob)
+            if 'gender' not in data:
+                data.update(gender=rs.gender)
+            if 'screening_identifier' not in data:
+                data.update(screening_identifier=rs.screening_identifier)
+            data.update(
+                relative_identifier=rs.relative_identifier,
+                screening_age_in_years=rs.screening_age_in_years,
+                registration_datetime=rs.registration_datetime
+            )
+        return data
 
-    def offstudy(self, offstudy_prn_model_list=None):
+    def prn_rows(self, objs=None):
+        columns = self.export_methods_cls.export_columns(
+            model_cls=objs.model, exclude=exclude_fields,
+            only=self.column_subset(model_cls=objs.model))
+        return self.export_methods_cls.iterate_values(
+            queryset=objs, columns=columns, chunk_size=self.chunk_size,
+            encrypt=True, row_dict=self.prn_data)
+
+    def offstudy(self, offstudy_prn_model_list=None, output_format=None):
         """Export off study forms.
         """
 
         for model_name in offstudy_prn_model_list:
             model_cls = django_apps.get_model('esr21_prn', model_name)
-            objs = model_cls.objects.all()
-            count = 0
-            models_data = []
-            for obj in objs:
-                data = obj.__dict__
-                data = self.export_methods_cls.encrypt_values(data, obj.__class__)
-                try:
-                    rs = self.rs_cls.objects.get(subject_identifier=obj.subject_identifier)
-                except self.rs_cls.DoesNotExist:
-                    raise ValidationError('Registered subject can not be missing')
-                else:
-                    if 'dob' not in data:
-                        data.update(dob=rs.dob)
-                    if 'gender' not in data:
-                        data.update(gender=rs.gender)
-                    if 'screening_identifier' not in data:
-                        data.update(screening_identifier=rs.screening_identifier)
-                    if 'subject_identifier' in data:
-                        data.update(self.export_methods_cls.get_participant_cohort(data.get('subject_identifier')))
-                    data.update(
-                        relative_identifier=rs.relative_identifier,
-                        screening_age_in_years=rs.screening_age_in_years,
-                        registration_datetime=rs.registration_datetime
-                    )
-                last_data = self.export_methods_cls.fix_date_format(data)
-                for e_fields in exclude_fields:
-                    try:
-                        del last_data[e_fields]
-                    except KeyError:
-                        pass
-                models_data.append(last_data)
-                count += 1
+            objs = self.partitioned(self.export_methods_cls.export_window(
+                queryset=model_cls.objects.all()))
+            rows = self.prn_rows(objs=objs)
             timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-            fname = 'esr21_prn_' + model_name + '_' + timestamp + '.csv'
-            final_path = self.export_path + fname
-            df_crf = pd.DataFrame(models_data)
-            df_crf.to_csv(final_path, encoding='utf-8', index=False)
+            fname = 'esr21_prn_' + model_name + '_' + timestamp
+            self.write_file(
+                fname=fname, rows=rows, model_cls=model_cls,
+                output_format=output_format, rows_total=objs.count())
 
-    def death_report(self, death_report_prn_model_list=None):
+    def death_report(self, death_report_prn_model_list=None, output_format=None):
         # Export child Non CRF data
         for model_name in death_report_prn_model_list:
             model_cls = django_apps.get_model('esr21_prn', model_name)
-            objs = model_cls.objects.all()
-            count = 0
-            models_data = []
-            for obj in objs:
-                data = obj.__dict__
-                try:
-                    rs = self.rs_cls.objects.get(subject_identifier=obj.subject_identifier)
-                except self.rs_cls.DoesNotExist:
-                    raise ValidationError('Registered subject can not be missing')
-                else:
-                    if 'dob' not in data:
-                        data.update(dob=rs.dob)
-                    if 'gender' not in data:
-                        data.update(gender=rs.gender)
-                    if 'screening_identifier' not in data:
-                        data.update(screening_identifier=rs.screening_identifier)
-                    if 'subject_identifier' in data:
-                        data.update(self.export_methods_cls.get_participant_cohort(data.get('subject_identifier')))
-                    data.update(
-                        relative_identifier=rs.relative_identifier,
-                        screening_age_in_years=rs.screening_age_in_years,
-                        registration_datetime=rs.registration_datetime
-                    )
-                data = self.export_methods_cls.encrypt_values(data, obj.__class__)
-                last_data = self.export_methods_cls.fix_date_format(data)
-                for e_fields in exclude_fields:
-                    try:
-                        del last_data[e_fields]
-                    except KeyError:
-                        pass
-                models_data.append(last_data)
-                count += 1
+            objs = self.partitioned(self.export_methods_cls.export_window(
+                queryset=model_cls.objects.all()))
+            rows = self.prn_rows(objs=objs)
             timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-            fname = 'esr21_prn_' + model_name + '_' + timestamp + '.csv'
-            final_path = self.export_path + fname
-            df_crf = pd.DataFrame(models_data)
-            df_crf.to_csv(final_path, encoding='utf-8', index=False)
-
-    def subject_visit(self):
-
-        subject_visits = django_apps.get_model('esr21_subject.subjectvisit').objects.all()
-        data = []
-        for mv in subject_visits:
-            d = mv.__dict__
-            d = self.export_methods_cls.fix_date_format(d)
-            for e_fields in exclude_fields:
-                try:
-                    del d[e_fields]
-                except KeyError:
-                    pass
-            data.append(d)
-            if 'subject_identifier' in data:
-                data.update(self.export_methods_cls.get_participant_cohort(data.get('subject_identifier')))
+            fname = 'esr21_prn_' + model_name + '_' + timestamp
+            self.write_file(
+                fname=fname, rows=rows, model_cls=model_cls,
+                output_format=output_format, rows_total=objs.count())
+
+    def subject_visit_rows(self, subject_visits=None):
+        return self.export_methods_cls.iterate_values(
+            queryset=subject_visits, chunk_size=self.chunk_size,
+            columns=self.export_methods_cls.export_columns(
+                model_cls=subject_visits.model, exclude=exclude_fields,
+                only=self.column_subset(model_cls=subject_visits.model)))
+
+    def subject_visit(self, output_format=None):
+
+        subject_visit_cls = django_apps.get_model('esr21_subject.subjectvisit')
+        subject_visits = self.partitioned(self.export_methods_cls.export_window(
+            queryset=subject_visit_cls.objects.all()))
+        rows = self.subject_visit_rows(subject_visits=subject_visits)
         timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-        fname = 'esr21_subject_subject_visit' + '_' + timestamp + '.csv'
-        final_path = self.export_path + fname
-        df_crf = pd.DataFrame(data)
-        df_crf.to_csv(final_path, encoding='utf-8', index=False)
+        fname = 'esr21_subject_subject_visit' + '_' + timestamp
+        self.write_file(
+            fname=fname, rows=rows, model_cls=subject_visit_cls,
+            output_format=output_format, rows_total=subject_visits.count())
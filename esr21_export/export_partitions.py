@@ -0,0 +1,70 @@
+import math
+
+from django.core.exceptions import FieldDoesNotExist
+
+NO_SITE = 'none'
+
+
+def has_site(model_cls=None):
+    try:
+        model_cls._meta.get_field('site')
+    except FieldDoesNotExist:
+        return False
+    return True
+
+
+def site_shards(queryset=None):
+    """Return the site ids of the rows of a queryset, NO_SITE standing
+    for rows without a site.
+    """
+    site_ids = set(queryset.order_by().values_list('site_id', flat=True).distinct())
+    shards = sorted(site_id for site_id in site_ids if site_id is not None)
+    if None in site_ids:
+        shards.append(NO_SITE)
+    return shards
+
+
+def site_queryset(queryset=None, site_id=None):
+    """Limit a queryset of a model with a site to the rows of the site.
+    """
+    if site_id is None or not has_site(model_cls=queryset.model):
+        return queryset
+    if site_id == NO_SITE:
+        return queryset.filter(site__isnull=True)
+    return queryset.filter(site_id=site_id)
+
+
+def partition_bounds(queryset=None, field='id', rows_per_task=None):
+    """Return the (low, high) bounds of ranges of the field splitting
+    the queryset into parts of about rows_per_task rows, or an empty
+    list if it fits in one part.
+
+    The first range has no low and the last no high bound, so rows
+    created after the bounds are read still fall in a part.
+    """
+    total = queryset.count()
+    if not rows_per_task or total <= rows_per_task:
+        return []
+    parts = math.ceil(total / rows_per_task)
+    size = math.ceil(total / parts)
+    ordered = queryset.order_by(field).values_list(field, flat=True)
+    bounds = []
+    for part in range(1, parts):
+        bound = ordered[part * size]
+        if bound not in bounds:
+            bounds.append(bound)
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def partition_queryset(queryset=None, partition=None):
+    """Limit a queryset of the partitioned model to the range of the
+    partition.
+    """
+    if not partition or queryset.model._meta.label_lower != partition['model']:
+        return queryset
+    field = partition['field']
+    if partition['low'] is not None:
+        queryset = queryset.filter(**{f'{field}__gte': partition['low']})
+    if partition['high'] is not None:
+        queryset = queryset.filter(**{f'{field}__lt': partition['high']})
+    return queryset
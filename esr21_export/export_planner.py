@@ -0,0 +1,119 @@
+import json
+
+from .export_data_mixin import crf_output_names
+from .export_scheduler import ExportScheduler
+
+
+class ExportPlanner:
+    """Plan the export of one or more profiles as scheduler tasks.
+
+    Tasks of different profiles exporting the same model with the same
+    options are merged, so a model is fetched once and its files copied
+    into the path of each profile that exports it. Crf tasks that only
+    differ in the files they write, the flat file, inline merges and
+    many to many merges, are merged into one task writing all of them,
+    each file routed to the profiles that export it.
+    """
+
+    sink_options = ['flat', 'inline_n_field', 'm2m_class']
+
+    def __init__(self, profiles=None, dir_to_zip=None):
+        self.profiles = [
+            p for profile in profiles or [] for p in profile.profiles]
+        self.dir_to_zip = dir_to_zip
+
+    def export_path(self, profile=None):
+        return self.dir_to_zip + '/' + profile.path + '/'
+
+    def add_profile_tasks(self, scheduler=None, profile=None):
+        """Add the tasks of a single profile to the scheduler.
+        """
+        export_path = self.export_path(profile=profile)
+        scheduler.output_format = profile.output_format
+        scheduler.columns = profile.columns
+        scheduler.add_crf_tasks(
+            export_path=export_path, crf_list=profile.crfs,
+            inlines_dict=profile.inlines, m2m_class=profile.m2m,
+            study=profile.study)
+        for method, option, model_list in profile.non_crfs:
+            if option:
+                scheduler.add_non_crf_tasks(
+                    export_path=export_path, method=method, option=option,
+                    model_list=model_list)
+            else:
+                scheduler.add_task(
+                    exporter='non_crf', method=method, export_path=export_path,
+                    columns=scheduler.task_columns('subjectvisit'))
+        if profile.metadata_apps:
+            scheduler.add_metadata_task(
+                export_path=export_path, app_names=profile.metadata_apps)
+
+    def task_key(self, task=None):
+        options = task.options
+        if task.method == 'export_crf_outputs':
+            options = {
+                k: v for k, v in options.items() if k not in self.sink_options}
+        return (task.exporter, task.method,
+                json.dumps(options, sort_keys=True, default=str))
+
+    def task_route(self, task=None):
+        """Return the export path of a crf task and the names of the
+        files it writes.
+        """
+        return (task.export_path, tuple(crf_output_names(**{
+            k: v for k, v in task.options.items()
+            if k in ['study', 'crf_name', 'layout', *self.sink_options]})))
+
+    def merge_sinks(self, first=None, task=None):
+        """Return the crf task first writing the files of task as well,
+        each routed to the path of the profile exporting it.
+        """
+        inline, filed_n = first.options['inline_n_field'] or [[], None]
+        task_inline, task_filed_n = task.options['inline_n_field'] or [[], None]
+        inline = inline + [inl for inl in task_inline if inl not in inline]
+        m2m_class = first.options['m2m_class'] + [
+            c for c in task.options['m2m_class']
+            if c not in first.options['m2m_class']]
+        routes = dict(first.routes or [self.task_route(task=first)])
+        path, names = self.task_route(task=task)
+        routes[path] = tuple(dict.fromkeys(routes.get(path, ()) + names))
+        return first._replace(
+            options={
+                **first.options,
+                'flat': first.options['flat'] or task.options['flat'],
+                'inline_n_field': (
+                    [inline, filed_n or task_filed_n] if inline else None),
+                'm2m_class': m2m_class},
+            routes=tuple(routes.items()))
+
+    def deduplicate(self, tasks=None):
+        """Return the tasks with each repeated task merged into the
+        first, its export path added to the paths the files are copied to
+        or, for crf tasks, its files to the files the first task writes.
+        """
+        planned = {}
+        for task in tasks:
+            key = self.task_key(task=task)
+            first = planned.get(key)
+            if not first:
+                planned[key] = task
+            elif task.method == 'export_crf_outputs':
+                planned[key] = self.merge_sinks(first=first, task=task)
+            elif task.export_path != first.export_path and (
+                    task.export_path not in first.copy_paths):
+                planned[key] = first._replace(
+                    copy_paths=first.copy_paths + (task.export_path,))
+        return list(planned.values())
+
+    def scheduler(self, export_methods=None, archive=None, processes=None,
+                  site_id=None):
+        """Return a scheduler with the deduplicated tasks of all the
+        profiles, for a single site if given.
+        """
+        scheduler = ExportScheduler(
+            processes=processes, export_methods=export_methods,
+            archive=archive, site_id=site_id)
+        for profile in self.profiles:
+            self.add_profile_tasks(scheduler=scheduler, profile=profile)
+        scheduler.tasks = self.deduplicate(tasks=scheduler.tasks)
+        return scheduler
@@ -0,0 +1,25 @@
+import multiprocessing
+
+import django
+from django.apps import apps as django_apps
+from django.utils.module_loading import import_string
+
+
+def pool_context():
+    """Return the context export process pools are started with.
+
+    Pool processes are spawned rather than forked, as a fork would copy
+    the connections and held locks of the other threads of the parent,
+    e.g. the archive's compression thread or the export job workers.
+    """
+    return multiprocessing.get_context('spawn')
+
+
+def setup_worker(initializer=None, *initargs):
+    """Set up Django in a spawned pool process, then run the initializer
+    given by its dotted path, imported once the apps are ready.
+    """
+    if not django_apps.ready:
+        django.setup()
+    if initializer:
+        import_string(initializer)(*initargs)
@@ -0,0 +1,143 @@
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.apps import apps as django_apps
+from django.db import connections
+
+from .constants import FILE_STAGE, QUERY_STAGE
+
+
+class ExportProfiler:
+    """Record the wall time, query count and rows of each stage of the
+    files of an export, saved against the export file as each file is
+    finished.
+
+    Stages are recorded once per chunk of rows, never per row, to keep
+    profiling cheap enough to leave on. Stages nest, e.g. a throttle
+    wait while a file is written, and time and queries are counted
+    against the innermost stage only. Time in a file outside any other
+    stage is counted against the file stage.
+    """
+
+    def __init__(self, export_file=None, enabled=None):
+        self.export_file = export_file
+        if enabled is None:
+            enabled = django_apps.get_app_config('esr21_export').profile_exports
+        self.enabled = enabled and export_file is not None
+        self.name = None
+        self.frames = []
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def record(self, name=None, stage=None, seconds=0.0, queries=0, rows=0):
+        """Add to the totals of a stage of a file.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            stat = self.stats.setdefault((name, stage), [0.0, 0, 0])
+            stat[0] += seconds
+            stat[1] += queries
+            stat[2] += rows
+
+    def count_query(self, execute, sql, params, many, context):
+        if self.frames:
+            self.frames[-1]['queries'] += 1
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def stage(self, stage=None, rows=1):
+        """Time the block as a stage of the current file. The rows of
+        the yielded frame may be changed in the block.
+        """
+        if not self.enabled or self.name is None:
+            yield {}
+            return
+        frame = {'child_seconds': 0.0, 'queries': 0, 'rows': rows}
+        self.frames.append(frame)
+        start = time.perf_counter()
+        try:
+            yield frame
+        finally:
+            seconds = time.perf_counter() - start
+            self.frames.pop()
+            if self.frames:
+                self.frames[-1]['child_seconds'] += seconds
+            self.record(
+                name=self.name, stage=stage,
+                seconds=seconds - frame['child_seconds'],
+                queries=frame['queries'], rows=frame['rows'])
+
+    def iterate(self, iterable=None, stage=QUERY_STAGE, chunk_size=None):
+        """Yield from iterable, timing the fetches and recording them as
+        a stage once per chunk_size rows.
+
+        Fetch time and queries are taken out of the stage the rows are
+        read in, as if each fetch were a stage of its own.
+        """
+        if not self.enabled or self.name is None:
+            yield from iterable
+            return
+        name = self.name
+        chunk_size = chunk_size or django_apps.get_app_config(
+            'esr21_export').chunk_size
+        iterator = iter(iterable)
+        rows = queries = 0
+        seconds = 0.0
+        while True:
+            frame = self.frames[-1] if self.frames else None
+            frame_queries = frame['queries'] if frame else 0
+            start = time.perf_counter()
+            obj = next(iterator, iterator)
+            elapsed = time.perf_counter() - start
+            seconds += elapsed
+            if frame:
+                frame['child_seconds'] += elapsed
+                queries += frame['queries'] - frame_queries
+                frame['queries'] = frame_queries
+            if obj is iterator:
+                break
+            yield obj
+            rows += 1
+            if rows == chunk_size:
+                self.record(
+                    name=name, stage=stage, seconds=seconds, queries=queries,
+                    rows=rows)
+                rows = queries = 0
+                seconds = 0.0
+        self.record(
+            name=name, stage=stage, seconds=seconds, queries=queries, rows=rows)
+
+    @contextmanager
+    def file(self, name=None):
+        """Profile the export of a file, counting the queries of every
+        database connection.
+        """
+        if not self.enabled:
+            yield
+            return
+        self.name = name
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(
+                        connection.execute_wrapper(self.count_query))
+                with self.stage(FILE_STAGE, rows=0):
+                    yield
+        finally:
+            self.name = None
+            self.save()
+
+    def save(self):
+        """Save the recorded stages against the export file.
+        """
+        if not self.enabled:
+            return
+        stage_cls = django_apps.get_model('esr21_export.exportstage')
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        for (name, stage), (seconds, queries, rows) in stats.items():
+            stage_cls.objects.create(
+                export_file=self.export_file, name=name, stage=stage,
+                wall_time=round(seconds, 3), queries=queries, rows=rows)
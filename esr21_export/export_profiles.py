@@ -0,0 +1,138 @@
+from .export_model_lists import (
+    subject_crfs_list, subject_inlines_dict, subject_many_to_many_crf,
+    subject_model_list, death_report_prn_model_list, offstudy_prn_model_list,
+    subject_many_to_many_non_crf, vida_subject_crfs_list,
+    vida_subject_inlines_dict, vida_subject_many_to_many_crf,
+    vida_subject_model_list)
+from .metadata_app_names_list import metadata_app_names
+
+
+class ExportProfile:
+    """A declarative export: the crfs, inlines, many to many crfs, non
+    crf export methods and metadata apps it exports, optional column
+    subsets per model name and the output format. A profile with a
+    context name lists its recent exports under that name on the home
+    page. An incremental profile exports only the rows created,
+    modified or deleted since its own last completed export.
+
+    A profile of other profiles exports all of them in one run, each
+    under its own path in the archive.
+    """
+
+    def __init__(self, name=None, archive_name='esr21_export', download=None,
+                 path=None, study='esr21_subject', crfs=None, inlines=None,
+                 m2m=None, non_crfs=None, metadata_apps=None, columns=None,
+                 output_format=None, profiles=None, context_name=None,
+                 incremental=False):
+        self.name = name
+        self.archive_name = archive_name
+        self.download = download
+        self.path = path
+        self.study = study
+        self.crfs = crfs or []
+        self.inlines = inlines or {}
+        self.m2m = m2m or []
+        self.non_crfs = non_crfs or []
+        self.metadata_apps = metadata_apps or []
+        self.columns = columns or {}
+        self.output_format = output_format
+        self.profiles = profiles or [self]
+        self.context_name = context_name
+        self.incremental = incremental
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(name={self.name!r})'
+
+    @property
+    def exports_data(self):
+        return any(
+            p.crfs or p.inlines or p.m2m or p.non_crfs for p in self.profiles)
+
+    @property
+    def exports_metadata(self):
+        return any(p.metadata_apps for p in self.profiles)
+
+    def definition(self):
+        """Return what the profile exports, for fingerprinting.
+        """
+        return [
+            {'path': p.path, 'study': p.study, 'crfs': p.crfs,
+             'inlines': p.inlines, 'm2m': p.m2m, 'non_crfs': p.non_crfs,
+             'columns': p.columns, 'output_format': p.output_format,
+             'incremental': self.incremental}
+            for p in self.profiles]
+
+
+class ExportProfiles:
+    """A registry of export profiles by name, the description of the
+    export files they produce.
+    """
+
+    def __init__(self):
+        self.registry = {}
+
+    def register(self, profile=None):
+        self.registry[profile.name] = profile
+        return profile
+
+    def get(self, name=None):
+        return self.registry.get(name)
+
+    def for_download(self, download=None):
+        """Return the profile of a download link, or None.
+        """
+        for profile in self.registry.values():
+            if download and profile.download == download:
+                return profile
+        return None
+
+    @property
+    def names(self):
+        return list(self.registry)
+
+    def listed(self):
+        """Return the profiles listed on the home page.
+        """
+        return [p for p in self.registry.values() if p.context_name]
+
+
+export_profiles = ExportProfiles()
+
+subject_crf_profile = export_profiles.register(ExportProfile(
+    name='ESR21 Subject CRF Export', download='3', path='subject',
+    context_name='subject_crf_exports', crfs=subject_crfs_list, inlines=subject_inlines_dict,
+    m2m=subject_many_to_many_crf))
+
+non_crf_profile = export_profiles.register(ExportProfile(
+    name='ESR21 Non CRF Export', archive_name='esr21_non_crf_export',
+    download='2', path='non_crf', context_name='non_crf_exports',
+    non_crfs=[
+        ('death_report', 'death_report_prn_model_list',
+         death_report_prn_model_list),
+        ('subject_non_crfs', 'subject_model_list', subject_model_list),
+        ('subject_m2m_non_crf', 'subject_many_to_many_non_crf',
+         subject_many_to_many_non_crf),
+        ('subject_visit', None, None),
+        ('offstudy', 'offstudy_prn_model_list', offstudy_prn_model_list)]))
+
+all_profile = export_profiles.register(ExportProfile(
+    name='ESR21 All Export', download='1',
+    profiles=[subject_crf_profile, non_crf_profile]))
+
+incremental_all_profile = export_profiles.register(ExportProfile(
+    name='ESR21 All Incremental Export',
+    archive_name='esr21_incremental_export', download='6', incremental=True,
+    profiles=[subject_crf_profile, non_crf_profile]))
+
+export_profiles.register(ExportProfile(
+    name='Metadata Export', archive_name='esr21_metadata_export',
+    download='4', path='metadata', context_name='metadata_exports',
+    metadata_apps=metadata_app_names))
+
+export_profiles.register(ExportProfile(
+    name='Current required Export', download='5', path='current_required',
+    context_name='vida_crf_exports',
+    crfs=vida_subject_crfs_list, inlines=vida_subject_inlines_dict,
+    m2m=vida_subject_many_to_many_crf,
+    non_crfs=[
+        ('subject_non_crfs', 'subject_model_list', vida_subject_model_list)]))
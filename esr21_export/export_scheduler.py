@@ -0,0 +1,400 @@
+import os
+import re
+import shutil
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.apps import apps as django_apps
+from django.core.exceptions import ValidationError
+
+from .export_data_mixin import ExportDataMixin
+from .export_methods import ExportMethods
+from .export_non_crfs import ExportNonCrfData
+from .export_partitions import (
+    has_site, partition_bounds, site_queryset, site_shards)
+from .export_pool import pool_context, setup_worker
+from .export_throttle import ExportThrottle
+from .export_writer import export_writer_for
+from .metadata import ExportMetadata
+from .routers import exporting
+
+ExportTask = namedtuple(
+    'ExportTask', 'exporter method export_path options copy_paths routes',
+    defaults=[(), ()])
+
+worker_export_methods = None
+
+
+def init_worker(export_file_id=None, incremental=False, processes=1):
+    """Give each pool process its export file, lookups and share of the
+    export's read budget. The export file is passed by id, as a spawned
+    process has no models until Django is set up.
+    """
+    global worker_export_methods
+    export_file = None
+    if export_file_id:
+        export_file = django_apps.get_model(
+            'esr21_export.exportfile').objects.get(pk=export_file_id)
+    exporting.set(True)
+    worker_export_methods = ExportMethods(
+        export_file=export_file, incremental=incremental)
+    worker_export_methods.throttle = ExportThrottle(
+        profiler=worker_export_methods.profiler, processes=processes)
+    worker_export_methods.load_lookups()
+
+
+def output_name(path=None):
+    """Return the name of an export file without its timestamp,
+    extension or tombstone suffix.
+    """
+    name = os.path.splitext(re.sub(r'_\d{14}(?=[_.])', '', os.path.basename(path)))[0]
+    return re.sub(r'_deleted$', '', name)
+
+
+def route_files(task=None, written_files=None):
+    """Return a list per file a task wrote of the paths of the file in
+    the export path of every profile sharing the task.
+
+    Without routes a file is copied into every copy path. With routes,
+    a task shared by profiles exporting different files of a model, a
+    file is kept in or moved to the first path of a profile exporting
+    it and copied into the paths of the others.
+    """
+    routed = []
+    for path in written_files:
+        if task.routes:
+            name = output_name(path=path)
+            route_paths = [
+                route_path for route_path, names in task.routes
+                if name in names] or [task.export_path]
+        else:
+            route_paths = [task.export_path, *task.copy_paths]
+        if os.path.normpath(os.path.dirname(path)) not in [
+                os.path.normpath(p) for p in route_paths]:
+            os.makedirs(route_paths[0], exist_ok=True)
+            path = shutil.move(path, route_paths[0])
+        paths = [path]
+        for route_path in route_paths:
+            if os.path.normpath(route_path) != os.path.normpath(os.path.dirname(path)):
+                os.makedirs(route_path, exist_ok=True)
+                paths.append(shutil.copy(path, route_path))
+        routed.append(paths)
+    return routed
+
+
+def run_task(task, export_methods=None):
+    """Run a single export task and return the files it wrote.
+    """
+    export_methods = export_methods or worker_export_methods or ExportMethods()
+    options = dict(task.options)
+    columns = options.pop('columns', None)
+    partition = options.pop('partition', None)
+    site_id = options.pop('site_id', None)
+    if task.exporter == 'crf':
+        exporter = ExportDataMixin(
+            export_path=task.export_path, export_methods_cls=export_methods,
+            columns=columns, partition=partition, site_id=site_id)
+        options.update(crf_data_dict=export_methods.subject_crf_data_dict)
+    elif task.exporter == 'metadata':
+        exporter = ExportMetadata(export_path=task.export_path)
+    else:
+        exporter = ExportNonCrfData(
+            export_path=task.export_path, export_methods_cls=export_methods,
+            columns=columns, partition=partition, site_id=site_id)
+    getattr(exporter, task.method)(**options)
+    return list(exporter.written_files)
+
+
+class ExportScheduler:
+    """Run exports as one task per model, on a process pool when more
+    than one export process is configured.
+
+    On a pool, the task of a model with more than rows_per_task rows is
+    split into tasks over ranges of the partition field, each writing
+    part files that are concatenated in range order once all are done.
+
+    Given a site id, models with a site are exported for that site
+    only. With site shards, the task of a model with a site is split
+    into a task per site writing to a site=<id>/ path, and the files of
+    the whole study are assembled from the site files.
+    """
+
+    def __init__(self, processes=None, export_methods=None, output_format=None,
+                 archive=None, columns=None, site_id=None, site_shards=None):
+        app_config = django_apps.get_app_config('esr21_export')
+        self.processes = processes or app_config.export_processes
+        self.rows_per_task = app_config.rows_per_task
+        self.partition_field = app_config.partition_field
+        self.site_id = site_id
+        if site_shards is None:
+            site_shards = app_config.site_shards
+        self.site_shards = site_shards and site_id is None
+        self.export_methods = export_methods
+        self.output_format = output_format
+        self.columns = columns
+        self.archive = archive
+        self.tasks = []
+        self.failures = {}
+        self.splits = {}
+        self.part_of = {}
+
+    def add_crf_tasks(self, export_path=None, crf_list=None, inlines_dict=None,
+                      m2m_class=None, study=None):
+        """Add a task per crf exporting the crf, its inline merges and
+        its many to many merges from a single read of the crf.
+        """
+        crf_list = crf_list or []
+        inlines_dict = inlines_dict or {}
+        m2m_class = m2m_class or []
+        crf_names = list(crf_list)
+        for crf_name in list(inlines_dict) + [c[0] for c in m2m_class]:
+            if crf_name not in crf_names:
+                crf_names.append(crf_name)
+        for crf_name in crf_names:
+            inline_n_field = inlines_dict.get(crf_name)
+            self.add_task(
+                exporter='crf', method='export_crf_outputs',
+                export_path=export_path, crf_name=crf_name,
+                flat=crf_name in crf_list, inline_n_field=inline_n_field,
+                m2m_class=[c for c in m2m_class if c[0] == crf_name],
+                study=study,
+                columns=self.task_columns(
+                    crf_name, *(inline_n_field or [[]])[0]))
+
+    def add_non_crf_tasks(self, export_path=None, method=None, option=None,
+                          model_list=None):
+        """Add a task for each model of a non crf export method.
+        """
+        for model in model_list:
+            self.add_task(
+                exporter='non_crf', method=method, export_path=export_path,
+                columns=self.task_columns(
+                    model[0] if isinstance(model, list) else model),
+                **{option: [model]})
+
+    def add_metadata_task(self, export_path=None, app_names=None):
+        """Add a task writing the data dictionaries of the apps.
+        """
+        self.tasks.append(ExportTask(
+            'metadata', 'generate_metadata', export_path,
+            {'app_names': app_names}))
+
+    def add_task(self, exporter=None, method=None, export_path=None, **options):
+        options.setdefault('output_format', self.output_format)
+        if not options.get('columns'):
+            options.pop('columns', None)
+        self.tasks.append(ExportTask(exporter, method, export_path, options))
+
+    def task_columns(self, *model_names):
+        """Return the column subsets of the models a task exports.
+        """
+        return {
+            model_name: self.columns[model_name]
+            for model_name in model_names if model_name in (self.columns or {})}
+
+    @property
+    def worker_initargs(self):
+        export_file = self.export_methods and self.export_methods.export_file
+        return ('esr21_export.export_scheduler.init_worker',
+                export_file.pk if export_file else None,
+                bool(self.export_methods and self.export_methods.incremental),
+                self.processes)
+
+    def archive_files(self, written_files=None):
+        """Hand the files of a finished task to the archive.
+        """
+        if self.archive:
+            for path in written_files:
+                self.archive.add(path)
+
+    def task_model(self, task=None):
+        """Return the model a task reads its rows from, or None if the
+        task cannot be split.
+        """
+        options = task.options
+        if task.method == 'export_crf_outputs':
+            return django_apps.get_model(options['study'], options['crf_name'])
+        if task.method == 'subject_visit':
+            return django_apps.get_model('esr21_subject.subjectvisit')
+        if task.method == 'death_report':
+            return django_apps.get_model(
+                'esr21_prn', options['death_report_prn_model_list'][0])
+        if task.method == 'offstudy':
+            return django_apps.get_model(
+                'esr21_prn', options['offstudy_prn_model_list'][0])
+        if task.method == 'subject_m2m_non_crf':
+            return django_apps.get_model(
+                'esr21_subject', options['subject_many_to_many_non_crf'][0][0])
+        if task.method == 'subject_non_crfs':
+            model_name = options['subject_model_list'][0]
+            if model_name == 'registeredsubject':
+                return django_apps.get_model('edc_registration.registeredsubject')
+            if model_name == 'appointment':
+                return django_apps.get_model('edc_appointment.appointment')
+            return django_apps.get_model('esr21_subject', model_name)
+        return None
+
+    def split_task(self, index=None, task=None, parts=None, keep_parts=False):
+        """Return a task per part of a split task, each with the options
+        of its part and writing to the path of the part under the
+        export path of the task.
+        """
+        self.splits[index] = {
+            'task': task, 'index': index, 'keep_parts': keep_parts,
+            'archive': [],
+            'written': [None] * len(parts)}
+        part_tasks = []
+        for part, (path, options) in enumerate(parts):
+            copy_paths = routes = ()
+            if keep_parts:
+                copy_paths = tuple(p + path for p in task.copy_paths)
+                routes = tuple((p + path, names) for p, names in task.routes)
+            part_task = task._replace(
+                export_path=task.export_path + path, copy_paths=copy_paths,
+                routes=routes, options={**task.options, **options})
+            self.part_of[id(part_task)] = (index, part)
+            part_tasks.append(part_task)
+        return part_tasks
+
+    def partition_tasks(self):
+        """Return the tasks to run, with the task of each model split
+        into a task per site shard or, on a pool, a task per range of a
+        model too large for one task.
+        """
+        self.splits = {}
+        self.part_of = {}
+        tasks = []
+        for index, task in enumerate(self.tasks):
+            model_cls = self.task_model(task=task)
+            if not model_cls:
+                tasks.append(task)
+                continue
+            if has_site(model_cls=model_cls):
+                if self.site_id is not None:
+                    task = task._replace(
+                        options={**task.options, 'site_id': self.site_id})
+                elif self.site_shards:
+                    tasks += self.split_task(
+                        index=index, task=task, keep_parts=True,
+                        parts=[(f'site={shard}/', {'site_id': shard})
+                               for shard in site_shards(
+                                   queryset=model_cls.objects.all())])
+                    continue
+            bounds = []
+            if self.processes > 1:
+                bounds = partition_bounds(
+                    queryset=site_queryset(
+                        queryset=model_cls.objects.all(), site_id=self.site_id),
+                    field=self.partition_field,
+                    rows_per_task=self.rows_per_task)
+            if not bounds:
+                tasks.append(task)
+                continue
+            tasks += self.split_task(
+                index=index, task=task,
+                parts=[(f'.parts/{index}/{part}/', {'partition': {
+                    'model': model_cls._meta.label_lower,
+                    'field': self.partition_field,
+                    'low': low, 'high': high, 'index': part}})
+                    for part, (low, high) in enumerate(bounds)])
+        return tasks
+
+    def remove_parts(self, split=None):
+        """Remove the part files of a range split task, leaving those of
+        the other tasks writing to the same path. Site files are kept as
+        partitions of the export.
+        """
+        if not split['keep_parts']:
+            shutil.rmtree(
+                split['task'].export_path + f'.parts/{split["index"]}/',
+                ignore_errors=True)
+
+    def concatenate_parts(self, task=None, written=None):
+        """Concatenate the part files of a split task into its export
+        path and return the files, routed to the paths sharing the task.
+        """
+        groups = {}
+        for written_files in written:
+            for path in written_files:
+                name = re.sub(r'_\d{14}(?=[_.])', '', os.path.basename(path))
+                groups.setdefault(name, []).append(path)
+        final_files = []
+        for paths in groups.values():
+            final_path = task.export_path + os.path.basename(paths[0])
+            export_writer_for(path=final_path).concatenate(
+                paths=paths, final_path=final_path)
+            final_files.append(final_path)
+        return [path for paths in route_files(task=task, written_files=final_files)
+                for path in paths]
+
+    def finished(self, task=None, written_files=None):
+        """Archive the files of a finished task or, for the last part of
+        a split task, of the concatenated parts.
+        """
+        routed = route_files(task=task, written_files=written_files)
+        if id(task) not in self.part_of:
+            self.archive_files([path for paths in routed for path in paths])
+            return
+        index, part = self.part_of[id(task)]
+        split = self.splits[index]
+        split['written'][part] = [paths[0] for paths in routed]
+        if split['keep_parts']:
+            split['archive'] += [path for paths in routed for path in paths]
+        if all(w is not None for w in split['written']):
+            try:
+                final_files = self.concatenate_parts(
+                    task=split['task'], written=split['written'])
+            except Exception as e:
+                self.failures[self.task_label(split['task'])] = e
+            else:
+                self.archive_files(final_files)
+            finally:
+                self.archive_files(split['archive'])
+                self.remove_parts(split=split)
+
+    def task_label(self, task):
+        options = ', '.join(f'{k}={v}' for k, v in task.options.items())
+        return f'{task.method}({options})'
+
+    def run(self):
+        """Run all tasks, then raise listing every task that failed.
+        """
+        self.failures = {}
+        for export_path in {path for task in self.tasks
+                            for path in (task.export_path, *task.copy_paths,
+                                         *(p for p, _ in task.routes))}:
+            if export_path:
+                os.makedirs(export_path, exist_ok=True)
+        tasks = self.partition_tasks()
+        if self.processes <= 1:
+            for task in tasks:
+                try:
+                    written_files = run_task(
+                        task, export_methods=self.export_methods)
+                except Exception as e:
+                    self.failures[self.task_label(task)] = e
+                else:
+                    self.finished(task=task, written_files=written_files)
+        else:
+            with ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=pool_context(),
+                    initializer=setup_worker,
+                    initargs=self.worker_initargs) as executor:
+                futures = {
+                    executor.submit(run_task, task): task for task in tasks}
+                for future in as_completed(futures):
+                    task = futures[future]
+                    try:
+                        written_files = future.result()
+                    except Exception as e:
+                        self.failures[self.task_label(task)] = e
+                    else:
+                        self.finished(task=task, written_files=written_files)
+        for split in self.splits.values():
+            self.remove_parts(split=split)
+        self.tasks = []
+        if self.failures:
+            raise ValidationError(
+                'Export tasks failed: ' + '; '.join(
+                    f'{label}: {e!r}' for label, e in self.failures.items()))
@@ -0,0 +1,179 @@
+import time
+from contextlib import ExitStack
+
+from django.apps import apps as django_apps
+from django.db import connections
+
+from .constants import THROTTLE_STAGE
+from .routers import export_database
+
+
+class TokenBucket:
+    """A budget of rate units a second holding at most a second's worth
+    of units, so a reader that was idle cannot build up credit.
+    """
+
+    def __init__(self, rate=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = max(rate, 1)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = None
+
+    def take(self, units=1):
+        """Take units from the bucket and return the seconds to wait
+        until it is out of debt again.
+        """
+        now = self.clock()
+        if self.updated is not None:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= units
+        return max(-self.tokens / self.rate, 0.0)
+
+
+class ExportThrottle:
+    """Pace the reads of an export to a rows and queries per second
+    budget, backing off while query latency is above a threshold.
+
+    Rows are counted a chunk at a time as they are read. Each chunk
+    fetched counts as a query, timed from the reader's side so that
+    server side cursor fetches are measured and not only the statement
+    declaring the cursor, as does every other read run on the export
+    database. The latency is a moving average of the chunk fetch times.
+    After each chunk the reader waits for as long as either budget is
+    in debt, plus a back-off that doubles while the latency is over the
+    threshold and halves again once it is back under. The budgets are
+    per export and shared between its processes.
+    """
+
+    smoothing = 0.2
+    min_backoff = 0.1
+    read_statements = ('SELECT', 'WITH')
+
+    def __init__(self, rows_per_second=None, queries_per_second=None,
+                 latency_threshold=None, max_backoff=None, processes=1,
+                 profiler=None, clock=time.monotonic, sleep=time.sleep):
+        app_config = django_apps.get_app_config('esr21_export')
+        rows_per_second = rows_per_second or app_config.max_rows_per_second
+        queries_per_second = queries_per_second or app_config.max_queries_per_second
+        self.rows_per_second = rows_per_second / processes if rows_per_second else None
+        self.queries_per_second = (
+            queries_per_second / processes if queries_per_second else None)
+        self.latency_threshold = latency_threshold or app_config.latency_threshold
+        self.max_backoff = max_backoff or app_config.max_backoff
+        self.chunk_size = app_config.chunk_size
+        self.profiler = profiler
+        self.clock = clock
+        self.sleep = sleep
+        self.row_budget = self.query_budget = None
+        if self.rows_per_second:
+            self.row_budget = TokenBucket(rate=self.rows_per_second, clock=clock)
+        if self.queries_per_second:
+            self.query_budget = TokenBucket(
+                rate=self.queries_per_second, clock=clock)
+        self.rows = 0
+        self.queries = 0
+        self.pending_queries = 0
+        self.latency = None
+        self.backoff = 0.0
+        self.waited = 0.0
+        self.counting = False
+        self.fetching = False
+
+    @property
+    def enabled(self):
+        return bool(
+            self.rows_per_second or self.queries_per_second
+            or self.latency_threshold)
+
+    def count_query(self, execute, sql, params, many, context):
+        """Count the reads run on the export database outside of a
+        chunk fetch, which is counted on its own.
+        """
+        if not self.fetching and sql.lstrip()[:6].upper().startswith(
+                self.read_statements):
+            self.pending_queries += 1
+        return execute(sql, params, many, context)
+
+    def record_fetch(self, seconds=None):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += self.smoothing * (seconds - self.latency)
+
+    def pause(self, rows=0, queries=0):
+        """Take the rows and queries read from the budgets and return
+        the seconds to wait before reading the next chunk.
+        """
+        wait = 0.0
+        if self.row_budget:
+            wait = max(wait, self.row_budget.take(rows))
+        if self.query_budget:
+            wait = max(wait, self.query_budget.take(queries))
+        if self.latency_threshold and self.latency is not None:
+            if self.latency > self.latency_threshold:
+                self.backoff = min(
+                    self.max_backoff, max(self.backoff * 2, self.min_backoff))
+            elif self.backoff:
+                self.backoff /= 2
+                if self.backoff < self.min_backoff:
+                    self.backoff = 0.0
+            wait += self.backoff
+        return wait
+
+    def throttle(self, rows=0, seconds=0.0):
+        """Record a chunk fetched in seconds, then wait for as long as
+        the reads are over budget or backing off, recording the wait as
+        the throttle stage.
+        """
+        queries, self.pending_queries = self.pending_queries + 1, 0
+        self.rows += rows
+        self.queries += queries
+        self.record_fetch(seconds=seconds)
+        wait = self.pause(rows=rows, queries=queries)
+        if wait <= 0:
+            return
+        if self.profiler:
+            with self.profiler.stage(THROTTLE_STAGE, rows=0):
+                self.sleep(wait)
+        else:
+            self.sleep(wait)
+        self.waited += wait
+
+    def iterate(self, iterable=None, chunk_size=None):
+        """Yield from iterable, timing the fetch of every chunk_size rows
+        and pacing the reads after it.
+        """
+        if not self.enabled:
+            yield from iterable
+            return
+        with ExitStack() as stack:
+            if not self.counting:
+                self.counting = True
+                stack.callback(setattr, self, 'counting', False)
+                stack.enter_context(connections[export_database()].execute_wrapper(
+                    self.count_query))
+            chunk_size = chunk_size or self.chunk_size
+            iterator = iter(iterable)
+            count = 0
+            seconds = 0.0
+            while True:
+                self.fetching = True
+                start = self.clock()
+                try:
+                    obj = next(iterator, iterator)
+                finally:
+                    seconds += self.clock() - start
+                    self.fetching = False
+                if obj is iterator:
+                    break
+                yield obj
+                count += 1
+                if count == chunk_size:
+                    self.throttle(rows=count, seconds=seconds)
+                    count = 0
+                    seconds = 0.0
+            if count:
+                self.throttle(rows=count, seconds=seconds)
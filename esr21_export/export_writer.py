@@ -0,0 +1,281 @@
+import csv
+from contextlib import nullcontext
+
+from django.apps import apps as django_apps
+from django.core.exceptions import ImproperlyConfigured
+
+from .constants import WRITE_STAGE
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+class ExportWriter:
+    """Write export rows to a csv file as they are produced.
+
+    The header is settled from the first chunk of rows followed by any
+    model fieldnames not seen in it and the derived columns of its
+    columns, e.g. the cohort and the split dates that may only appear
+    in later chunks, after which rows are written straight to the file
+    so memory does not grow with the table.
+
+    Rows are either written from an iterable with write, or pushed one
+    at a time with add and finished with close, so a single pass over
+    a table can feed several writers.
+    """
+
+    extension = '.csv'
+    format_dates = True
+
+    def __init__(self, final_path=None, fieldnames=None, exclude=None,
+                 chunk_size=None, transform=None, model_classes=None,
+                 derived_columns=None, derived_fields=None, progress=None,
+                 profiler=None):
+        self.final_path = final_path
+        self.progress = progress
+        self.profiler = profiler
+        self.model_classes = model_classes or []
+        self.fieldnames = fieldnames or []
+        self.exclude = exclude or []
+        self.derived_columns = derived_columns or {}
+        self.derived_fields = derived_fields or {}
+        self.transform = transform
+        self.chunk_size = chunk_size or django_apps.get_app_config(
+            'esr21_export').chunk_size
+        self.buffer = []
+        self.count = 0
+        self.file = None
+        self.writer = None
+
+    def header(self, rows=None):
+        """Return the csv header for the rows.
+        """
+        header = {}
+        for row in rows:
+            header.update(dict.fromkeys(row))
+        header.update(dict.fromkeys(self.fieldnames))
+        for name in list(header):
+            header.update(dict.fromkeys(self.derived_columns.get(name, [])))
+        return [name for name in header if name not in self.exclude]
+
+    def write_stage(self, rows=None):
+        """Return a context profiling the write of rows.
+        """
+        if self.profiler:
+            return self.profiler.stage(WRITE_STAGE, rows=len(rows))
+        return nullcontext()
+
+    def report(self, count=None, finished=False):
+        """Record the rows written so far on the progress record.
+        """
+        if self.progress:
+            self.progress.update_rows(rows_done=count, finished=finished)
+
+    def open(self, first_chunk=None):
+        """Open the csv file and write the header for the first chunk.
+        """
+        self.file = open(self.final_path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.DictWriter(
+            self.file, fieldnames=self.header(first_chunk),
+            extrasaction='ignore')
+        self.writer.writeheader()
+
+    def write_rows(self, chunk=None):
+        self.writer.writerows(chunk)
+
+    def close_file(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def add(self, row=None):
+        """Buffer a row, writing the buffer once it holds a chunk.
+        """
+        self.buffer.append(row)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows, passed through transform, opening the
+        file with the first of them.
+        """
+        chunk = self.transform(self.buffer) if self.transform else self.buffer
+        self.buffer = []
+        if self.writer is None:
+            self.open(first_chunk=chunk)
+        with self.write_stage(chunk):
+            self.write_rows(chunk=chunk)
+        self.count += len(chunk)
+        self.report(self.count)
+
+    def close(self):
+        """Write any buffered rows, finish the file and return the number
+        of rows written.
+        """
+        if self.buffer or self.writer is None:
+            self.flush()
+        self.close_file()
+        self.report(self.count, finished=True)
+        return self.count
+
+    @classmethod
+    def concatenate(cls, paths=None, final_path=None):
+        """Concatenate csv part files in order into a file with a single
+        header, the columns of all the parts in order of appearance.
+        """
+        headers = []
+        for path in paths:
+            with open(path, newline='', encoding='utf-8') as f:
+                headers.append(next(csv.reader(f), []))
+        header = list(dict.fromkeys(name for h in headers for name in h))
+        with open(final_path, 'w', newline='', encoding='utf-8') as out:
+            writer = csv.writer(out)
+            writer.writerow(header)
+            for path, part_header in zip(paths, headers):
+                with open(path, newline='', encoding='utf-8') as f:
+                    reader = csv.reader(f)
+                    next(reader, None)
+                    if part_header == header:
+                        writer.writerows(reader)
+                    else:
+                        for row in reader:
+                            values = dict(zip(part_header, row))
+                            writer.writerow([values.get(name, '') for name in header])
+
+    def write(self, rows=None):
+        """Write rows to the file and return the number written.
+        """
+        try:
+            for row in rows:
+                self.add(row=row)
+        except Exception:
+            self.close_file()
+            raise
+        return self.close()
+
+
+class ExportParquetWriter(ExportWriter):
+    """Write export rows to a compressed parquet file as they are produced.
+
+    Column types are taken from the model fields and the fields of the
+    derived columns, falling back to the types of the values in the
+    first chunk. Derived columns are typed explicitly so that the part
+    files of a split model, some of which may have no values for them,
+    share a schema. Dates keep their type rather than being formatted.
+    """
+
+    extension = '.parquet'
+    format_dates = False
+
+    def __init__(self, compression='zstd', **kwargs):
+        if not pa:
+            raise ImproperlyConfigured(
+                'pyarrow is required to export in parquet format.')
+        super().__init__(**kwargs)
+        self.compression = compression
+
+    def field_type(self, field=None):
+        """Return the arrow type of a model field or None.
+        """
+        internal_type = field.get_internal_type()
+        if internal_type in ['ForeignKey', 'OneToOneField']:
+            return self.field_type(field.target_field)
+        if internal_type in ['AutoField', 'BigAutoField', 'IntegerField',
+                             'BigIntegerField', 'SmallIntegerField',
+                             'PositiveIntegerField', 'PositiveSmallIntegerField']:
+            return pa.int64()
+        if internal_type == 'DecimalField' and field.max_digits:
+            return pa.decimal128(field.max_digits, field.decimal_places)
+        return {
+            'FloatField': pa.float64(),
+            'BooleanField': pa.bool_(),
+            'NullBooleanField': pa.bool_(),
+            'DateField': pa.date32(),
+            'DateTimeField': pa.timestamp('us', tz='UTC'),
+        }.get(internal_type, pa.string())
+
+    def schema_for(self, header=None, rows=None):
+        """Return the arrow schema for the header columns.
+        """
+        field_types = {}
+        for model_cls in self.model_classes:
+            for field in model_cls._meta.concrete_fields:
+                field_types.setdefault(field.attname, self.field_type(field))
+        for name, field in self.derived_fields.items():
+            field_types.setdefault(name, self.field_type(field))
+        field_types.setdefault('cohort', pa.string())
+        fields = []
+        for name in header:
+            field_type = field_types.get(name)
+            if field_type is None:
+                values = [row.get(name) for row in rows if row.get(name) is not None]
+                try:
+                    field_type = pa.array(values).type if values else pa.string()
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    field_type = pa.string()
+                if pa.types.is_null(field_type):
+                    field_type = pa.string()
+            fields.append(pa.field(name, field_type))
+        return pa.schema(fields)
+
+    def table(self, schema=None, rows=None):
+        """Return an arrow table of rows for the schema.
+        """
+        columns = {}
+        for field in schema:
+            values = [row.get(field.name) for row in rows]
+            if pa.types.is_string(field.type):
+                values = [
+                    v if v is None or isinstance(v, str) else str(v)
+                    for v in values]
+            columns[field.name] = values
+        return pa.Table.from_pydict(columns, schema=schema)
+
+    def open(self, first_chunk=None):
+        """Open the parquet file with the schema of the first chunk.
+        """
+        self.schema = self.schema_for(
+            header=self.header(first_chunk), rows=first_chunk)
+        self.writer = pq.ParquetWriter(
+            self.final_path, self.schema, compression=self.compression)
+
+    def write_rows(self, chunk=None):
+        self.writer.write_table(self.table(schema=self.schema, rows=chunk))
+
+    def close_file(self):
+        if self.writer:
+            self.writer.close()
+
+    @classmethod
+    def concatenate(cls, paths=None, final_path=None, compression='zstd'):
+        """Concatenate parquet part files in order into a file with the
+        unified schema of the parts, a batch at a time.
+        """
+        schema = pa.unify_schemas([pq.read_schema(path) for path in paths])
+        with pq.ParquetWriter(final_path, schema, compression=compression) as writer:
+            for path in paths:
+                for batch in pq.ParquetFile(path).iter_batches():
+                    table = pa.Table.from_batches([batch])
+                    for field in schema:
+                        if field.name not in table.column_names:
+                            table = table.append_column(
+                                field, pa.nulls(len(table), type=field.type))
+                    writer.write_table(table.select(schema.names).cast(schema))
+
+
+export_writers = {
+    'csv': ExportWriter,
+    'parquet': ExportParquetWriter,
+}
+
+
+def export_writer_for(path=None):
+    """Return the writer class of an export file.
+    """
+    for writer_cls in export_writers.values():
+        if path.endswith(writer_cls.extension):
+            return writer_cls
+    return ExportWriter
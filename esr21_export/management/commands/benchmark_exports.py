@@ -0,0 +1,100 @@
+import json
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+
+from esr21_export.benchmark import ExportBenchmark, SyntheticData
+
+
+class Command(BaseCommand):
+
+    help = ('Time the exports over synthetic ESR21 data in a separate '
+            'database. The data is rolled back at the end unless --keep-data '
+            'is given.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--database', required=True,
+            help='Alias of the database to benchmark in, never the default one')
+        parser.add_argument('--subjects', type=int, default=100)
+        parser.add_argument('--visits', type=int, default=3,
+                            help='Visits per subject')
+        parser.add_argument('--inlines', type=int, default=2,
+                            help='Inline rows per crf')
+        parser.add_argument('--m2m-values', type=int, default=2,
+                            help='Many to many values per crf')
+        parser.add_argument('--format', default='csv',
+                            help='Export output format')
+        parser.add_argument('--output',
+                            help='Write the results as json to this file')
+        parser.add_argument('--baseline',
+                            help='Fail on a regression against these json results')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed regression against the baseline')
+        parser.add_argument('--keep-data', action='store_true')
+
+    def check_database(self, database=None):
+        if database == DEFAULT_DB_ALIAS:
+            raise CommandError(
+                'Refusing to write synthetic data into the default database.')
+        if database not in connections.databases:
+            raise CommandError(f'Database {database} is not configured.')
+        if 'esr21_export.routers.ExportRouter' not in settings.DATABASE_ROUTERS:
+            raise CommandError(
+                'Add esr21_export.routers.ExportRouter to DATABASE_ROUTERS so '
+                'the exports read from the benchmark database.')
+        try:
+            connections[database].ensure_connection()
+        except DatabaseError as e:
+            raise CommandError(f'Cannot connect to database {database}: {e}')
+
+    def handle(self, *args, **options):
+        database = options['database']
+        self.check_database(database=database)
+        export_path = tempfile.mkdtemp(prefix='esr21_benchmark_') + '/'
+        try:
+            with transaction.atomic(using=database):
+                synthetic_data = SyntheticData(
+                    subjects=options['subjects'], visits=options['visits'],
+                    inlines=options['inlines'],
+                    m2m_values=options['m2m_values'], database=database)
+                created = synthetic_data.generate()
+                for label, error in synthetic_data.skipped.items():
+                    self.stderr.write(f'Skipped {label}: {error}')
+                self.stdout.write(
+                    f'Created {sum(created.values())} rows in '
+                    f'{len(created)} tables.')
+                benchmark = ExportBenchmark(
+                    export_path=export_path, output_format=options['format'],
+                    database=database)
+                results = benchmark.run()
+                if not options['keep_data']:
+                    transaction.set_rollback(True, using=database)
+        finally:
+            shutil.rmtree(export_path, ignore_errors=True)
+
+        self.stdout.write(
+            f'{"method":<20}{"seconds":>10}{"rows":>10}{"rows/s":>12}'
+            f'{"queries":>10}{"peak MB":>10}')
+        for result in results:
+            self.stdout.write(
+                f'{result["label"]:<20}{result["seconds"]:>10}'
+                f'{result["rows"]:>10}{result["rows_per_second"] or "-":>12}'
+                f'{result["queries"]:>10}{result["peak_memory_mb"]:>10}')
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'options': options, 'results': results}, f, indent=2)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)['results']
+            regressions = benchmark.regressions(
+                baseline=baseline, tolerance=options['tolerance'])
+            if regressions:
+                raise CommandError(
+                    'Export benchmark regressed: ' + '; '.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions.'))
@@ -0,0 +1,65 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from esr21_export.export_jobs import ExportJobRunner
+
+
+class Command(BaseCommand):
+
+    help = 'Run queued exports.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of exports to run at the same time')
+        parser.add_argument(
+            '--poll', type=float, default=10.0,
+            help='Seconds to wait between checks for queued exports')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Exit once there are no queued exports')
+
+    def handle(self, *args, **options):
+        workers = [
+            threading.Thread(
+                target=self.work, args=(options['poll'], options['once']),
+                name=f'esr21_export_worker_{i}')
+            for i in range(options['workers'])]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def work(self, poll=None, once=False):
+        """Claim and run jobs until stopped. A database error, e.g. a
+        locked SQLite database or a dropped connection, is reported and
+        the worker carries on with new connections after a poll.
+        """
+        runner = ExportJobRunner()
+        try:
+            while True:
+                try:
+                    job = runner.claim_job()
+                    if job:
+                        self.run_job(runner=runner, job=job)
+                    elif once:
+                        return
+                    else:
+                        time.sleep(poll)
+                except Exception as e:
+                    self.stderr.write(f'Export worker error: {e!r}')
+                    connections.close_all()
+                    time.sleep(poll)
+        finally:
+            connections.close_all()
+
+    def run_job(self, runner=None, job=None):
+        self.stdout.write(f'Running {job.export_identifier} {job.description}')
+        if runner.run_job(job=job):
+            self.stdout.write(self.style.SUCCESS(
+                f'Completed {job.export_identifier}'))
+        else:
+            self.stderr.write(f'Failed {job.export_identifier}: {job.error}')
@@ -1,48 +1,106 @@
-import os, pandas as pd, openpyxl
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
 
 from django.apps import apps as django_apps
 from django.db.models import ForeignKey
 
+from .export_pool import pool_context, setup_worker
+
+
+def write_app_metadata(final_path=None, app_name=None):
+    """Write the data dictionary of an app to a workbook, a sheet per
+    model, in a single writer session.
+    """
+    metadata = ExportMetadata(export_path=os.path.dirname(final_path) + '/')
+    tmp_path = final_path + '.tmp'
+    with pd.ExcelWriter(tmp_path, engine='openpyxl') as writer:
+        for sheet_name, model_data in metadata.app_metadata(app_name=app_name):
+            pd.DataFrame(model_data).to_excel(writer, sheet_name=sheet_name)
+    os.replace(tmp_path, final_path)
+    return final_path
+
 
 class ExportMetadata:
     """Export data.
     """
 
-    def __init__(self, export_path=None):
-        self.export_path = export_path or django_apps.get_app_config('esr21_export').metadata_path
+    def __init__(self, export_path=None, cache_path=None, processes=None):
+        app_config = django_apps.get_app_config('esr21_export')
+        self.export_path = export_path or app_config.metadata_path
         if not os.path.exists(self.export_path):
             os.makedirs(self.export_path)
+        self.cache_path = cache_path or app_config.metadata_cache_path
+        self.processes = processes or app_config.export_processes
+        self.written_files = []
+
+    def model_metadata(self, app_model=None, exclude_fields=None):
+        """Return the data dictionary rows of a model.
+        """
+        model_data = [['variable name', 'Question', 'field_type', 'choices',
+                       'max_length', 'null', 'blank', 'editable']]
+        for field_object in app_model._meta.get_fields():
+            if not isinstance(field_object, ForeignKey) and field_object.name not in (exclude_fields or []):
+                try:
+                    model_data.append([
+                        field_object.name, field_object.verbose_name,
+                        field_object.get_internal_type(),
+                        field_object.flatchoices or None, field_object.max_length,
+                        field_object.null, field_object.blank,
+                        field_object.editable])
+                except AttributeError:
+                    pass
+        return model_data
+
+    def app_metadata(self, app_name=None):
+        """Yield the sheet name and data dictionary rows of each model
+        of an app.
+        """
+        for app_model in django_apps.get_app_config(app_name).get_models():
+            if 'historical' not in app_model._meta.label_lower:
+                sheet_name = app_model._meta.label_lower.split('.')[1]
+                yield sheet_name, self.model_metadata(app_model=app_model)
+
+    def schema_hash(self, app_name=None):
+        """Return a hash of the data dictionary of an app, which changes
+        whenever one of its model schemas does.
+        """
+        schema = json.dumps(list(self.app_metadata(app_name=app_name)), default=str)
+        return hashlib.sha256(schema.encode()).hexdigest()[:16]
 
     def generate_metadata(self, app_names=None):
         """Generate medata per app name for all models.
+
+        Workbooks are cached by the schema hash of the app and only
+        regenerated, in parallel across apps, when a schema changed.
         """
-        exclude_fields = []
+        os.makedirs(self.cache_path, exist_ok=True)
+        cached = {}
         for app_name in app_names:
-            app_models = django_apps.get_app_config(app_name).get_models()
-            file_name = app_name + '.xlsx'
-            final_path = self.export_path + file_name
-
-            # Create file
-            wb = openpyxl.Workbook()
-            wb.save(final_path)
-
-            for app_model in app_models:
-                if 'historical' not in app_model._meta.label_lower:
-                    sheet_name = app_model._meta.label_lower
-                    sheet_name = sheet_name.split('.')[1]
-                    model_data = [['variable name', 'Question', 'field_type', 'choices',
-                                   'max_length', 'null', 'blank', 'editable']]
-                    for field_object in app_model._meta.get_fields():
-                        if not isinstance(field_object, ForeignKey) and field_object.name not in exclude_fields:
-                            try:
-                                model_data.append([
-                                    field_object.name, field_object.verbose_name,
-                                    field_object.get_internal_type(),
-                                    field_object.flatchoices or None, field_object.max_length,
-                                    field_object.null, field_object.blank,
-                                    field_object.editable])
-                            except AttributeError:
-                                pass
-                    df = pd.DataFrame(model_data)
-                    with pd.ExcelWriter(final_path, mode='a') as writer:
-                        df.to_excel(writer, sheet_name=sheet_name, engine='xlsxwriter')
+            cached[app_name] = os.path.join(
+                self.cache_path,
+                f'{app_name}_{self.schema_hash(app_name=app_name)}.xlsx')
+        stale = {
+            app_name: cache_file for app_name, cache_file in cached.items()
+            if not os.path.exists(cache_file)}
+        if self.processes <= 1 or len(stale) <= 1:
+            for app_name, cache_file in stale.items():
+                write_app_metadata(final_path=cache_file, app_name=app_name)
+        else:
+            with ProcessPoolExecutor(
+                    max_workers=min(self.processes, len(stale)),
+                    mp_context=pool_context(),
+                    initializer=setup_worker) as executor:
+                futures = [
+                    executor.submit(write_app_metadata, cache_file, app_name)
+                    for app_name, cache_file in stale.items()]
+                for future in futures:
+                    future.result()
+        for app_name, cache_file in cached.items():
+            final_path = self.export_path + app_name + '.xlsx'
+            shutil.copyfile(cache_file, final_path)
+            self.written_files.append(final_path)
@@ -0,0 +1,44 @@
+import _socket
+from django.db import migrations, models
+import django.db.models.deletion
+import django_revision.revision_field
+import edc_base.model_fields.hostname_modification_field
+import edc_base.model_fields.userfield
+import edc_base.model_fields.uuid_auto_field
+import edc_base.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esr21_export', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportfile',
+            name='incremental',
+            field=models.BooleanField(default=False, help_text='Only rows created or modified since the last export'),
+        ),
+        migrations.CreateModel(
+            name='ExportWatermark',
+            fields=[
+                ('created', models.DateTimeField(blank=True, default=edc_base.utils.get_utcnow)),
+                ('modified', models.DateTimeField(blank=True, default=edc_base.utils.get_utcnow)),
+                ('user_created', edc_base.model_fields.userfield.UserField(blank=True, help_text='Updated by admin.save_model', max_length=50, verbose_name='user created')),
+                ('user_modified', edc_base.model_fields.userfield.UserField(blank=True, help_text='Updated by admin.save_model', max_length=50, verbose_name='user modified')),
+                ('hostname_created', models.CharField(blank=True, default=_socket.gethostname, help_text='System field. (modified on create only)', max_length=60)),
+                ('hostname_modified', edc_base.model_fields.hostname_modification_field.HostnameModificationField(blank=True, help_text='System field. (modified on every save)', max_length=50)),
+                ('revision', django_revision.revision_field.RevisionField(blank=True, editable=False, help_text='System field. Git repository tag:branch:commit.', max_length=75, null=True, verbose_name='Revision')),
+                ('device_created', models.CharField(blank=True, max_length=10)),
+                ('device_modified', models.CharField(blank=True, max_length=10)),
+                ('id', edc_base.model_fields.uuid_auto_field.UUIDAutoField(blank=True, editable=False, help_text='System auto field. UUID primary key.', primary_key=True, serialize=False)),
+                ('model', models.CharField(max_length=100)),
+                ('high_water_mark', models.DateTimeField()),
+                ('export_file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='esr21_export.exportfile')),
+            ],
+            options={
+                'unique_together': {('export_file', 'model')},
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+from django.db import migrations, models
+
+
+def set_export_status(apps, schema_editor):
+    """Existing exports are never picked up as queued jobs.
+    """
+    export_file_cls = apps.get_model('esr21_export', 'exportfile')
+    export_file_cls.objects.filter(download_complete=False).update(status='failed')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esr21_export', '0002_exportwatermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportfile',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('complete', 'Complete'), ('failed', 'Failed')], default='complete', max_length=15),
+        ),
+        migrations.RunPython(set_export_status, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='exportfile',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('complete', 'Complete'), ('failed', 'Failed')], default='queued', max_length=15),
+        ),
+        migrations.AddField(
+            model_name='exportfile',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='exportfile',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='exportfile',
+            name='email',
+            field=models.EmailField(blank=True, help_text='Notified when the export is ready', max_length=254),
+        ),
+        migrations.AddConstraint(
+            model_name='exportfile',
+            constraint=models.UniqueConstraint(condition=models.Q(status__in=['queued', 'running']), fields=('description',), name='unique_active_export_description'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+import _socket
+from django.db import migrations, models
+import django.db.models.deletion
+import django_revision.revision_field
+import edc_base.model_fields.hostname_modification_field
+import edc_base.model_fields.userfield
+import edc_base.model_fields.uuid_auto_field
+import edc_base.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esr21_export', '0004_exportprogress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportStage',
+            fields=[
+                ('created', models.DateTimeField(blank=True, default=edc_base.utils.get_utcnow)),
+                ('modified', models.DateTimeField(blank=True, default=edc_base.utils.get_utcnow)),
+                ('user_created', edc_base.model_fields.userfield.UserField(blank=True, help_text='Updated by admin.save_model', max_length=50, verbose_name='user created')),
+                ('user_modified', edc_base.model_fields.userfield.UserField(blank=True, help_text='Updated by admin.save_model', max_length=50, verbose_name='user modified')),
+                ('hostname_created', models.CharField(blank=True, default=_socket.gethostname, help_text='System field. (modified on create only)', max_length=60)),
+                ('hostname_modified', edc_base.model_fields.hostname_modification_field.HostnameModificationField(blank=True, help_text='System field. (modified on every save)', max_length=50)),
+                ('revision', django_revision.revision_field.RevisionField(blank=True, editable=False, help_text='System field. Git repository tag:branch:commit.', max_length=75, null=True, verbose_name='Revision')),
+                ('device_created', models.CharField(blank=True, max_length=10)),
+                ('device_modified', models.CharField(blank=True, max_length=10)),
+                ('id', edc_base.model_fields.uuid_auto_field.UUIDAutoField(blank=True, editable=False, help_text='System auto field. UUID primary key.', primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255)),
+                ('stage', models.CharField(choices=[('file', 'Other file work'), ('query', 'Query'), ('rows', 'Row building'), ('encrypt', 'Encrypt values'), ('dates', 'Date formatting'), ('write', 'File write'), ('zip', 'Zip')], max_length=15)),
+                ('wall_time', models.DecimalField(decimal_places=3, help_text='Seconds', max_digits=12)),
+                ('queries', models.PositiveIntegerField(default=0)),
+                ('rows', models.PositiveIntegerField(default=0)),
+                ('export_file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stages', to='esr21_export.exportfile')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esr21_export', '0005_exportstage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportfile',
+            name='fingerprint',
+            field=models.CharField(blank=True, help_text='Signature of the data the export was generated from', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='exportprogress',
+            name='path',
+            field=models.CharField(blank=True, help_text='Name of the file in the export archive', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='exportprogress',
+            name='fingerprint',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='exportprogress',
+            name='reused',
+            field=models.BooleanField(default=False, help_text='Copied from an earlier export with the same fingerprint'),
+        ),
+    ]
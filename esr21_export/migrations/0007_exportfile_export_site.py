@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esr21_export', '0006_export_fingerprints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportfile',
+            name='export_site',
+            field=models.PositiveIntegerField(blank=True, help_text='Only export the data of this site', null=True),
+        ),
+        migrations.RemoveConstraint(
+            model_name='exportfile',
+            name='unique_active_export_description',
+        ),
+        migrations.AddConstraint(
+            model_name='exportfile',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['queued', 'running']), ('export_site__isnull', True)), fields=('description',), name='unique_active_export_description'),
+        ),
+        migrations.AddConstraint(
+            model_name='exportfile',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['queued', 'running']), ('export_site__isnull', False)), fields=('description', 'export_site'), name='unique_active_site_export_description'),
+        ),
+    ]
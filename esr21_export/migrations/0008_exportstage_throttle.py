@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('esr21_export', '0007_exportfile_export_site'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='exportstage',
+            name='stage',
+            field=models.CharField(choices=[('file', 'Other file work'), ('query', 'Query'), ('rows', 'Row building'), ('encrypt', 'Encrypt values'), ('dates', 'Date formatting'), ('write', 'File write'), ('zip', 'Zip'), ('throttle', 'Throttle wait')], max_length=15),
+        ),
+    ]
@@ -1 +1,5 @@
 from .export_file import ExportFile
+from .export_watermark import ExportWatermark
+from .export_progress import ExportProgress
+from .export_stage import ExportStage
+from .export_job_lock import ExportJobLock
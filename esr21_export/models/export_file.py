@@ -1,5 +1,6 @@
 from django.contrib.sites.models import Site
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Q
 
 from edc_base.model_mixins import BaseUuidModel
 
@@ -7,6 +8,8 @@ from edc_base.sites import SiteModelMixin
 from edc_search.model_mixins import SearchSlugManager
 from edc_search.model_mixins import SearchSlugModelMixin as Base
 
+from ..choices import EXPORT_STATUS
+from ..constants import QUEUED, RUNNING
 from ..identifiers import ExportIdentifier
 
 
@@ -15,6 +18,31 @@ class ExportFileManager(SearchSlugManager, models.Manager):
     def get_by_natural_key(self, export_identifier):
         return self.get(export_identifier=export_identifier)
 
+    def create_export(self, description=None, status=QUEUED, **options):
+        """Create an export file, estimating its download time from the
+        last completed export with the same description.
+        """
+        last_doc = self.filter(
+            description=description, download_complete=True).order_by(
+                'created').last()
+        return self.create(
+            description=description,
+            study='esr21',
+            export_identifier=self.model.identifier_cls().identifier,
+            download_time=last_doc.download_time if last_doc else 0.0,
+            status=status,
+            **options)
+
+    def enqueue(self, description=None, **options):
+        """Queue an export job, or return None if an export with the
+        description is already queued or running.
+        """
+        try:
+            with transaction.atomic():
+                return self.create_export(description=description, **options)
+        except IntegrityError:
+            return None
+
 
 class SearchSlugModelMixin(Base):
 
@@ -57,6 +85,35 @@ class ExportFile(SiteModelMixin, SearchSlugModelMixin, BaseUuidModel):
     download_complete = models.BooleanField(
         default=False,)
 
+    incremental = models.BooleanField(
+        default=False,
+        help_text='Only rows created or modified since the last export')
+
+    status = models.CharField(
+        max_length=15,
+        choices=EXPORT_STATUS,
+        default=QUEUED)
+
+    attempts = models.PositiveIntegerField(default=0)
+
+    error = models.TextField(blank=True)
+
+    email = models.EmailField(
+        blank=True,
+        help_text='Notified when the export is ready')
+
+    fingerprint = models.CharField(
+        max_length=64,
+        blank=True,
+        help_text='Signature of the data the export was generated from')
+
+    export_site = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text='Only export the data of this site')
+
+    objects = ExportFileManager()
+
     def __str__(self):
         return f'{self.export_identifier}'
 
@@ -76,3 +133,15 @@ class ExportFile(SiteModelMixin, SearchSlugModelMixin, BaseUuidModel):
             return self.document.url
         except ValueError:
             return None
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['description'],
+                condition=Q(status__in=[QUEUED, RUNNING], export_site__isnull=True),
+                name='unique_active_export_description'),
+            models.UniqueConstraint(
+                fields=['description', 'export_site'],
+                condition=Q(status__in=[QUEUED, RUNNING], export_site__isnull=False),
+                name='unique_active_site_export_description'),
+        ]
@@ -0,0 +1,14 @@
+from django.db import models
+
+from edc_base.model_mixins import BaseUuidModel
+
+
+class ExportJobLock(BaseUuidModel):
+    """A sentinel row updated at the start of a transaction to hold
+    the lock of the export job queue until it commits.
+    """
+
+    name = models.CharField(max_length=50, unique=True)
+
+    def __str__(self):
+        return self.name
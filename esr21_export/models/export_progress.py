@@ -0,0 +1,59 @@
+from django.db import models
+
+from edc_base.model_mixins import BaseUuidModel
+from edc_base.utils import get_utcnow
+
+from .export_file import ExportFile
+
+
+class ExportProgress(BaseUuidModel):
+    """The rows written so far of a file in an export, updated after
+    each chunk while the file is written.
+    """
+
+    export_file = models.ForeignKey(
+        ExportFile, on_delete=models.CASCADE, related_name='progress')
+
+    name = models.CharField(max_length=255)
+
+    rows_done = models.PositiveIntegerField(default=0)
+
+    rows_total = models.PositiveIntegerField(null=True)
+
+    finished = models.DateTimeField(null=True)
+
+    path = models.CharField(
+        max_length=255,
+        blank=True,
+        help_text='Name of the file in the export archive')
+
+    fingerprint = models.CharField(max_length=64, blank=True)
+
+    reused = models.BooleanField(
+        default=False,
+        help_text='Copied from an earlier export with the same fingerprint')
+
+    def __str__(self):
+        return f'{self.export_file} {self.name}'
+
+    def update_rows(self, rows_done=None, finished=False):
+        """Record the rows written without touching the other fields,
+        touching the export file as the heartbeat of a running job.
+        """
+        self.rows_done = rows_done
+        self.modified = get_utcnow()
+        if finished:
+            self.finished = self.modified
+        ExportProgress.objects.filter(pk=self.pk).update(
+            rows_done=self.rows_done, modified=self.modified,
+            finished=self.finished)
+        ExportFile.objects.filter(pk=self.export_file_id).update(
+            modified=self.modified)
+
+    @property
+    def elapsed(self):
+        return ((self.finished or get_utcnow()) - self.created).total_seconds()
+
+    @property
+    def rows_per_second(self):
+        return self.rows_done / self.elapsed if self.elapsed > 0 else None
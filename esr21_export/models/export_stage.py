@@ -0,0 +1,31 @@
+from django.db import models
+
+from edc_base.model_mixins import BaseUuidModel
+
+from ..choices import EXPORT_STAGES
+from .export_file import ExportFile
+
+
+class ExportStage(BaseUuidModel):
+    """The wall time, query count and rows of a stage of a file in an
+    export.
+    """
+
+    export_file = models.ForeignKey(
+        ExportFile, on_delete=models.CASCADE, related_name='stages')
+
+    name = models.CharField(max_length=255)
+
+    stage = models.CharField(max_length=15, choices=EXPORT_STAGES)
+
+    wall_time = models.DecimalField(
+        max_digits=12,
+        decimal_places=3,
+        help_text='Seconds')
+
+    queries = models.PositiveIntegerField(default=0)
+
+    rows = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.export_file} {self.name} {self.stage}'
@@ -0,0 +1,23 @@
+from django.db import models
+
+from edc_base.model_mixins import BaseUuidModel
+
+from .export_file import ExportFile
+
+
+class ExportWatermark(BaseUuidModel):
+    """The high-water mark of modified for a model in an export, the
+    point the next incremental export of the same description runs from.
+    """
+
+    export_file = models.ForeignKey(ExportFile, on_delete=models.CASCADE)
+
+    model = models.CharField(max_length=100)
+
+    high_water_mark = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.export_file} {self.model}'
+
+    class Meta:
+        unique_together = ('export_file', 'model')
@@ -0,0 +1,84 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.apps import apps as django_apps
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+exporting = ContextVar('exporting', default=False)
+
+available_databases = {}
+
+
+def database_available(alias=None):
+    """Return True if the database can be connected to, closing a
+    connection that is no longer usable so the next check reconnects.
+    """
+    connection = connections[alias]
+    try:
+        connection.ensure_connection()
+    except DatabaseError:
+        return False
+    if connection.is_usable():
+        return True
+    try:
+        connection.close()
+    except DatabaseError:
+        pass
+    return False
+
+
+def export_database():
+    """Return the alias of the database export reads are sent to, the
+    default database if the configured one is missing or unreachable.
+
+    Whether the database is reachable is checked again once the last
+    check is older than the check interval, so a long running worker
+    fails over to the default database and back.
+    """
+    app_config = django_apps.get_app_config('esr21_export')
+    alias = app_config.export_database
+    if alias == DEFAULT_DB_ALIAS or alias not in connections.databases:
+        return DEFAULT_DB_ALIAS
+    available, checked = available_databases.get(alias, (False, None))
+    now = time.monotonic()
+    if checked is None or now - checked >= app_config.export_database_check_interval:
+        available = database_available(alias=alias)
+        available_databases[alias] = (available, now)
+    return alias if available else DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def export_reads():
+    """Send the reads of the block to the export database.
+    """
+    token = exporting.set(True)
+    try:
+        yield
+    finally:
+        exporting.reset(token)
+
+
+class ExportRouter:
+    """Route the reads of a running export to the export database.
+
+    Models of the export app, e.g. the export file and its progress,
+    are always read from and written to the default database, as are
+    all other reads outside an export.
+    """
+
+    export_app_label = 'esr21_export'
+
+    def db_for_read(self, model, **hints):
+        if exporting.get() and model._meta.app_label != self.export_app_label:
+            return export_database()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
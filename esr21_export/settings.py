@@ -80,6 +80,8 @@ DATABASES = {
     }
 }
 
+DATABASE_ROUTERS = ['esr21_export.routers.ExportRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
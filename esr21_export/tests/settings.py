@@ -0,0 +1,34 @@
+"""Settings for the esr21_export tests, with a second SQLite database
+as the export replica.
+
+    python manage.py test esr21_export.tests --settings=esr21_export.tests.settings
+"""
+from ..settings import *  # noqa
+
+INSTALLED_APPS = INSTALLED_APPS + [  # noqa
+    'simple_history',
+    'django_crypto_fields.apps.AppConfig',
+    'django_revision.apps.AppConfig',
+    'edc_registration.apps.AppConfig',
+    'edc_appointment.apps.AppConfig',
+    'esr21_subject.apps.AppConfig',
+    'esr21_prn.apps.AppConfig',
+    'esr21_export.apps.EdcBaseAppConfig',
+    'esr21_export.apps.EdcDeviceAppConfig',
+    'esr21_export.apps.AppConfig',
+]
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',  # noqa
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db_replica.sqlite3',  # noqa
+    },
+}
+
+DATABASE_ROUTERS = ['esr21_export.routers.ExportRouter']
+
+ESR21_EXPORT_DATABASE = 'replica'
@@ -0,0 +1,134 @@
+import copy
+import datetime
+import re
+
+from django.contrib.auth.models import User
+from django.db import models
+from django.test import SimpleTestCase
+from pytz import timezone, utc
+
+from ..export_methods import ExportMethods
+
+
+def fix_date_format(obj_dict=None):
+    """The per row date formatting fix_date_format_chunk replaced, kept
+    as the reference the chunked formatting is checked against.
+    """
+    result_dict_obj = {**obj_dict}
+    for key, value in obj_dict.items():
+        if isinstance(value, datetime.datetime):
+            value = value.astimezone(timezone('Africa/Gaborone'))
+            time_value = value.time().strftime('%H:%M:%S.%f')
+            if 'datetime' in key:
+                time_variable = re.sub('datetime', 'time', key)
+            elif 'vaccination_date' == key:
+                time_variable = re.sub('date', 'time', key)
+            else:
+                time_variable = key + '_time'
+            new_key = re.sub('time', '', key)
+            result_dict_obj[new_key] = value.strftime('%m/%d/%Y')
+            result_dict_obj[time_variable] = time_value
+        elif isinstance(value, datetime.date):
+            result_dict_obj[key] = value.strftime('%m/%d/%Y')
+    return result_dict_obj
+
+
+class DateFormatTestMixin:
+
+    derived_fields = {}
+
+    def setUp(self):
+        # Only the date formatting is used, which needs no lookups.
+        self.export_methods = ExportMethods.__new__(ExportMethods)
+        self.export_methods.date_plans = {}
+        self.export_methods.derived_field_plan = dict(self.derived_fields)
+
+    def assertMatchesPerRow(self, rows=None, model_cls=None):
+        expected = [fix_date_format(row) for row in copy.deepcopy(rows)]
+        formatted = self.export_methods.fix_date_format_chunk(
+            rows=copy.deepcopy(rows), model_cls=model_cls)
+        self.assertEqual(formatted, expected)
+
+
+class TestFixDateFormatChunk(DateFormatTestMixin, SimpleTestCase):
+
+    def test_aware_datetimes(self):
+        self.assertMatchesPerRow(rows=[
+            {'report_datetime': datetime.datetime(
+                2021, 3, 4, 22, 30, 15, 123456, tzinfo=utc)},
+            {'report_datetime': datetime.datetime(
+                2021, 12, 31, 23, 59, 59, tzinfo=utc)},
+            {'report_datetime': timezone('Africa/Gaborone').localize(
+                datetime.datetime(2022, 1, 1, 0, 0, 1))},
+        ])
+
+    def test_none_values(self):
+        self.assertMatchesPerRow(rows=[
+            {'report_datetime': None, 'visit_date': None, 'comment': None},
+            {'report_datetime': datetime.datetime(2021, 6, 1, 8, 0, tzinfo=utc),
+             'visit_date': datetime.date(2021, 6, 1), 'comment': None},
+            {'report_datetime': None, 'visit_date': None, 'comment': 'late'},
+        ])
+
+    def test_vaccination_date(self):
+        self.assertMatchesPerRow(rows=[
+            {'vaccination_date': datetime.datetime(
+                2021, 7, 9, 23, 15, tzinfo=utc)},
+            {'vaccination_date': None},
+        ])
+
+    def test_datetime_keys(self):
+        self.assertMatchesPerRow(rows=[
+            {'consent_datetime': datetime.datetime(2021, 2, 1, 9, 0, tzinfo=utc),
+             'sae_datetime': datetime.datetime(2021, 2, 2, 21, 45, tzinfo=utc),
+             'onset': datetime.datetime(2021, 2, 3, 12, 0, tzinfo=utc),
+             'dob': datetime.date(1980, 5, 17)},
+        ])
+
+    def test_dates_before_1677(self):
+        self.assertMatchesPerRow(rows=[
+            {'report_datetime': datetime.datetime(1600, 1, 1, 12, 0, tzinfo=utc),
+             'visit_date': datetime.date(1000, 1, 1)},
+            {'report_datetime': datetime.datetime(2021, 1, 1, 12, 0, tzinfo=utc),
+             'visit_date': datetime.date(2021, 1, 1)},
+        ])
+
+
+class TestFixDateFormatChunkFields(DateFormatTestMixin, SimpleTestCase):
+    """Columns typed by the fields of the model and of the derived
+    columns rather than by their first value.
+    """
+
+    derived_fields = {
+        'dob': models.DateField(),
+        'registration_datetime': models.DateTimeField(),
+    }
+
+    def test_model_datetime_fields(self):
+        self.assertMatchesPerRow(model_cls=User, rows=[
+            {'username': 'a', 'last_login': None,
+             'date_joined': datetime.datetime(2021, 5, 1, 23, 0, tzinfo=utc)},
+            {'username': 'b',
+             'last_login': datetime.datetime(2021, 5, 2, 6, 30, tzinfo=utc),
+             'date_joined': datetime.datetime(2021, 5, 2, 6, 0, tzinfo=utc)},
+        ])
+
+    def test_derived_fields(self):
+        self.assertMatchesPerRow(model_cls=User, rows=[
+            {'dob': None, 'registration_datetime': None},
+            {'dob': datetime.date(1990, 2, 3),
+             'registration_datetime': datetime.datetime(
+                 2021, 1, 31, 22, 0, tzinfo=utc)},
+        ])
+
+    def test_columns_without_values(self):
+        self.assertMatchesPerRow(model_cls=User, rows=[
+            {'username': 'a', 'last_login': None, 'dob': None},
+        ])
+
+    def test_plan_is_kept_between_chunks(self):
+        self.assertMatchesPerRow(model_cls=User, rows=[
+            {'last_login': None, 'dob': None}])
+        self.assertMatchesPerRow(model_cls=User, rows=[
+            {'last_login': datetime.datetime(1650, 5, 2, 6, 30, tzinfo=utc),
+             'dob': datetime.date(1650, 2, 3)}])
@@ -0,0 +1,85 @@
+from django.test import SimpleTestCase
+
+from ..export_planner import ExportPlanner
+from ..export_scheduler import ExportTask
+
+
+def crf_task(export_path=None, **options):
+    return ExportTask('crf', 'export_crf_outputs', export_path, {
+        'output_format': None, 'crf_name': 'adverseevent', 'flat': True,
+        'inline_n_field': None, 'm2m_class': [], 'study': 'esr21_subject',
+        **options})
+
+
+def non_crf_task(export_path=None, **options):
+    return ExportTask('non_crf', 'subject_visit', export_path, {
+        'output_format': None, **options})
+
+
+class TestExportPlanner(SimpleTestCase):
+
+    inline_n_field = [['adverseeventrecord'], 'adverse_event_id']
+
+    def setUp(self):
+        self.planner = ExportPlanner(profiles=[], dir_to_zip='/export')
+
+    def test_repeated_task_is_copied(self):
+        tasks = self.planner.deduplicate(tasks=[
+            non_crf_task('/export/a/'), non_crf_task('/export/b/'),
+            non_crf_task('/export/b/')])
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(tasks[0].export_path, '/export/a/')
+        self.assertEqual(tasks[0].copy_paths, ('/export/b/',))
+
+    def test_task_repeated_in_its_own_path_is_not_copied(self):
+        tasks = self.planner.deduplicate(tasks=[
+            non_crf_task('/export/a/'), non_crf_task('/export/a/')])
+        self.assertEqual(tasks[0].copy_paths, ())
+
+    def test_tasks_with_different_options_are_kept(self):
+        tasks = self.planner.deduplicate(tasks=[
+            non_crf_task('/export/a/'),
+            non_crf_task('/export/b/', output_format='parquet'),
+            crf_task('/export/a/'),
+            crf_task('/export/b/', columns={'adverseevent': ['ae_term']})])
+        self.assertEqual(len(tasks), 4)
+
+    def test_crf_tasks_merge_their_files(self):
+        tasks = self.planner.deduplicate(tasks=[
+            crf_task('/export/a/'),
+            crf_task('/export/b/', flat=False,
+                     inline_n_field=self.inline_n_field)])
+        self.assertEqual(len(tasks), 1)
+        task = tasks[0]
+        self.assertEqual(task.export_path, '/export/a/')
+        self.assertTrue(task.options['flat'])
+        self.assertEqual(task.options['inline_n_field'], self.inline_n_field)
+        self.assertEqual(task.routes, (
+            ('/export/a/', ('esr21_subject_adverseevent',)),
+            ('/export/b/', (
+                'esr21_subject_adverseevent_merged_adverseeventrecord',))))
+
+    def test_merge_sinks_adds_each_file_once(self):
+        m2m = ['adverseevent', 'ae_symptoms', 'symptoms']
+        first = crf_task('/export/a/', m2m_class=[m2m])
+        merged = self.planner.merge_sinks(
+            first=first, task=crf_task(
+                '/export/a/', m2m_class=[m2m],
+                inline_n_field=self.inline_n_field))
+        self.assertEqual(merged.options['m2m_class'], [m2m])
+        self.assertEqual(merged.options['inline_n_field'], self.inline_n_field)
+        self.assertEqual(merged.routes, (
+            ('/export/a/', (
+                'esr21_subject_adverseevent',
+                'esr21_subject_adverseevent_merged_ae_symptoms',
+                'esr21_subject_adverseevent_merged_adverseeventrecord')),))
+
+    def test_crf_task_without_inlines_keeps_none(self):
+        merged = self.planner.merge_sinks(
+            first=crf_task('/export/a/'),
+            task=crf_task('/export/b/', flat=False,
+                          m2m_class=[['adverseevent', 'ae_symptoms', 'symptoms']]))
+        self.assertIsNone(merged.options['inline_n_field'])
+        self.assertFalse(
+            any('merged_adverseeventrecord' in name
+                for _, names in merged.routes for name in names))
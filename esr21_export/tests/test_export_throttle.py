@@ -0,0 +1,87 @@
+from django.test import SimpleTestCase
+
+from ..export_throttle import ExportThrottle, TokenBucket
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.bucket = TokenBucket(rate=10, clock=self.clock)
+
+    def test_no_wait_within_budget(self):
+        self.assertEqual(self.bucket.take(10), 0.0)
+
+    def test_wait_until_out_of_debt(self):
+        self.bucket.take(10)
+        self.assertEqual(self.bucket.take(5), 0.5)
+        self.clock.now = 1.0
+        self.assertEqual(self.bucket.take(5), 0.0)
+
+    def test_idle_time_builds_no_burst(self):
+        self.bucket.take(1)
+        self.clock.now = 100.0
+        self.assertEqual(self.bucket.take(20), 1.0)
+
+
+class TestExportThrottle(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.sleeps = []
+
+    def throttle(self, **options):
+        return ExportThrottle(
+            clock=self.clock, sleep=self.sleeps.append, **options)
+
+    def test_disabled_throttle_never_waits(self):
+        throttle = self.throttle()
+        self.assertFalse(throttle.enabled)
+        self.assertEqual(list(throttle.iterate(range(10), chunk_size=2)),
+                         list(range(10)))
+        self.assertEqual(self.sleeps, [])
+
+    def test_rows_budget_is_shared_between_processes(self):
+        throttle = self.throttle(rows_per_second=100, processes=2)
+        self.assertEqual(list(throttle.iterate(range(150), chunk_size=50)),
+                         list(range(150)))
+        self.assertEqual(self.sleeps, [1.0, 2.0])
+        self.assertEqual(throttle.rows, 150)
+        self.assertEqual(throttle.queries, 3)
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        throttle = self.throttle(latency_threshold=0.5, max_backoff=1.0)
+        throttle.record_fetch(seconds=2.0)
+        self.assertEqual(
+            [throttle.pause() for _ in range(6)],
+            [0.1, 0.2, 0.4, 0.8, 1.0, 1.0])
+
+    def test_backoff_halves_once_latency_recovers(self):
+        throttle = self.throttle(latency_threshold=0.5, max_backoff=1.0)
+        throttle.backoff = 1.0
+        throttle.latency = 0.1
+        self.assertEqual(
+            [throttle.pause() for _ in range(5)],
+            [0.5, 0.25, 0.125, 0.0, 0.0])
+
+    def test_latency_is_a_moving_average(self):
+        throttle = self.throttle(latency_threshold=0.5)
+        throttle.record_fetch(seconds=1.0)
+        throttle.record_fetch(seconds=0.0)
+        self.assertAlmostEqual(throttle.latency, 0.8)
+
+    def test_slow_fetches_back_off(self):
+        throttle = self.throttle(latency_threshold=0.5, max_backoff=1.0)
+        throttle.throttle(rows=10, seconds=2.0)
+        throttle.throttle(rows=10, seconds=2.0)
+        self.assertEqual(self.sleeps, [0.1, 0.2])
+        self.assertAlmostEqual(throttle.waited, 0.3)
@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+
+from ..export_methods import ExportMethods
+
+
+class TestFlattenM2m(SimpleTestCase):
+
+    def setUp(self):
+        # The through table and the list model are read by m2m_lookup and
+        # m2m_columns, given here as the values they would read.
+        self.export_methods = ExportMethods.__new__(ExportMethods)
+        self.export_methods.m2m_lookup = lambda **kwargs: {
+            1: ['cough', 'fever'], 2: []}
+        self.export_methods.m2m_columns = lambda **kwargs: {
+            'cough': 'symptoms_cough', 'fever': 'symptoms_fever',
+            'rash': 'symptoms_rash'}
+        self.export_methods.iterate_values = lambda **kwargs: iter([
+            {'id': 1, 'report': 'a'}, {'id': 2, 'report': 'b'},
+            {'id': 3, 'report': 'c'}])
+
+    def flatten(self, layout=None):
+        return list(self.export_methods.flatten_m2m(
+            queryset=SimpleNamespace(model=None), mm_field='symptoms',
+            layout=layout, columns=['id', 'report']))
+
+    def test_long_layout(self):
+        self.assertEqual(self.flatten(layout='long'), [
+            {'id': 1, 'report': 'a', 'symptoms': 'cough'},
+            {'id': 1, 'report': 'a', 'symptoms': 'fever'},
+            {'id': 2, 'report': 'b'},
+            {'id': 3, 'report': 'c'}])
+
+    def test_wide_layout(self):
+        self.assertEqual(self.flatten(layout='wide'), [
+            {'id': 1, 'report': 'a', 'symptoms_cough': True,
+             'symptoms_fever': True, 'symptoms_rash': False},
+            {'id': 2, 'report': 'b', 'symptoms_cough': False,
+             'symptoms_fever': False, 'symptoms_rash': False},
+            {'id': 3, 'report': 'c', 'symptoms_cough': False,
+             'symptoms_fever': False, 'symptoms_rash': False}])
+
+    def test_rows_do_not_share_dicts(self):
+        first, second = self.flatten(layout='long')[:2]
+        first['report'] = 'changed'
+        self.assertEqual(second['report'], 'a')
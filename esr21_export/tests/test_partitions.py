@@ -0,0 +1,103 @@
+import csv
+import os
+import shutil
+import tempfile
+from unittest import skipUnless
+
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+
+from ..export_partitions import partition_bounds, partition_queryset
+from ..export_writer import ExportParquetWriter, ExportWriter, pa
+
+if pa:
+    import pyarrow.parquet as pq
+
+
+class TestPartitionBounds(TestCase):
+
+    def setUp(self):
+        User.objects.bulk_create(
+            [User(username=f'user_{i}') for i in range(10)])
+        self.queryset = User.objects.all()
+
+    def part_ids(self, bounds=None):
+        ids = []
+        for index, (low, high) in enumerate(bounds):
+            part = partition_queryset(queryset=self.queryset, partition={
+                'model': 'auth.user', 'field': 'id', 'low': low, 'high': high,
+                'index': index})
+            ids += list(part.values_list('id', flat=True))
+        return ids
+
+    def test_fits_in_one_part(self):
+        self.assertEqual(
+            partition_bounds(queryset=self.queryset, rows_per_task=10), [])
+        self.assertEqual(
+            partition_bounds(queryset=self.queryset, rows_per_task=None), [])
+
+    def test_parts_cover_every_row_once(self):
+        bounds = partition_bounds(
+            queryset=self.queryset, field='id', rows_per_task=3)
+        self.assertEqual(len(bounds), 4)
+        self.assertIsNone(bounds[0][0])
+        self.assertIsNone(bounds[-1][1])
+        self.assertEqual(
+            sorted(self.part_ids(bounds=bounds)),
+            sorted(self.queryset.values_list('id', flat=True)))
+
+    def test_rows_added_after_the_bounds_fall_in_the_last_part(self):
+        bounds = partition_bounds(
+            queryset=self.queryset, field='id', rows_per_task=3)
+        user = User.objects.create(username='late')
+        self.assertIn(user.id, self.part_ids(bounds=bounds[-1:]))
+
+
+class TestConcatenate(SimpleTestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def write_csv(self, name=None, rows=None):
+        path = os.path.join(self.path, name)
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerows(rows)
+        return path
+
+    def read_csv(self, path=None):
+        with open(path, newline='', encoding='utf-8') as f:
+            return list(csv.reader(f))
+
+    def test_csv_parts_with_the_same_header(self):
+        paths = [
+            self.write_csv('part_0.csv', [['id', 'a'], ['1', 'x']]),
+            self.write_csv('part_1.csv', [['id', 'a'], ['2', 'y']])]
+        final_path = os.path.join(self.path, 'final.csv')
+        ExportWriter.concatenate(paths=paths, final_path=final_path)
+        self.assertEqual(
+            self.read_csv(final_path), [['id', 'a'], ['1', 'x'], ['2', 'y']])
+
+    def test_csv_parts_with_different_headers(self):
+        paths = [
+            self.write_csv('part_0.csv', [['id', 'a'], ['1', 'x']]),
+            self.write_csv('part_1.csv', [['id', 'b', 'a'], ['2', 'y', 'z']]),
+            self.write_csv('part_2.csv', [['id'], ['3']])]
+        final_path = os.path.join(self.path, 'final.csv')
+        ExportWriter.concatenate(paths=paths, final_path=final_path)
+        self.assertEqual(self.read_csv(final_path), [
+            ['id', 'a', 'b'], ['1', 'x', ''], ['2', 'z', 'y'], ['3', '', '']])
+
+    @skipUnless(pa, 'pyarrow is not installed')
+    def test_parquet_parts_with_different_columns(self):
+        paths = []
+        for index, columns in enumerate([
+                {'id': [1], 'a': ['x']},
+                {'id': [2], 'b': [True], 'a': ['z']}]):
+            path = os.path.join(self.path, f'part_{index}.parquet')
+            pq.write_table(pa.table(columns), path)
+            paths.append(path)
+        final_path = os.path.join(self.path, 'final.parquet')
+        ExportParquetWriter.concatenate(paths=paths, final_path=final_path)
+        self.assertEqual(pq.read_table(final_path).to_pylist(), [
+            {'id': 1, 'a': 'x', 'b': None}, {'id': 2, 'a': 'z', 'b': True}])
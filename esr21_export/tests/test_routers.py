@@ -0,0 +1,55 @@
+from unittest import mock
+
+from django.apps import apps as django_apps
+from django.contrib.auth.models import User
+from django.db import OperationalError, connections, router
+from django.test import TestCase
+
+from ..routers import available_databases, export_database, export_reads
+
+
+class TestExportRouter(TestCase):
+    """Run with esr21_export.tests.settings, which has a separate
+    SQLite database as the replica.
+    """
+
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        available_databases.clear()
+        self.export_file_cls = django_apps.get_model('esr21_export.exportfile')
+
+    def tearDown(self):
+        available_databases.clear()
+
+    def test_export_reads_go_to_replica(self):
+        User.objects.create(username='data_entry')
+        with export_reads():
+            self.assertEqual(router.db_for_read(User), 'replica')
+            self.assertFalse(
+                User.objects.filter(username='data_entry').exists())
+
+    def test_other_reads_stay_on_default(self):
+        User.objects.create(username='data_entry')
+        self.assertEqual(router.db_for_read(User), 'default')
+        self.assertTrue(User.objects.filter(username='data_entry').exists())
+        with export_reads():
+            self.assertEqual(
+                router.db_for_read(self.export_file_cls), 'default')
+            self.assertEqual(router.db_for_write(User), 'default')
+
+    def test_unreachable_replica_is_checked_again(self):
+        app_config = django_apps.get_app_config('esr21_export')
+        with mock.patch.object(app_config, 'export_database_check_interval', 60), \
+                mock.patch('esr21_export.routers.time.monotonic',
+                           side_effect=[0, 30, 90, 100]):
+            with mock.patch.object(
+                    connections['replica'], 'ensure_connection',
+                    side_effect=OperationalError):
+                self.assertEqual(export_database(), 'default')
+            self.assertEqual(export_database(), 'default')
+            self.assertEqual(export_database(), 'replica')
+            with mock.patch.object(
+                    connections['replica'], 'ensure_connection',
+                    side_effect=OperationalError):
+                self.assertEqual(export_database(), 'replica')
@@ -1,7 +1,7 @@
-from django.urls.conf import path
+from django.urls.conf import path, re_path
 
 from .admin_site import esr21_export_admin
-from .views import HomeView, ListBoardView
+from .views import ExportProgressView, HomeView, ListBoardView
 
 from edc_dashboard import UrlConfig
 
@@ -24,3 +24,8 @@ export_listboard_url_config = UrlConfig(
 
 
 urlpatterns += export_listboard_url_config.listboard_urls
+
+urlpatterns += [
+    re_path(f'^progress/(?P<export_identifier>{export_identifier})/$',
+            ExportProgressView.as_view(), name='export_progress_url'),
+]
@@ -1,4 +1,5 @@
 from .administration_view import AdministrationView
+from .export_progress_view import ExportProgressView
 from .home_view import HomeView
 from .listboard_view import ListBoardView
 from .listboard_view_mixin import ListBoardViewMixin
@@ -0,0 +1,105 @@
+from django.contrib.auth.decorators import login_required
+from django.http import Http404, JsonResponse
+from django.utils.decorators import method_decorator
+from django.views.generic import View
+from edc_base.utils import get_utcnow
+
+from ..constants import COMPLETE, RUNNING
+from ..models import ExportFile
+
+
+class ExportProgressView(View):
+    """Return the progress of an export as json, with an ETA worked out
+    from the rate rows have been written at so far.
+
+    Files not started yet are estimated from the rows written for them
+    by the last completed export of the same kind, so the ETA covers the
+    whole export from the first file on.
+    """
+
+    @method_decorator(login_required)
+    def dispatch(self, *args, **kwargs):
+        return super().dispatch(*args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        try:
+            doc = ExportFile.objects.get(
+                export_identifier=kwargs.get('export_identifier'))
+        except ExportFile.DoesNotExist:
+            raise Http404('Export file does not exist.')
+        return JsonResponse(self.progress_data(doc=doc))
+
+    def previous_rows(self, doc=None):
+        """Return the rows written per file name by the last completed
+        export with the same description, site and increment.
+        """
+        previous = ExportFile.objects.filter(
+            description=doc.description, export_site=doc.export_site,
+            incremental=doc.incremental, status=COMPLETE).exclude(
+                pk=doc.pk).order_by('created').last()
+        rows = {}
+        for name, rows_done in (previous.progress.values_list(
+                'name', 'rows_done') if previous else []):
+            rows[name] = rows.get(name, 0) + rows_done
+        return rows
+
+    def pending_rows(self, doc=None, progress=None):
+        """Return the estimated rows of the files, or the parts of a
+        file, that are not started yet, and the number of such files.
+        """
+        started = {}
+        for p in progress:
+            rows = p.rows_done if p.finished or p.rows_total is None else p.rows_total
+            started[p.name] = started.get(p.name, 0) + rows
+        pending = {
+            name: max(rows - started.get(name, 0), 0)
+            for name, rows in self.previous_rows(doc=doc).items()}
+        return (sum(pending.values()),
+                len([name for name in pending if name not in started]))
+
+    def progress_data(self, doc=None):
+        now = get_utcnow()
+        progress = list(doc.progress.order_by('created'))
+        rows_done = sum(p.rows_done for p in progress)
+        rows_remaining = sum(
+            max(p.rows_total - p.rows_done, 0) for p in progress
+            if p.rows_total is not None and not p.finished)
+        files_pending = 0
+        if doc.status != COMPLETE:
+            rows_pending, files_pending = self.pending_rows(
+                doc=doc, progress=progress)
+            rows_remaining += rows_pending
+        running = [p for p in progress if not p.finished]
+        elapsed = rate = eta = last_update = None
+        if progress:
+            elapsed = (now - progress[0].created).total_seconds()
+            rate = rows_done / elapsed if elapsed > 0 else None
+            last_update = (
+                now - max(p.modified for p in progress)).total_seconds()
+        if doc.status == COMPLETE:
+            eta = 0
+        elif doc.status == RUNNING and rate:
+            eta = round(rows_remaining / rate, 1)
+        return {
+            'export_identifier': doc.export_identifier,
+            'description': doc.description,
+            'status': doc.status,
+            'attempts': doc.attempts,
+            'current': [p.name for p in running],
+            'files_done': len(progress) - len(running),
+            'files_pending': files_pending,
+            'rows_done': rows_done,
+            'rows_remaining': rows_remaining,
+            'rows_per_second': round(rate, 1) if rate else None,
+            'elapsed_seconds': round(elapsed, 1) if elapsed else None,
+            'seconds_since_update': round(last_update, 1) if last_update is not None else None,
+            'eta_seconds': eta,
+            'previous_download_time': float(doc.download_time or 0),
+            'files': [
+                {'name': p.name,
+                 'rows_done': p.rows_done,
+                 'rows_total': p.rows_total,
+                 'rows_per_second': round(p.rows_per_second or 0, 1),
+                 'finished': p.finished is not None}
+                for p in progress],
+        }
@@ -1,9 +1,5 @@
-import datetime
 import re
-import threading
-import time
 
-from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.db.models import Q
 from django.db.models.constants import LOOKUP_SEP
@@ -14,9 +10,9 @@ from edc_dashboard.view_mixins import ListboardFilterViewMixin, SearchFormViewMi
 from edc_dashboard.views import ListboardView
 from edc_navbar import NavbarViewMixin
 
+from ..export_profiles import all_profile, export_profiles, incremental_all_profile
 from ..identifiers import ExportIdentifier
 from ..model_wrappers import ExportFileModelWrapper
-from ..models import ExportFile
 from .listboard_view_mixin import ListBoardViewMixin
 
 
@@ -42,73 +38,23 @@ class ListBoardView(NavbarViewMixin, EdcBaseViewMixin, ListBoardViewMixin,
     def dispatch(self, *args, **kwargs):
         return super().dispatch(*args, **kwargs)
 
-    def stop_main_thread(self, thread_name):
-        """Stop export file generation thread.
-        """
-        time.sleep(20)
-        threads = threading.enumerate()
-        threads = [t for t in threads if t.is_alive()]
-        for thread in threads:
-            if thread.name == thread_name:
-                thread._stop()
-
     def get_context_data(self, **kwargs):
 
         context = super().get_context_data(**kwargs)
         download = self.request.GET.get('download')
 
-        if download == '1':
-            self.generate_export(thread_name='esr21_all_export',
-                                 thread_target=self.download_all_data,
-                                 description='ESR21 All Export')
+        site = self.request.GET.get('site')
+        export_site = int(site) if site and site.isdigit() else None
+
+        profile = export_profiles.for_download(download=download)
+        if profile:
+            self.generate_export(
+                description=profile.name, incremental=profile.incremental,
+                export_site=export_site)
 
         context.update(export_add_url=self.model_cls().get_absolute_url())
         return context
 
-    def generate_export(self, thread_name=None, active_download=False,
-                        thread_target=None, description=None):
-
-        threads = threading.enumerate()
-
-        if threads:
-            for thread in threads:
-                if thread.name == thread_name:
-                    active_download = True
-                    messages.add_message(
-                        self.request, messages.INFO,
-                        (f'Download for {description} that was initiated is still running '
-                         'please wait until an export is fully prepared.'))
-
-        if not active_download:
-            is_clean = self.is_clean(description=description)
-            if is_clean:
-
-                download_thread = threading.Thread(
-                    name=thread_name, target=thread_target,
-                    daemon=True)
-                download_thread.start()
-                last_doc = ExportFile.objects.filter(
-                    description=description,
-                    download_complete=True).order_by('created').last()
-
-                if last_doc:
-                    start_time = datetime.datetime.now().strftime(
-                        "%d/%m/%Y %H:%M:%S")
-                    last_doc_time = round(
-                        float(last_doc.download_time) / 60.0, 2)
-
-                    messages.add_message(
-                        self.request, messages.INFO,
-                        (f'Download for {description} has been initiated, you will receive an email once '
-                         'the download is completed. Estimated download time: '
-                         f'{last_doc_time} minutes, file generation started at:'
-                         f' {start_time}'))
-                else:
-                    messages.add_message(
-                        self.request, messages.INFO,
-                        (f'Download for {description} initiated, you will receive an email once '
-                         'the download is completed.'))
-
     def get_queryset_filter_options(self, request, *args, **kwargs):
         options = super().get_queryset_filter_options(request, *args, **kwargs)
         options = self.add_description_filter_options(
@@ -125,11 +71,11 @@ class ListBoardView(NavbarViewMixin, EdcBaseViewMixin, ListBoardViewMixin,
 
     def add_description_filter_options(self, options=None, **kwargs):
         """Updates the filter options to limit the description for all data
-        download.
+        download, full and incremental.
         """
-        description = 'ESR21 All Export'
+        descriptions = [all_profile.name, incremental_all_profile.name]
         options.update(
-            {f'{self.description_lookup_prefix}description': description})
+            {f'{self.description_lookup_prefix}description__in': descriptions})
         return options
 
     def extra_search_options(self, search_term):
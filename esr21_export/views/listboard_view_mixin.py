@@ -1,25 +1,26 @@
 import datetime
 import os
 import shutil
-import threading
 import time
 
+from django.apps import apps as django_apps
 from django.conf import settings
 from django.contrib import messages
 from django.core.exceptions import ValidationError
 from django.core.mail import send_mail
 from edc_base.utils import get_utcnow
 
-from ..export_data_mixin import ExportDataMixin
+from ..constants import COMPLETE, FAILED, RUNNING
+from ..export_archive import ExportArchive
+from ..export_fingerprint import ExportFingerprint
 from ..export_methods import ExportMethods
-from ..export_model_lists import (
-    subject_crfs_list, subject_inlines_dict, subject_many_to_many_crf,
-    subject_model_list, death_report_prn_model_list,
-    offstudy_prn_model_list, subject_many_to_many_non_crf)
+from ..export_profiler import ExportProfiler
+from ..export_model_lists import export_app_labels
+from ..export_planner import ExportPlanner
 from ..metadata_app_names_list import metadata_app_names
-from ..export_non_crfs import ExportNonCrfData
 from ..metadata import ExportMetadata
 from ..models import ExportFile
+from ..routers import export_reads
 
 
 class ListBoardViewMixin:
@@ -27,334 +28,69 @@ class ListBoardViewMixin:
     def __init__(self, to_email=None):
         self.email = to_email
 
-    def vida_current_export(self, export_path=None):
-        """Export current file VIDA is interested in only.
+    def download_profile(self, profile=None, doc=None, export_site=None):
+        """Export the data of an export profile, or of an incremental
+        profile only the rows created, modified or deleted since its last
+        export, of all sites or of the export site only. The data is read
+        from the export database.
         """
-        vida_subject_crfs_list = [
-            'covid19symptomaticinfections',
-            'concomitantmedication',
-            'demographicsdata',
-            'medicalhistory',
-            'pregnancystatus',
-            'pregnancytest',
-            'rapidhivtesting',
-            'vaccinationdetails',
-            'covid19results',
-            'pregoutcome'
-        ]
-
-        vida_subject_inlines_dict = {
-            'adverseevent': [['adverseeventrecord'], 'adverse_event_id'],
-            'seriousadverseevent': [
-                ['seriousadverseeventrecord'], 'serious_adverse_event_id'],
-            'specialinterestadverseevent': [
-                ['specialinterestadverseeventrecord'], 'special_interest_adverse_event_id'],
-            'concomitantmedication': [['medication'], 'concomitant_medication_id'],
-            'pregoutcome': [['outcomeinline'], 'preg_outcome_id']
-        }
-
-        vida_subject_many_to_many_crf = [
-            ['medicalhistory', 'covid_symptoms', 'symptoms'],
-            ['medicalhistory', 'comorbidities', 'diseases'],
-            ['pregnancystatus', 'contraceptive', 'contraception'],
-            ['seriousadverseeventrecord', 'sae_criteria', 'saecriteria'],
-            ['covid19symptomaticinfections', 'symptomatic_infections',
-             'symptomaticinfections'],
-        ]
-
-        vida_subject_model_list = [
-            'eligibilityconfirmation', 'screeningeligibility',
-            'informedconsent', 'vaccinationhistory',
-        ]
-        export_crf_data = ExportDataMixin(export_path=export_path)
-        export_crf_data.export_crfs(
-            crf_list=vida_subject_crfs_list,
-            crf_data_dict=ExportMethods().subject_crf_data_dict,
-            study='esr21_subject')
-        export_crf_data.export_inline_crfs(
-            inlines_dict=vida_subject_inlines_dict,
-            crf_data_dict=ExportMethods().subject_crf_data_dict,
-            study='esr21_subject')
-        export_crf_data.generate_m2m_crf(
-            m2m_class=vida_subject_many_to_many_crf,
-            crf_data_dict=ExportMethods().subject_crf_data_dict,
-            study='esr21_subject')
-
-        non_crf_data = ExportNonCrfData(export_path=export_path)
-        non_crf_data.subject_non_crfs(subject_model_list=vida_subject_model_list)
-
-    def export_subject_data(self, export_path=None):
-            """Export all subject CRF data.
-            """
-            export_crf_data = ExportDataMixin(export_path=export_path)
-            export_crf_data.export_crfs(
-                crf_list=subject_crfs_list,
-                crf_data_dict=ExportMethods().subject_crf_data_dict,
-                study='esr21_subject')
-            export_crf_data.export_inline_crfs(
-                inlines_dict=subject_inlines_dict,
-                crf_data_dict=ExportMethods().subject_crf_data_dict,
-                study='esr21_subject')
-            export_crf_data.generate_m2m_crf(
-                m2m_class=subject_many_to_many_crf,
-                crf_data_dict=ExportMethods().subject_crf_data_dict,
-                study='esr21_subject')
-
-    def export_non_crf_data(self, export_path=None):
-        """Export subject non CFR data.
-        """
-        non_crf_data = ExportNonCrfData(export_path=export_path)
-        non_crf_data.death_report(death_report_prn_model_list=death_report_prn_model_list)
-        non_crf_data.subject_non_crfs(subject_model_list=subject_model_list)
-        non_crf_data.subject_m2m_non_crf(subject_many_to_many_non_crf=subject_many_to_many_non_crf)
-        non_crf_data.subject_visit()
-        non_crf_data.offstudy(offstudy_prn_model_list=offstudy_prn_model_list)
-
-    def export_metadat_data(self, export_path=None):
-        """Export metadata.
-        """
-        metadata = ExportMetadata(export_path=export_path)
-        metadata.generate_metadata(app_names=metadata_app_names)
-
-    def export_requisitions(self, subject_export_path=None):
-        """Export subject requisitions.
-        """
-        pass
-
-    def download_all_data(self):
-        """Export all data.
-        """
-
-        export_identifier = self.identifier_cls().identifier
-        thread_name = 'esr21_all_export'
-        last_doc = ExportFile.objects.filter(
-            description='ESR21 All Export', download_complete=True).order_by(
-                'created').last()
-
-        if last_doc:
-            download_time = last_doc.download_time
-        else:
-            download_time = 0.0
-        options = {
-            'description': 'ESR21 All Export',
-            'study': 'esr21',
-            'export_identifier': export_identifier,
-            'download_time': download_time
-        }
-        doc = ExportFile.objects.create(**options)
-        try:
-            start = time.perf_counter()
-            today_date = datetime.datetime.now().strftime('%Y%m%d')
-
-            zipped_file_path = 'documents/' + export_identifier + '_esr21_export_' + today_date + '.zip'
-            dir_to_zip = settings.MEDIA_ROOT + '/documents/' + export_identifier + '_esr21_export_' + today_date
-
-            export_path = dir_to_zip + '/subject/'
-            self.export_subject_data(export_path=export_path)
-
-            export_path = dir_to_zip + '/non_crf/'
-            self.export_non_crf_data(export_path=export_path)
-
-            doc.document = zipped_file_path
-            doc.save()
-
-            # Zip the file
-
-            self.zipfile(
-                thread_name=thread_name,
-                dir_to_zip=dir_to_zip, start=start,
-                export_identifier=export_identifier,
-                doc=doc)
-        except Exception as e:
-            raise e
-
-    def download_vida_current_export(self):
-
-        export_identifier = self.identifier_cls().identifier
-        thread_name = 'vida_current_export'
-        last_doc = ExportFile.objects.filter(
-            description='Current required Export', download_complete=True).order_by(
-                'created').last()
-
-        if last_doc:
-            download_time = last_doc.download_time
-        else:
-            download_time = 0.0
-        options = {
-            'description': 'Current required Export',
-            'study': 'esr21',
-            'export_identifier': export_identifier,
-            'download_time': download_time
-        }
-        doc = ExportFile.objects.create(**options)
-        try:
-            start = time.perf_counter()
-            today_date = datetime.datetime.now().strftime('%Y%m%d')
-
-            zipped_file_path = 'documents/' + export_identifier + '_esr21_export_' + today_date + '.zip'
-            dir_to_zip = settings.MEDIA_ROOT + '/documents/' + export_identifier + '_esr21_export_' + today_date
-
-            export_path = dir_to_zip + '/current_required/'
-            self.vida_current_export(export_path=export_path)
-
-            doc.document = zipped_file_path
-            doc.save()
-
-            # Zip the file
-
-            self.zipfile(
-                thread_name=thread_name,
-                dir_to_zip=dir_to_zip, start=start,
-                export_identifier=export_identifier,
-                doc=doc)
-        except Exception as e:
-            raise e
-
-    def download_subject_data(self):
-        """Export subject data.
-        """
-
-        export_identifier = self.identifier_cls().identifier
-        thread_name = 'esr21_subject_crf_export'
-        last_doc = ExportFile.objects.filter(
-            description='ESR21 Subject CRF Export', download_complete=True).order_by(
-                'created').last()
-
-        if last_doc:
-            download_time = last_doc.download_time
-        else:
-            download_time = 0.0
-        options = {
-            'description': 'ESR21 Subject CRF Export',
-            'study': 'esr21',
-            'export_identifier': export_identifier,
-            'download_time': download_time
-        }
-        doc = ExportFile.objects.create(**options)
-        try:
-            start = time.perf_counter()
-            today_date = datetime.datetime.now().strftime('%Y%m%d')
-
-            zipped_file_path = 'documents/' + export_identifier + '_esr21_export_' + today_date + '.zip'
-            dir_to_zip = settings.MEDIA_ROOT + '/documents/' + export_identifier + '_esr21_export_' + today_date
-
-            export_path = dir_to_zip + '/subject/'
-            self.export_subject_data(export_path=export_path)
-
-            doc.document = zipped_file_path
-            doc.save()
-
-            # Zip the file
-
-            self.zipfile(
-                thread_name=thread_name,
-                dir_to_zip=dir_to_zip, start=start,
-                export_identifier=export_identifier,
-                doc=doc)
-        except Exception as e:
-            raise e
-
-    def download_non_crf_data(self):
-        """Export all data.
-        """
-        export_identifier = self.identifier_cls().identifier
-        thread_name = 'esr21_non_crf_export',
-        last_doc = ExportFile.objects.filter(
-            description='ESR21 Non CRF Export',
-            download_complete=True).order_by('created').last()
-
-        if last_doc:
-            download_time = last_doc.download_time
-        else:
-            download_time = 0.0
-        options = {
-            'description': 'ESR21 Non CRF Export',
-            'study': 'esr21',
-            'export_identifier': export_identifier,
-            'download_time': download_time
-        }
-        doc = ExportFile.objects.create(**options)
-        try:
-            start = time.perf_counter()
-            today_date = datetime.datetime.now().strftime('%Y%m%d')
-
-            zipped_file_path = 'documents/' + export_identifier + '_esr21_non_crf_export_' + today_date + '.zip'
-            dir_to_zip = settings.MEDIA_ROOT + '/documents/' + export_identifier + '_esr21_non_crf_export_' + today_date
-
-            export_path = dir_to_zip + '/non_crf/'
-            self.export_non_crf_data(export_path=export_path)
-
-            doc.document = zipped_file_path
-            doc.save()
-
-            # Zip the file
-
-            self.zipfile(
-                thread_name=thread_name,
-                dir_to_zip=dir_to_zip, start=start,
-                export_identifier=export_identifier,
-                doc=doc)
-        except Exception as e:
-            raise e
-
-    def download_medata(self):
-        """Export all metadata.
-        """
-
-        export_identifier = self.identifier_cls().identifier
-        thread_name = 'esr21_metadata_export',
-        last_doc = ExportFile.objects.filter(
-            description='Metadata Export',
-            download_complete=True).order_by('created').last()
-
-        if last_doc:
-            download_time = last_doc.download_time
-        else:
-            download_time = 0.0
-        options = {
-            'description': 'Metadata Export',
-            'study': 'esr21',
-            'export_identifier': export_identifier,
-            'download_time': download_time
-        }
-        doc = ExportFile.objects.create(**options)
-        try:
-            start = time.perf_counter()
-            today_date = datetime.datetime.now().strftime('%Y%m%d')
-
-            zipped_file_path = 'documents/' + export_identifier + '_esr21_metadata_export_' + today_date + '.zip'
-            dir_to_zip = settings.MEDIA_ROOT + '/documents/' + export_identifier + '_esr21_metadata_export_' + today_date
-
-            export_path = dir_to_zip + '/metadata/'
-            self.export_metadat_data(export_path=export_path)
-
-            doc.document = zipped_file_path
-            doc.save()
+        doc = doc or ExportFile.objects.create_export(
+            description=profile.name, status=RUNNING,
+            incremental=profile.incremental,
+            export_site=export_site)
+        export_identifier = doc.export_identifier
+        start = time.perf_counter()
+        today_date = datetime.datetime.now().strftime('%Y%m%d')
+
+        file_name = export_identifier + '_' + profile.archive_name + '_' + today_date
+        if doc.export_site is not None:
+            file_name += f'_site_{doc.export_site}'
+        zipped_file_path = 'documents/' + file_name + '.zip'
+        dir_to_zip = settings.MEDIA_ROOT + '/documents/' + file_name
+        with export_reads():
+            if self.reuse_export(
+                    doc=doc, fingerprint=self.profile_fingerprint(
+                        profile=profile, export_site=doc.export_site),
+                    start=start):
+                return
+            archive = ExportArchive(
+                dir_to_zip=dir_to_zip, profiler=ExportProfiler(export_file=doc))
+
+            planner = ExportPlanner(profiles=[profile], dir_to_zip=dir_to_zip)
+            export_methods = ExportMethods(
+                export_file=doc, incremental=doc.incremental)
+            try:
+                with export_methods.lookups():
+                    planner.scheduler(
+                        export_methods=export_methods, archive=archive,
+                        site_id=doc.export_site).run()
+            except Exception:
+                archive.abort()
+                raise
+
+        doc.document = zipped_file_path
+        doc.save()
 
-            # Zip the file
+        # Zip the file
 
-            self.zipfile(
-                thread_name=thread_name,
-                dir_to_zip=dir_to_zip, start=start,
-                export_identifier=export_identifier,
-                doc=doc)
-        except Exception as e:
-            raise e
+        self.zipfile(
+            dir_to_zip=dir_to_zip, start=start,
+            export_identifier=export_identifier,
+            doc=doc, archive=archive)
 
     def zipfile(
-            self, thread_name=None, dir_to_zip=None, start=None,
-            export_identifier=None, doc=None):
-        """Zip file.
-        """
-        # Zip the file
-        if not self.email:
-            self.email = self.request.user.email
-
-        doc.download_complete = True
-        doc.save()
+            self, dir_to_zip=None, start=None,
+            export_identifier=None, doc=None, archive=None):
+        """Zip file, finishing the archive the export files were
+        compressed into as they were written.
 
+        The export is marked complete only once the archive is closed.
+        """
         if not os.path.isfile(dir_to_zip):
-            shutil.make_archive(dir_to_zip, 'zip', dir_to_zip)
+            if archive:
+                archive.close()
+            else:
+                shutil.make_archive(dir_to_zip, 'zip', dir_to_zip)
             # Create a document object.
 
             end = time.perf_counter()
@@ -367,40 +103,116 @@ class ListBoardViewMixin:
                                       export_identifier)
             else:
                 doc.download_time = download_time
+                doc.download_complete = True
+                doc.status = COMPLETE
                 doc.save()
 
-            # Notify user the download is done
-            subject = export_identifier + ' ' + doc.description
-            message = (export_identifier + doc.description +
-                       ' export files have been successfully generated and '
-                       'ready for download. This is an automated message.')
-            send_mail(
-                subject,
-                message,
-                settings.EMAIL_HOST_USER,  # FROM
-                [self.email],  # TO
-                fail_silently=False)
-            threading.Thread(target=self.stop_main_thread, args=(thread_name,))
+            self.notify(doc=doc)
 
-    def is_clean(self, description=None):
-
-        current_file = ExportFile.objects.filter(
-            description=description,
-            download_complete=False).order_by('created').last()
-        if current_file:
-            time_now = (get_utcnow() - current_file.created).total_seconds()
+    def notify(self, doc=None):
+        """Notify user the download is done.
+        """
+        email = self.email or doc.email or self.request.user.email
+        subject = doc.export_identifier + ' ' + doc.description
+        message = (doc.export_identifier + doc.description +
+                   ' export files have been successfully generated and '
+                   'ready for download. This is an automated message.')
+        send_mail(
+            subject,
+            message,
+            settings.EMAIL_HOST_USER,  # FROM
+            [email],  # TO
+            fail_silently=False)
+
+    def data_fingerprint(self, **options):
+        """Return the fingerprint of the data of all export apps.
+        """
+        return ExportFingerprint().app_fingerprint(
+            app_labels=export_app_labels,
+            output_format=django_apps.get_app_config('esr21_export').output_format,
+            **options)
 
-            if time_now <= current_file.download_time:
-                messages.add_message(
-                    self.request, messages.INFO,
-                    (f'Download for {description} that was initiated is still running '
-                     'please wait until an export is fully prepared.'))
+    def metadata_fingerprint(self):
+        """Return the fingerprint of the schemas of the metadata apps.
+        """
+        metadata = ExportMetadata(
+            export_path=django_apps.get_app_config('esr21_export').metadata_cache_path)
+        return ExportFingerprint().fingerprint(
+            schema_hashes=[metadata.schema_hash(app_name=app_name)
+                           for app_name in metadata_app_names])
+
+    def profile_fingerprint(self, profile=None, export_site=None):
+        """Return the fingerprint of the data and schemas an export
+        profile exports.
+        """
+        options = {'profile': profile.definition(), 'export_site': export_site}
+        if profile.exports_metadata:
+            options.update(metadata=self.metadata_fingerprint())
+        if profile.exports_data:
+            return self.data_fingerprint(**options)
+        return ExportFingerprint().fingerprint(**options)
+
+    def reuse_export(self, doc=None, fingerprint=None, start=None):
+        """Complete the export with the archive of the last completed
+        export of the same description if their fingerprints match.
+        """
+        doc.fingerprint = fingerprint
+        doc.save()
+        if doc.incremental or not django_apps.get_app_config(
+                'esr21_export').reuse_export_files:
+            return False
+        last_doc = ExportFile.objects.filter(
+            description=doc.description, status=COMPLETE,
+            incremental=False, fingerprint=fingerprint).exclude(
+                pk=doc.pk).order_by('created').last()
+        try:
+            if not last_doc or not os.path.isfile(last_doc.document.path):
                 return False
-
-        # Delete any other extra failed files
-        docs = ExportFile.objects.filter(download_complete=False)
-        for doc in docs:
-            if doc.created.date() < get_utcnow().date():
-                doc.delete()
+        except ValueError:
+            return False
+        doc.document = last_doc.document.name
+        doc.download_complete = True
+        doc.status = COMPLETE
+        doc.download_time = time.perf_counter() - start
+        doc.save()
+        self.notify(doc=doc)
         return True
 
+    def generate_export(self, description=None, incremental=False,
+                        export_site=None):
+        """Queue an export job for the export workers to run.
+        """
+        self.purge_failed_exports()
+        doc = ExportFile.objects.enqueue(
+            description=description,
+            email=self.request.user.email,
+            incremental=incremental,
+            export_site=export_site)
+        if not doc:
+            messages.add_message(
+                self.request, messages.INFO,
+                (f'Download for {description} that was initiated is still running '
+                 'please wait until an export is fully prepared.'))
+        elif doc.download_time:
+            start_time = datetime.datetime.now().strftime(
+                "%d/%m/%Y %H:%M:%S")
+            last_doc_time = round(float(doc.download_time) / 60.0, 2)
+
+            messages.add_message(
+                self.request, messages.INFO,
+                (f'Download for {description} has been initiated, you will receive an email once '
+                 'the download is completed. Estimated download time: '
+                 f'{last_doc_time} minutes, file generation queued at:'
+                 f' {start_time}'))
+        else:
+            messages.add_message(
+                self.request, messages.INFO,
+                (f'Download for {description} initiated, you will receive an email once '
+                 'the download is completed.'))
+
+    def purge_failed_exports(self):
+        """Delete exports that failed before today.
+        """
+        ExportFile.objects.filter(
+            status=FAILED,
+            created__date__lt=get_utcnow().date()).delete()